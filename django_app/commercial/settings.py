@@ -89,6 +89,14 @@ DATABASES = {
     }
 }
 
+# Кэш общий для всех воркеров на сервере: в нем хранятся статусы фоновых задач (products.tasks)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'django_cache',
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -177,5 +185,9 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': False,
         },
+        # Компилятор numba на уровне DEBUG пишет в лог промежуточное представление ядер
+        'numba': {
+            'level': 'WARNING',
+        },
     },
 }
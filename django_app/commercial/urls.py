@@ -18,6 +18,6 @@ from django.contrib import admin
 from django.urls import path, include
 
 urlpatterns = [
+    path('', include('products.urls')),  # Все маршруты приложения (основной трафик – проверяются первыми)
     path('admin/', admin.site.urls),  # Стандартный админ Django
-    path('', include('products.urls')),  # Все маршруты приложения
 ]
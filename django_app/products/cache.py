@@ -1,24 +1,32 @@
 import json
+import re
 import sqlite3
+import threading
 import time
 import logging
+from collections import OrderedDict
 from typing import Dict, List, Optional, Any, Union
 import pickle
+import numpy as np
 from logger import setup_logger
+from .normalization import normalize_dimensions
 
 logger = setup_logger()
 
 class QueryCache:
-    def __init__(self, db_path: str = "cache.db", expire_time: int = 86400):
+    def __init__(self, db_path: str = "cache.db", expire_time: int = 86400, purge_interval: int = 3600):
         """
         Initialize QueryCache with database path and expiration time.
         
         Args:
             db_path: Path to SQLite database
             expire_time: Cache expiration time in seconds (default: 1 day)
+            purge_interval: Как часто (в секундах) set() удаляет истекшие записи
         """
         self.db_path = db_path
         self.expire_time = expire_time
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
         self.hit_count = 0
         self.miss_count = 0
         self._initialize_db()
@@ -116,12 +124,56 @@ class QueryCache:
             )
             conn.commit()
             logger.info(f"Cached result for query: {query}")
+            # Ключи вида __search__: после загрузки прайса больше не читаются, и get() их не удалит –
+            # истекшие записи чистятся здесь, иначе таблица (и чтение items_with_prefix) растет с каждой загрузкой
+            if time.time() - self._last_purge >= self.purge_interval:
+                self.purge_expired()
             return True
             
         except Exception as e:
             logger.error(f"Error setting cache: {str(e)}")
             return False
     
+    def items_with_prefix(self, prefix: str) -> List[tuple]:
+        """
+        Все неистекшие записи, ключ которых начинается с prefix: [(ключ, значение), ...] в порядке записи.
+        """
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+            cursor.execute(
+                "SELECT query, result FROM query_cache WHERE substr(query, 1, ?) = ? AND timestamp >= ? ORDER BY timestamp, id",
+                (len(prefix), prefix, int(time.time() - self.expire_time))
+            )
+            return [(query, pickle.loads(blob)) for query, blob in cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"Error reading cache prefix {prefix}: {str(e)}")
+            return []
+
+    def purge_expired(self) -> int:
+        """
+        Remove all expired cache entries.
+        
+        Returns:
+            Number of removed entries
+        """
+        self._last_purge = time.time()
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM query_cache WHERE timestamp < ?",
+                (int(time.time() - self.expire_time),)
+            )
+            conn.commit()
+            if cursor.rowcount:
+                logger.info(f"Removed {cursor.rowcount} expired cache entries")
+            return cursor.rowcount
+            
+        except Exception as e:
+            logger.error(f"Error purging expired cache entries: {str(e)}")
+            return 0
+
     def _remove(self, query: str) -> bool:
         """
         Remove cache entry for a query.
@@ -188,4 +240,137 @@ class QueryCache:
     
     def close(self):
         """Close database connection."""
-        logger.info("Cache database connection closed") 
\ No newline at end of file
+        logger.info("Cache database connection closed") 
+
+
+# Числа и размеры запроса: ДУ300 и ДУ400, 10 и 16 атм, 57x5 и 57x6 – разные товары,
+# хотя их эмбеддинги почти совпадают
+_NUMBER_TOKEN_RE = re.compile(r'\d+(?:[.,]\d+)*')
+
+
+def _number_tokens(key: str) -> tuple:
+    return tuple(_NUMBER_TOKEN_RE.findall(normalize_dimensions(key.lower())))
+
+
+class SemanticCache:
+    """
+    Семантический кэш ответов LLM: ищет ранее обработанный запрос с косинусным сходством
+    эмбеддингов >= threshold и возвращает сохранённый ответ.
+    Семантическое попадание возможно только между ключами с одинаковыми числами/размерами
+    (_number_tokens); ключи с разными числами кэшируются только точно.
+    Каждая запись хранится в QueryCache отдельной строкой (store_key:ключ).
+    """
+    def __init__(self, embed_fn, store: Optional[QueryCache] = None, namespace: str = "default",
+                 threshold: float = 0.92, max_entries: int = 5000):
+        """
+        Args:
+            embed_fn: Функция text -> list[float] (например, OpenAIEmbeddings.embed_query) или None
+            store: QueryCache для сохранения кэша между перезапусками
+            namespace: Имя раздела кэша (ключевые слова, маппинг колонок и т.д.)
+            threshold: Минимальное косинусное сходство для попадания
+            max_entries: Максимальное число записей (старые вытесняются)
+        """
+        self.embed_fn = embed_fn
+        self.store = store
+        self.store_key = f"__semantic__:{namespace}:"
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # ключ -> {"value", "vector", "tokens"}; порядок вставки = порядок вытеснения
+        self.entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # числа ключа -> ключи с такими же числами (кандидаты на семантическое попадание)
+        self.by_tokens: Dict[tuple, set] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if self.store is None:
+            return
+        for store_key, record in self.store.items_with_prefix(self.store_key):
+            try:
+                self._put(store_key[len(self.store_key):], record["value"], record["vector"])
+            except Exception as e:
+                logger.error(f"Error loading semantic cache entry: {str(e)}")
+        if self.entries:
+            logger.info(f"Semantic cache '{self.store_key}' loaded: {len(self.entries)} entries")
+
+    def _persist(self, key: str):
+        if self.store is not None:
+            entry = self.entries[key]
+            self.store.set(self.store_key + key, {"value": entry["value"], "vector": entry["vector"]})
+
+    def _put(self, key: str, value: Any, vector: Optional[np.ndarray]) -> List[str]:
+        """Добавляет запись в память; возвращает вытесненные ключи."""
+        tokens = _number_tokens(key)
+        self.entries[key] = {"value": value, "vector": vector, "tokens": tokens}
+        self.by_tokens.setdefault(tokens, set()).add(key)
+        evicted = []
+        while len(self.entries) > self.max_entries:
+            old_key, old_entry = self.entries.popitem(last=False)
+            self.by_tokens.get(old_entry["tokens"], set()).discard(old_key)
+            evicted.append(old_key)
+        return evicted
+
+    def _embed(self, text: str) -> Optional[np.ndarray]:
+        if self.embed_fn is None:
+            return None
+        try:
+            vector = np.asarray(self.embed_fn(text), dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            return vector / norm if norm else None
+        except Exception as e:
+            logger.error(f"Error computing embedding: {str(e)}")
+            return None
+
+    def get(self, key: str):
+        """
+        Возвращает (значение или None, эмбеддинг ключа) – эмбеддинг передаётся в set(), чтобы не считать его дважды.
+        Эмбеддинг считается только если есть ключи с теми же числами; иначе попадание может быть только точным.
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry["value"], None
+            candidates = list(self.by_tokens.get(_number_tokens(key), ()))
+        if not candidates or self.embed_fn is None:
+            return None, None
+        vector = self._embed(key)
+        if vector is None:
+            return None, None
+        best_key, best_sim = None, -1.0
+        for candidate in candidates:
+            with self._lock:
+                entry = self.entries.get(candidate)
+            if entry is None:
+                continue
+            if entry["vector"] is None:
+                # Запись сохранена без эмбеддинга (не было соседей) – считаем один раз и запоминаем
+                entry["vector"] = self._embed(candidate)
+                if entry["vector"] is None:
+                    continue
+                with self._lock:
+                    if candidate in self.entries:
+                        self._persist(candidate)
+            if entry["vector"].shape != vector.shape:
+                continue
+            similarity = float(entry["vector"] @ vector)
+            if similarity > best_sim:
+                best_key, best_sim = candidate, similarity
+        if best_key is not None and best_sim >= self.threshold:
+            logger.info(f"Semantic cache hit: '{key}' ~ '{best_key}' (sim={best_sim:.3f})")
+            return self.entries[best_key]["value"], vector
+        return None, vector
+
+    def set(self, key: str, value: Any, vector: Optional[np.ndarray] = None) -> bool:
+        """Сохраняет ответ; эмбеддинг здесь не считается (только тот, что вернул get)."""
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["value"] = value
+                if vector is not None:
+                    entry["vector"] = vector
+            else:
+                for evicted in self._put(key, value, vector):
+                    if self.store is not None:
+                        self.store._remove(self.store_key + evicted)
+            self._persist(key)
+        return True
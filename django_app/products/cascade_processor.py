@@ -6,13 +6,89 @@ from typing import List, Dict, Optional, Any, Tuple
 import os
 import json
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import docx
 import tabula # Для извлечения таблиц из PDF
 import openpyxl # Для детального анализа стилей
 from pydantic import BaseModel, ValidationError, Field
 
+from .keywords import keyword_finder
+from .query_processor import first_json_block
+
 logger = logging.getLogger('commercial_proposal')
 
+# Текстовые колонки прайса храним в Arrow-строках (непрерывный буфер, .str.* на compute-ядрах Arrow);
+# pyarrow – в requirements.txt, без него (урезанная установка) – обычный object dtype
+try:
+    import pyarrow  # noqa: F401
+    _TEXT_DTYPE = 'string[pyarrow]'
+except ImportError:
+    _TEXT_DTYPE = object
+
+# --- Предкомпилированные регулярные выражения (вызываются на каждую строку/ячейку прайса) ---
+_DIGITS_RE = re.compile(r'\d+')
+_PRICE_CLEAN_RE = re.compile(r'[^\d,.]')
+_PRICE_DIGITS_DOT_RE = re.compile(r'[^\d\.]')
+_HAS_LETTER_RE = re.compile(r'[а-яА-Яa-zA-Z]')
+
+# Пул для фонового эвристического разбора (уровень 3), пока уровни 1-2 ждут ответа LLM.
+# Один на процесс: потоки не создаются заново на каждую загрузку
+_HEURISTICS_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cascade-heuristics')
+# Файлы крупнее в фоне не разбираются: разбор дольше запроса к LLM и занимал бы пул зря,
+# если LLM справится; для них уровень 3 запускается только при необходимости
+HEURISTICS_BACKGROUND_MAX_BYTES = 5 * 1024 * 1024
+_NUMBER_LIKE_RE = re.compile(r'^\d+[\.,\d]*$')
+_PRICE_LIKE_RE = re.compile(r'^\d+[\.,\d\s]*$')
+_ONLY_DIGITS_RE = re.compile(r'^\d+$')
+# Наборы ключевых слов, проверяемые на каждую ячейку, – одна альтернация вместо any(kw in value) по списку
+_GROUP_HEADER_RE = re.compile(
+    'задвижк|фланец|отвод|тройник|переход|клапан|кран|затвор|вентил|фильтр|муфта|чугун|сталь'
+    '|арматура|трубопровод|соединение|крепеж|болт|гайка|шайба|прокладка|уплотнение|редуктор|насос'
+    '|компенсатор|опора|подвеска|изоляция|теплоизоляция|цепь|канат|строп|такелаж|грузоподъем'
+)
+# Ключевые слова строки заголовков таблицы (_find_header_row): все вхождения за один проход по строке
+_HEADER_ROW_KEYWORDS = ['наимен', 'товар', 'цена', 'кол-во', 'остат', 'артикул', 'руб', 'гост', 'н-ра', 'описание']
+_find_header_row_keywords = keyword_finder(_HEADER_ROW_KEYWORDS)
+_HEADER_CONFIDENT_MATCHES = 6
+# Ключевые слова заголовков колонок (_map_columns)
+_PRICE_HEADER_RE = re.compile('цена|price|стоим|cost|value|руб|rub|сумма')
+_STOCK_HEADER_RE = re.compile('остат|кол-во|налич|stock|qty|amount|balance|количество|склад')
+_NAME_HEADER_RE = re.compile('наимен|товар|product|item|описан|nomenkl|назв|продукт')
+_GROUP_HEADER_EXCLUDED = frozenset(['наименование', 'цена', 'остаток', 'артикул', 'гост', 'ту'])
+_IN_STOCK_RE = re.compile(r'наличи|есть|\+')
+_ON_ORDER_RE = re.compile('заказ|ожид')
+_STOCK_TEXT_RE = re.compile('наличи|заказ|есть|нет')
+_STOCK_ZERO_RE = re.compile('нет|0|под заказ|ожид|отсут')
+_STOCK_PRESENT_RE = re.compile('есть|в наличии|налич|много')
+
+
+def _header_row_hits(row_str: str) -> set:
+    """Множество ключевых слов заголовка, встретившихся в тексте строки."""
+    return {kw for _, kw in _find_header_row_keywords(row_str)}
+
+
+@lru_cache(maxsize=256)
+def _columns_by_headers(headers: Tuple[Tuple[str, str], ...]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """
+    Колонки (название, цена, остаток) по тексту заголовков: ((col_idx, заголовок), ...).
+    Результат зависит только от заголовков, поэтому кэшируется – повторные загрузки прайсов
+    одного поставщика и листы с одинаковой шапкой не сканируются заново.
+    """
+    # Заголовки в нижнем регистре считаем один раз для всех трёх поисков
+    headers_lower = [
+        (col_idx, header_str)
+        for col_idx, header_str in ((col_idx, str(h).lower()) for col_idx, h in headers)
+        if header_str != 'nan'
+    ]
+
+    def find_header(keywords_re):
+        return next((col_idx for col_idx, header_str in headers_lower if keywords_re.search(header_str)), None)
+
+    return find_header(_NAME_HEADER_RE), find_header(_PRICE_HEADER_RE), find_header(_STOCK_HEADER_RE)
+
+
 # --- Pydantic модели для валидации ответов LLM ---
 
 class ColumnMap(BaseModel):
@@ -46,6 +122,8 @@ class CascadeProcessor:
             raise ValueError("LLM instance is required.")
         self.llm = llm
         self.cascade_log = []
+        self._heuristics_future = None
+        self._heuristics_cancelled = None
 
     def process_file_cascade(self, file_path: str, file_name: str) -> Dict:
         """
@@ -57,6 +135,8 @@ class CascadeProcessor:
         """
         logger.info(f"--- ЗАПУСК КАСКАДНОЙ СИСТЕМЫ для файла: {file_name} ---")
         self.cascade_log = [f"Начало каскадной обработки файла: {file_name}"]
+        self._heuristics_future = None
+        self._heuristics_cancelled = None
         
         try:
             # Определяем формат файла
@@ -102,7 +182,7 @@ class CascadeProcessor:
             
             # === УРОВЕНЬ 3: ЭВРИСТИЧЕСКИЕ МЕТОДЫ ===
             self.cascade_log.append("🔥 УРОВЕНЬ 3: Эвристические методы (fallback)")
-            level3_result = self._process_level3_heuristics(file_path, file_name)
+            level3_result = self._process_level3_heuristics(file_path, file_name, self._heuristics_future)
             
             if level3_result["success"] and len(level3_result["products"]) > 0:
                 self.cascade_log.append(f"✅ УРОВЕНЬ 3 УСПЕШЕН: {len(level3_result['products'])} товаров")
@@ -132,6 +212,31 @@ class CascadeProcessor:
             
         except Exception as e:
             return self._handle_error(f"Критическая ошибка в каскадной системе: {e}", exc_info=True)
+        finally:
+            # Результат уже получен на уровнях 1-2 – фоновый разбор не нужен: снимаем его из очереди,
+            # а если он уже идет, он остановится на следующем листе
+            if self._heuristics_future is not None:
+                self._heuristics_cancelled.set()
+                self._heuristics_future.cancel()
+                self._heuristics_future = None
+
+    def _start_background_heuristics(self, file_path: str) -> None:
+        """
+        Запускает эвристический разбор (уровень 3) в фоне на время запроса к LLM.
+        Эвристики не ходят в сеть: если уровни 1-2 не справятся, разбор уже готов.
+        Лог у эвристик свой, cascade_log не трогают. Большие файлы (HEURISTICS_BACKGROUND_MAX_BYTES) не запускаются.
+        """
+        if self._heuristics_future is not None:
+            return
+        try:
+            if os.path.getsize(file_path) > HEURISTICS_BACKGROUND_MAX_BYTES:
+                return
+        except OSError:
+            return
+        self._heuristics_cancelled = threading.Event()
+        self._heuristics_future = _HEURISTICS_EXECUTOR.submit(
+            self._process_with_heuristics, file_path, self._heuristics_cancelled
+        )
 
     def _process_level1_spatial(self, file_path: str, file_name: str) -> Dict:
         """УРОВЕНЬ 1: Пространственный анализ LLM для сложных иерархических структур."""
@@ -142,6 +247,7 @@ class CascadeProcessor:
                 return {"success": False, "products": [], "error": "Не удалось создать пространственное представление"}
 
             # Шаг 2: Получение готового списка товаров от LLM
+            self._start_background_heuristics(file_path)
             products_json = self._get_products_from_llm(spatial_json)
             if not products_json:
                 return {"success": False, "products": [], "error": "LLM не смогла извлечь данные из пространственного JSON"}
@@ -166,6 +272,7 @@ class CascadeProcessor:
                 return {"success": False, "products": [], "error": "Не удалось прочитать файл"}
 
             # Шаг 2: Получение карты структуры от LLM
+            self._start_background_heuristics(file_path)
             structure_map, sample_text = self._get_structure_map_from_llm(df)
             if not structure_map:
                 return {"success": False, "products": [], "error": "LLM не смогла определить структуру файла"}
@@ -199,10 +306,17 @@ class CascadeProcessor:
         except Exception as e:
             return {"success": False, "products": [], "error": f"Ошибка уровня 2: {e}"}
 
-    def _process_level3_heuristics(self, file_path: str, file_name: str) -> Dict:
-        """УРОВЕНЬ 3: Эвристические методы (fallback)."""
+    def _process_level3_heuristics(self, file_path: str, file_name: str, heuristics_future=None) -> Dict:
+        """
+        УРОВЕНЬ 3: Эвристические методы (fallback). heuristics_future – разбор, запущенный заранее в фоне.
+        Ждем только уже начатый разбор; если он еще стоит в очереди пула за разборами других загрузок,
+        снимаем его и разбираем файл здесь.
+        """
         try:
-            result = self._process_with_heuristics(file_path)
+            if heuristics_future is not None and not heuristics_future.cancel():
+                result = heuristics_future.result()
+            else:
+                result = self._process_with_heuristics(file_path)
             if result["success"]:
                 # Валидация и очистка данных
                 validated_products = self._validate_and_clean_products(result["products"], "Level 3")
@@ -224,6 +338,8 @@ class CascadeProcessor:
         4. Фильтрацию дубликатов
         """
         validated_products = []
+        # Название в нижнем регистре считаем один раз: оно нужно и проверке качества, и ключу дубликатов
+        name_keys = []
         skipped_count = 0
         
         for i, item in enumerate(products):
@@ -235,8 +351,10 @@ class CascadeProcessor:
                 validated_product = ExtractedProduct(**normalized_item)
                 
                 # Проверка качества данных
-                if self._is_quality_product(validated_product):
+                name_key = validated_product.full_name.lower().strip()
+                if self._is_quality_product(validated_product, name_key):
                     validated_products.append(validated_product.dict())
+                    name_keys.append(name_key)
                 else:
                     skipped_count += 1
                     self.cascade_log.append(f"{level_name}: Пропущен товар низкого качества: {normalized_item.get('full_name', 'Без названия')[:50]}")
@@ -251,7 +369,7 @@ class CascadeProcessor:
                 continue
         
         # Удаление дубликатов
-        unique_products = self._remove_duplicates(validated_products)
+        unique_products = self._remove_duplicates(validated_products, name_keys)
         
         removed_duplicates = len(validated_products) - len(unique_products)
         if removed_duplicates > 0:
@@ -293,7 +411,7 @@ class CascadeProcessor:
         
         return normalized
 
-    def _is_quality_product(self, product: ExtractedProduct) -> bool:
+    def _is_quality_product(self, product: ExtractedProduct, name_lower: Optional[str] = None) -> bool:
         """
         Проверяет качество товара по множественным критериям.
         
@@ -302,8 +420,10 @@ class CascadeProcessor:
         2. Название не является служебным словом
         3. Цена разумная (если указана)
         4. Название содержит значимую информацию
+        
+        name_lower – уже приведённое к нижнему регистру название (если вызывающий его посчитал).
         """
-        name = product.full_name.lower().strip()
+        name = name_lower if name_lower is not None else product.full_name.lower().strip()
         
         # Проверка длины
         if len(name) < 3:
@@ -335,14 +455,17 @@ class CascadeProcessor:
         
         return True
 
-    def _remove_duplicates(self, products: List[Dict]) -> List[Dict]:
-        """Удаляет ИСТИННЫЕ дубликаты товаров (одинаковые название + цена + остаток)."""
+    def _remove_duplicates(self, products: List[Dict], name_keys: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Удаляет ИСТИННЫЕ дубликаты товаров (одинаковые название + цена + остаток).
+        name_keys – названия в нижнем регистре, параллельные products (если уже посчитаны).
+        """
         seen_combinations = set()
         unique_products = []
         
-        for product in products:
+        for i, product in enumerate(products):
             # Создаем ключ из названия, цены и остатка
-            name_key = product["full_name"].lower().strip()
+            name_key = name_keys[i] if name_keys is not None else product["full_name"].lower().strip()
             price_key = str(product.get("price", ""))
             stock_key = str(product.get("stock", ""))
             
@@ -400,6 +523,10 @@ class CascadeProcessor:
             workbook = openpyxl.load_workbook(file_path, data_only=True)
             sheet = workbook.active
             
+            # Объединённые диапазоны: значение хранится в левой верхней ячейке (остальные пустые).
+            # Множество считаем один раз, а не список диапазонов на каждую ячейку
+            merged_starts = {(merged_range.min_row, merged_range.min_col) for merged_range in sheet.merged_cells.ranges}
+            
             cells_data = []
             # Ограничиваем количество строк для анализа, чтобы не превысить лимиты токенов
             max_rows_to_process = 500  # Увеличено для извлечения всех товаров из файлов типа УралОтвод
@@ -411,7 +538,7 @@ class CascadeProcessor:
                             "col": col_idx,
                             "value": str(cell.value),
                             "is_bold": cell.font.b or False,
-                            "is_merged": cell.coordinate in [merged_range.coord for merged_range in sheet.merged_cells.ranges]
+                            "is_merged": (cell.row, cell.column) in merged_starts
                         })
             
             self.cascade_log.append(f"Проанализировано {len(cells_data)} ячеек из Excel файла.")
@@ -541,9 +668,8 @@ class CascadeProcessor:
             self.cascade_log.append("Ответ от LLM получен.")
             
             # Извлекаем JSON из ответа, который может быть обернут в markdown
-            match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if match:
-                json_str = match.group(0)
+            json_str = first_json_block(response_text, '[', ']')
+            if json_str:
                 return json.loads(json_str)
             self.cascade_log.append("JSON-массив не найден в ответе LLM.")
             return None
@@ -758,9 +884,8 @@ class CascadeProcessor:
     def _parse_llm_response(self, response_text: str) -> Optional[Dict]:
         """Извлекает и парсит JSON из текстового ответа LLM."""
         try:
-            match = re.search(r'\{.*\}', response_text, re.DOTALL)
-            if match:
-                json_str = match.group(0)
+            json_str = first_json_block(response_text, '{', '}')
+            if json_str:
                 return json.loads(json_str)
             else:
                 self.cascade_log.append("JSON не найден в ответе LLM.")
@@ -829,14 +954,43 @@ class CascadeProcessor:
         group_headers = self._find_group_headers(df, header_row, data_start_row)
         self.cascade_log.append(f"Найдено {len(group_headers)} заголовков групп: {list(group_headers.values())}")
 
-        for index, row in data_df.iterrows():
+        # Предфильтр по колонкам целиком: строки без названия пропускаются в любом случае, поэтому
+        # в цикл попадают только строки с названием. Заголовок подгруппы обычно имеет название,
+        # но не имеет цены (числа в колонке цены)
+        n_cols = data_df.shape[1]
+        has_name = np.zeros(len(data_df), dtype=bool)
+        for col_idx in name_parts_cols_indices:
+            if col_idx < n_cols:
+                values = data_df.iloc[:, col_idx]
+                has_name |= (
+                    values.notna()
+                    & ~values.astype(str).str.strip().str.lower().isin(['nan', 'none', ''])
+                ).to_numpy(dtype=bool)
+        has_price = np.zeros(len(data_df), dtype=bool)
+        price_values = None
+        if price_col_index is not None and price_col_index < n_cols:
+            prices = data_df.iloc[:, price_col_index]
+            price_str = prices.astype(str)
+            has_price = (prices.notna() & price_str.str.contains(_DIGITS_RE)).to_numpy(dtype=bool)
+            # Цены – как в _clean_price, но на всю колонку: pd.to_numeric(errors='coerce') вместо
+            # float() в try/except на каждую ячейку; нераспознанные и пустые -> None
+            parsed = pd.to_numeric(
+                price_str.str.replace(_PRICE_CLEAN_RE, '', regex=True).str.replace(',', '.', regex=False),
+                errors='coerce',
+            ).where(prices.notna())
+            price_values = parsed.astype(object).where(parsed.notna(), None).tolist()
+        is_subgroup = has_name & ~has_price
+
+        rows = data_df.to_numpy(dtype=object)
+        for index in np.flatnonzero(has_name).tolist():
+            row = rows[index]
             # Проверяем, является ли строка заголовком подгруппы
-            if self._is_subgroup_header(row, name_parts_cols_indices, price_col_index):
+            if is_subgroup[index]:
                 # Это заголовок подгруппы
                 subgroup_parts = []
                 for col_idx in name_parts_cols_indices:
-                    if col_idx < len(row) and pd.notna(row.iloc[col_idx]):
-                        part = str(row.iloc[col_idx]).strip()
+                    if col_idx < len(row) and pd.notna(row[col_idx]):
+                        part = str(row[col_idx]).strip()
                         if part and part.lower() not in ['nan', 'none', '']:
                             subgroup_parts.append(part)
                 
@@ -848,8 +1002,8 @@ class CascadeProcessor:
             # Собираем полное наименование из частей по индексам
             name_parts = []
             for col_idx in name_parts_cols_indices:
-                if col_idx < len(row) and pd.notna(row.iloc[col_idx]):
-                    part = str(row.iloc[col_idx]).strip()
+                if col_idx < len(row) and pd.notna(row[col_idx]):
+                    part = str(row[col_idx]).strip()
                     if part and part.lower() not in ['nan', 'none', '']:
                         name_parts.append(part)
             
@@ -904,9 +1058,7 @@ class CascadeProcessor:
             full_name = " ".join(full_name_parts).strip()
             
             # Извлекаем цену по индексу
-            price = None
-            if price_col_index is not None and price_col_index < len(row):
-                price = self._clean_price(row.iloc[price_col_index])
+            price = price_values[index] if price_values is not None else None
 
             if not full_name or len(full_name) < 3:
                 continue
@@ -914,7 +1066,7 @@ class CascadeProcessor:
             # Извлекаем остаток по индексу
             stock = 'в наличии'
             if stock_col_index is not None and stock_col_index < len(row):
-                stock = self._clean_stock(row.iloc[stock_col_index])
+                stock = self._clean_stock(row[stock_col_index])
             else:
                 # Если колонка остатка не найдена, ищем ее "по смыслу" в строке
                 stock_val_from_row = next((str(v) for v in row if isinstance(v, str) and any(w in v.lower() for w in ['наличи', 'заказ'])), 'в наличии')
@@ -929,28 +1081,21 @@ class CascadeProcessor:
         """Находит заголовки групп во всем файле."""
         group_headers = {}
         
-        # Ищем заголовки групп во всем файле
-        for row_idx in range(len(df)):
+        # Ищем заголовки групп во всем файле; строки берём одним срезом в списки,
+        # а не собираем Series через df.iloc[row_idx] на каждую строку
+        for row_idx, row in enumerate(df.to_numpy(dtype=object).tolist()):
             if row_idx == header_row:  # Пропускаем строку с заголовками колонок
                 continue
-                
-            row = df.iloc[row_idx]
             
             # Ищем ячейки с текстом, которые могут быть заголовками групп
-            for col_idx, value in enumerate(row):
-                if pd.notna(value) and isinstance(value, str):
+            for value in row:
+                if isinstance(value, str):
                     value = str(value).strip()
                     # Расширенный поиск заголовков групп
+                    value_lower = value.lower()
                     if (len(value) > 8 and  # Увеличили минимальную длину
-                        any(keyword in value.lower() for keyword in [
-                            'задвижк', 'фланец', 'отвод', 'тройник', 'переход', 'клапан', 
-                            'кран', 'затвор', 'вентил', 'фильтр', 'муфта', 'чугун', 'сталь',
-                            'арматура', 'трубопровод', 'соединение', 'крепеж', 'болт', 'гайка',
-                            'шайба', 'прокладка', 'уплотнение', 'редуктор', 'насос', 'компенсатор',
-                            'опора', 'подвеска', 'изоляция', 'теплоизоляция', 'цепь', 'канат',
-                            'строп', 'такелаж', 'грузоподъем'
-                        ]) and
-                        value.lower() not in ['наименование', 'цена', 'остаток', 'артикул', 'гост', 'ту']):
+                        _GROUP_HEADER_RE.search(value_lower) and
+                        value_lower not in _GROUP_HEADER_EXCLUDED):
                         group_headers[row_idx] = value
                         self.cascade_log.append(f"Найден заголовок группы в строке {row_idx}: '{value}'")
                         break
@@ -969,61 +1114,36 @@ class CascadeProcessor:
         
         return ""
 
-    def _is_subgroup_header(self, row: pd.Series, name_cols: List[int], price_col: Optional[int]) -> bool:
-        """Проверяет, является ли строка заголовком подгруппы."""
-        # Заголовок подгруппы обычно имеет название, но не имеет цены
-        has_name = False
-        has_price = False
-        
-        # Проверяем наличие названия
-        for col_idx in name_cols:
-            if col_idx < len(row) and pd.notna(row.iloc[col_idx]):
-                value = str(row.iloc[col_idx]).strip()
-                if value and value.lower() not in ['nan', 'none', '']:
-                    has_name = True
-                    break
-        
-        # Проверяем отсутствие цены
-        if price_col is not None and price_col < len(row):
-            price_val = row.iloc[price_col]
-            if pd.notna(price_val):
-                price_str = str(price_val).strip()
-                # Если в колонке цены есть число, это не заголовок
-                if re.search(r'\d+', price_str):
-                    has_price = True
-        
-        # Заголовок подгруппы: есть название, но нет цены
-        return has_name and not has_price
-
     def _find_ru_info(self, df: pd.DataFrame, row_index: int, price_col_index: Optional[int]) -> str:
         """Находит информацию о давлении (Ру) для товара по колонке цены."""
         if price_col_index is None:
             return ""
         
-        # Ищем в строках выше текущей строки информацию о Ру
-        for check_row in range(max(0, row_index - 5), row_index):
-            if check_row < len(df):
-                row = df.iloc[check_row]
-                if price_col_index < len(row) and pd.notna(row.iloc[price_col_index]):
-                    value = str(row.iloc[price_col_index]).strip()
-                    if 'ру' in value.lower() and any(char.isdigit() for char in value):
-                        return value
+        if price_col_index >= df.shape[1]:
+            return ""
+        
+        # Ищем в строках выше текущей строки информацию о Ру – только ячейки колонки цены, одним срезом
+        for value in df.iloc[max(0, row_index - 5):row_index, price_col_index].tolist():
+            if pd.notna(value):
+                value = str(value).strip()
+                if 'ру' in value.lower() and any(char.isdigit() for char in value):
+                    return value
         
         return ""
 
     def _clean_price(self, price_val: Any) -> Optional[float]:
         if pd.isna(price_val): return None
         try:
-            price_str = re.sub(r'[^\d,.]', '', str(price_val)).replace(',', '.')
+            price_str = _PRICE_CLEAN_RE.sub('', str(price_val)).replace(',', '.')
             return float(price_str) if price_str else None
         except (ValueError, TypeError): return None
 
     def _clean_stock(self, stock_val: Any) -> str:
         if pd.isna(stock_val): return "не указан"
         stock_str = str(stock_val).lower().strip()
-        if any(w in stock_str for w in ['наличи', 'есть', '+']): return "в наличии"
-        if any(w in stock_str for w in ['заказ', 'ожид']): return "под заказ"
-        numbers = re.findall(r'\d+', stock_str)
+        if _IN_STOCK_RE.search(stock_str): return "в наличии"
+        if _ON_ORDER_RE.search(stock_str): return "под заказ"
+        numbers = _DIGITS_RE.findall(stock_str)
         return numbers[0] if numbers else "не указан"
 
     def get_cascade_summary(self, result: Dict) -> str:
@@ -1037,7 +1157,8 @@ class CascadeProcessor:
         summary_lines.extend(result.get('cascade_log', ["Лог отсутствует."]))
         return "\n".join(summary_lines)
 
-    def _process_with_heuristics(self, file_path: str) -> Dict:
+    def _process_with_heuristics(self, file_path: str, cancelled: Optional[threading.Event] = None) -> Dict:
+        """Эвристический разбор файла; cancelled – флаг отмены фонового разбора (проверяется между листами)."""
         log = []
         try:
             # Проверяем, есть ли несколько листов в Excel
@@ -1045,24 +1166,28 @@ class CascadeProcessor:
             all_products = []
             
             if file_ext in ['.xlsx', '.xls']:
-                excel_file = pd.ExcelFile(file_path)
-                sheet_names = excel_file.sheet_names
-                log.append(f"Файл содержит {len(sheet_names)} лист(ов): {sheet_names}")
-                
-                # Обрабатываем каждый лист
-                for sheet_name in sheet_names:
-                    log.append(f"\n--- Обработка листа '{sheet_name}' ---")
-                    try:
-                        df = pd.read_excel(file_path, sheet_name=sheet_name, header=None)
-                        log.append(f"Лист '{sheet_name}' прочитан: {df.shape[0]} строк, {df.shape[1]} колонок")
-                        
-                        # Обрабатываем лист теми же методами
-                        products = self._process_single_sheet(df, sheet_name, log)
-                        all_products.extend(products)
-                        
-                    except Exception as sheet_error:
-                        log.append(f"Ошибка обработки листа '{sheet_name}': {sheet_error}")
-                        continue
+                # Книгу открываем один раз и читаем листы из неё: pd.read_excel(file_path, sheet_name=...)
+                # заново открывал и разбирал весь файл для каждого листа
+                with pd.ExcelFile(file_path) as excel_file:
+                    sheet_names = excel_file.sheet_names
+                    log.append(f"Файл содержит {len(sheet_names)} лист(ов): {sheet_names}")
+                    
+                    # Обрабатываем каждый лист
+                    for sheet_name in sheet_names:
+                        if cancelled is not None and cancelled.is_set():
+                            return {"success": False, "products": [], "log": log, "error": "Разбор отменен"}
+                        log.append(f"\n--- Обработка листа '{sheet_name}' ---")
+                        try:
+                            df = excel_file.parse(sheet_name, header=None)
+                            log.append(f"Лист '{sheet_name}' прочитан: {df.shape[0]} строк, {df.shape[1]} колонок")
+                            
+                            # Обрабатываем лист теми же методами
+                            products = self._process_single_sheet(df, sheet_name, log)
+                            all_products.extend(products)
+                            
+                        except Exception as sheet_error:
+                            log.append(f"Ошибка обработки листа '{sheet_name}': {sheet_error}")
+                            continue
                 
                 if all_products:
                     log.append(f"\nВсего извлечено товаров со всех листов: {len(all_products)}")
@@ -1090,7 +1215,10 @@ class CascadeProcessor:
         df.columns = [f"col_{i}" for i in range(len(df.columns))]
         header_map = {f"col_{i}": str(h) for i, h in enumerate(header)}
         
-        data_df = df.iloc[header_row_index + 1:].reset_index(drop=True)
+        # Срез строк – view на блоки исходного листа; reset_index(drop=True) скопировал бы
+        # все данные ради перенумерации, поэтому индекс просто заменяем на RangeIndex
+        data_df = df.iloc[header_row_index + 1:]
+        data_df.index = pd.RangeIndex(len(data_df))
         log.append(f"Лист '{sheet_name}': Данные для обработки подготовлены, начиная со строки {header_row_index + 1}.")
 
         name_col, price_col, stock_col = self._map_columns(header_map, data_df, log)
@@ -1109,19 +1237,28 @@ class CascadeProcessor:
         return products
 
     def _find_header_row(self, df: pd.DataFrame, log: List[str]) -> Tuple[Optional[int], Optional[List[str]]]:
-        header_keywords = ['наимен', 'товар', 'цена', 'кол-во', 'остат', 'артикул', 'руб', 'гост', 'н-ра', 'описание']
         best_row_index = -1
         max_matches = 0
 
-        for i, row in df.head(20).iterrows():
-            row_str = ' '.join(str(x) for x in row.dropna() if x).lower()
+        # Первые 20 строк: текст непустых ячеек через пробел и число разных ключевых слов в нём –
+        # одним проходом альтернации по строке вместо проверки каждого слова отдельно
+        top = df.head(20)
+        cells_present = top.notna().to_numpy()
+        for pos, (row_index, values) in enumerate(zip(top.index, top.to_numpy(dtype=object))):
+            present = cells_present[pos]
+            if not present.any():
+                continue
+            row_str = ' '.join(str(x) for x, ok in zip(values, present) if ok and x).lower()
             if not row_str: continue
             
-            matches = sum(1 for kw in header_keywords if kw in row_str)
+            matches = len(_header_row_hits(row_str))
             
             if matches > 1 and matches > max_matches:
                 max_matches = matches
-                best_row_index = i
+                best_row_index = row_index
+                # Строка с большинством ключевых слов – заголовок, ниже лучше уже не найдётся
+                if max_matches >= _HEADER_CONFIDENT_MATCHES:
+                    break
         
         if best_row_index != -1:
             log.append(f"Найдена строка заголовка (индекс {best_row_index}) с {max_matches} совпадениями.")
@@ -1131,32 +1268,27 @@ class CascadeProcessor:
         return 0, list(df.iloc[0])
 
     def _map_columns(self, header_map: Dict, df: pd.DataFrame, log: List[str]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
-        price_kw = ['цена', 'price', 'стоим', 'cost', 'value', 'руб', 'rub', 'сумма']
-        stock_kw = ['остат', 'кол-во', 'налич', 'stock', 'qty', 'amount', 'balance', 'количество', 'склад']
-        name_kw = ['наимен', 'товар', 'product', 'item', 'описан', 'nomenkl', 'назв', 'продукт']
-
-        def find_header(keywords):
-            for col_idx, header_name in header_map.items():
-                header_str = str(header_name).lower()
-                if header_str != 'nan' and any(k in header_str for k in keywords):
-                    return col_idx
-            return None
-
         # Ищем колонки по заголовкам
-        name_col = find_header(name_kw)
-        price_col = find_header(price_kw)
-        stock_col = find_header(stock_kw)
+        name_col, price_col, stock_col = _columns_by_headers(tuple(header_map.items()))
+        
+        # Для определения по содержимому хватает первых 10 строк; проверки идут по колонке целиком
+        sample = df.head(10)
+        
+        def sample_values(col_idx, lower=False):
+            if col_idx not in sample.columns:
+                return pd.Series([], dtype=object)
+            values = sample[col_idx].astype(str).str.strip()
+            if lower:
+                values = values.str.lower()
+            return values[(values != '') & (values != 'nan')]
         
         # Если не нашли колонку с названием, ищем по содержимому
         if not name_col:
             log.append("Не найдена колонка названий по заголовкам. Пробуем определить по содержимому...")
             for col_idx in header_map.keys():
-                text_like_count = 0
-                for i in range(min(10, len(df))):
-                    val = str(df.iloc[i].get(col_idx, '')).strip()
-                    # Проверяем, похоже ли на текст (не число и не пустое)
-                    if val and val != 'nan' and re.search(r'[а-яА-Яa-zA-Z]', val) and not re.match(r'^\d+[\.,\d]*$', val):
-                        text_like_count += 1
+                values = sample_values(col_idx)
+                # Проверяем, похоже ли на текст (не число и не пустое)
+                text_like_count = int((values.str.contains(_HAS_LETTER_RE) & ~values.str.match(_NUMBER_LIKE_RE)).sum())
                 
                 if text_like_count >= 5:  # Если больше половины значений похожи на текст
                     name_col = col_idx
@@ -1170,12 +1302,8 @@ class CascadeProcessor:
                 if col_idx == name_col:  # Пропускаем колонку с названием
                     continue
                     
-                price_like_count = 0
-                for i in range(min(10, len(df))):
-                    val = str(df.iloc[i].get(col_idx, '')).strip()
-                    # Проверяем, похоже ли на цену (только цифры, точки, запятые)
-                    if val and val != 'nan' and re.match(r'^\d+[\.,\d\s]*$', val):
-                        price_like_count += 1
+                # Проверяем, похоже ли на цену (только цифры, точки, запятые)
+                price_like_count = int(sample_values(col_idx).str.match(_PRICE_LIKE_RE).sum())
                 
                 if price_like_count >= 5:  # Если больше половины значений похожи на цены
                     price_col = col_idx
@@ -1189,12 +1317,9 @@ class CascadeProcessor:
                 if col_idx in [name_col, price_col]:  # Пропускаем уже найденные колонки
                     continue
                     
-                stock_like_count = 0
-                for i in range(min(10, len(df))):
-                    val = str(df.iloc[i].get(col_idx, '')).strip().lower()
-                    # Проверяем, похоже ли на остаток
-                    if val and val != 'nan' and (re.match(r'^\d+$', val) or any(w in val for w in ['наличи', 'заказ', 'есть', 'нет'])):
-                        stock_like_count += 1
+                values = sample_values(col_idx, lower=True)
+                # Проверяем, похоже ли на остаток
+                stock_like_count = int((values.str.match(_ONLY_DIGITS_RE) | values.str.contains(_STOCK_TEXT_RE)).sum())
                 
                 if stock_like_count >= 3:  # Более мягкий критерий для остатков
                     stock_col = col_idx
@@ -1211,72 +1336,74 @@ class CascadeProcessor:
         return name_col, price_col, stock_col
 
     def _extract_products_with_subheaders(self, df: pd.DataFrame, name_col: str, price_col: str, stock_col: Optional[str], log: List[str], header_map: Dict) -> List[Dict]:
-        products = []
-        current_subheader = ""
-        for index, row in df.iterrows():
-            name = str(row.get(name_col, "")).strip()
-            
-            # Пропускаем строки с "nan" или пустыми названиями
-            if not name or name.lower() in ['nan', 'none', '']:
-                continue
-                
-            is_subheader = name and all(pd.isna(v) or str(v).strip() == "" or str(v).strip().lower() == 'nan' for k, v in row.items() if k != name_col)
-            
-            if is_subheader:
-                current_subheader = name
-                log.append(f"Обнаружен подзаголовок: '{current_subheader}'")
-                continue
-
-            full_name = f"{current_subheader} {name}".strip()
-            
-            price = 0
-            price_raw = str(row.get(price_col, "")).strip()
-            if price_raw and price_raw not in ['nan', 'None', '-', '']:
-                # Логируем исходное значение цены для отладки
-                logger.debug(f"Обрабатываем цену: '{price_raw}'")
-                
-                # Удаляем все пробельные символы включая неразрывные пробелы
-                price_raw = price_raw.replace('\xa0', ' ').replace('\u00a0', ' ')
-                
-                # Если цена содержит дробь через пробел (например "1 234,56")
-                # или через точку как разделитель тысяч (например "1.234,56")
-                price_raw = price_raw.replace(' ', '')
-                
-                # Заменяем запятую на точку для десятичных
-                if ',' in price_raw and '.' in price_raw:
-                    # Если есть и точка и запятая, предполагаем что точка - разделитель тысяч
-                    price_raw = price_raw.replace('.', '').replace(',', '.')
-                else:
-                    price_raw = price_raw.replace(',', '.')
-                
-                # Извлекаем только числа и точку
-                clean_price = re.sub(r'[^\d\.]', '', price_raw)
-                
-                if clean_price:
-                    try:
-                        price = float(clean_price)
-                        logger.debug(f"Успешно извлечена цена: {price}")
-                    except (ValueError, TypeError) as e:
-                        logger.debug(f"Не удалось преобразовать цену '{clean_price}': {e}")
-            
-            stock = 100
-            if stock_col and pd.notna(row.get(stock_col)):
-                stock_raw = str(row[stock_col]).lower().strip()
-                if stock_raw != 'nan':
-                    if any(w in stock_raw for w in ['нет', '0', 'под заказ', 'ожид', 'отсут']): 
-                        stock = 0
-                    elif any(w in stock_raw for w in ['есть', 'в наличии', 'налич', 'много']): 
-                        stock = 100
-                    else:
-                        stock_numbers = re.findall(r'\d+', stock_raw)
-                        if stock_numbers: 
-                            stock = int(stock_numbers[0])
-
-            # Добавляем товар только если есть валидное название
-            if full_name and full_name.strip() and full_name.lower() != 'nan':
-                products.append({"name": full_name, "price": price, "stock": stock})
-                if price == 0:
-                    logger.warning(f"Товар с нулевой ценой: {full_name[:50]}...")
+        # Нужные колонки достаём целиком один раз (без Series на каждую строку через iterrows)
+        def column_strings(col):
+            if col is None or col not in df.columns:
+                return np.full(len(df), '', dtype=object)
+            return df[col].astype(str).str.strip().to_numpy(dtype=object)
+        
+        names = column_strings(name_col)
+        names_lower = pd.Series(names, dtype=object).str.lower().to_numpy(dtype=object)
+        
+        # Цены – векторно по всей колонке: NBSP/пробелы убираем, при наличии и точки, и запятой
+        # точка – разделитель тысяч ("1.234,56"), запятая -> точка, остаются только цифры и точка
+        price_raw = pd.Series(column_strings(price_col), dtype=_TEXT_DTYPE)
+        price_str = price_raw.str.replace('\xa0', '', regex=False).str.replace(' ', '', regex=False)
+        thousands_dot = price_str.str.contains(',', regex=False) & price_str.str.contains('.', regex=False)
+        price_str = price_str.where(~thousands_dot, price_str.str.replace('.', '', regex=False))
+        price_str = price_str.str.replace(',', '.', regex=False).str.replace(_PRICE_DIGITS_DOT_RE.pattern, '', regex=True)
+        prices = (
+            pd.to_numeric(price_str, errors='coerce')
+            .where(~price_raw.isin(['nan', 'None', '-', '']).to_numpy(dtype=bool))
+            .fillna(0.0)
+            .to_numpy(dtype=np.float64)
+        )
+        
+        # Остатки: текстовые варианты, затем первое целое число; по умолчанию 100
+        stocks = np.full(len(df), 100, dtype=np.int32)
+        if stock_col and stock_col in df.columns:
+            stock_raw = df[stock_col].astype(str).astype(_TEXT_DTYPE).str.lower().str.strip()
+            stock_numbers = pd.to_numeric(stock_raw.str.extract(r'(?P<num>\d+)', expand=False), errors='coerce')
+            stock_known = df[stock_col].notna().to_numpy() & (stock_raw != 'nan').to_numpy(dtype=bool)
+            stocks = np.select(
+                [
+                    ~stock_known,
+                    stock_raw.str.contains(_STOCK_ZERO_RE.pattern, regex=True).to_numpy(dtype=bool),
+                    stock_raw.str.contains(_STOCK_PRESENT_RE.pattern, regex=True).to_numpy(dtype=bool),
+                    stock_numbers.notna().to_numpy(dtype=bool),
+                ],
+                [100, 0, 100, stock_numbers.fillna(0).to_numpy(dtype=np.int64)],
+                default=100,
+            ).astype(np.int32)
+        
+        # Подзаголовок – строка, где кроме названия все ячейки пустые (NaN, '' или 'nan')
+        other_cols = df.drop(columns=[name_col]) if name_col in df.columns else df
+        other_empty = (
+            other_cols.isna()
+            | other_cols.astype(str).apply(lambda col: col.str.strip().str.lower().isin(['', 'nan']))
+        ).all(axis=1).to_numpy()
+        
+        # Пропускаем строки с "nan" или пустыми названиями
+        valid = ~pd.Series(names_lower, dtype=object).isin(['nan', 'none', '']).to_numpy(dtype=bool)
+        is_subheader = valid & other_empty
+        is_item = valid & ~other_empty
+        for subheader in names[is_subheader]:
+            log.append(f"Обнаружен подзаголовок: '{subheader}'")
+        
+        # Текущий подзаголовок для каждой строки – протягивание последнего подзаголовка вниз
+        # (ffill) вместо состояния в цикле по строкам
+        current_subheader = pd.Series(np.where(is_subheader, names, None), dtype=object).ffill().fillna('')
+        full_names = (current_subheader + ' ' + pd.Series(names, dtype=object)).str.strip()[is_item]
+        
+        # Массивы переводим в питоновские числа разом, а не float()/int() на каждый товар.
+        # Цены остаются float64: во float32 копейки теряют точность (123.45 -> 123.4499969...)
+        item_prices = prices[is_item]
+        products = [
+            {"name": full_name, "price": price, "stock": stock}
+            for full_name, price, stock in zip(full_names.tolist(), item_prices.tolist(), stocks[is_item].tolist())
+        ]
+        for full_name in full_names[item_prices == 0].tolist():
+            logger.warning(f"Товар с нулевой ценой: {full_name[:50]}...")
         
         log.append(f"Извлечено {len(products)} товаров.")
         return products
@@ -6,8 +6,11 @@ import logging
 import numpy as np
 from typing import List, Dict, Optional, Any, Tuple
 import os
+import itertools
 import json
 import csv
+import codecs
+import chardet
 import docx
 import tabula # Для извлечения таблиц из PDF
 import openpyxl # Для детального анализа стилей
@@ -19,6 +22,59 @@ from langchain.chains import LLMChain # Добавил импорт LLMChain
 # Настройка логгера для нового модуля
 logger = logging.getLogger('commercial_proposal')
 
+# Текст PDF извлекаем движком PDFium (C++, pypdfium2 в requirements.txt); без него – PyPDF2
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+
+def _pdf_text(file_path: str) -> str:
+    """Текст всех страниц PDF через перевод строки (пустые страницы пропускаются)."""
+    if pdfium is not None:
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            page_texts = (pdf[i].get_textpage().get_text_range() for i in range(len(pdf)))
+            return '\n'.join(text for text in page_texts if text)
+        finally:
+            pdf.close()
+    from PyPDF2 import PdfReader
+    reader = PdfReader(file_path)
+    # extract_text вызываем один раз на страницу
+    return '\n'.join(text for text in (page.extract_text() for page in reader.pages) if text)
+
+# Для определения кодировки хватает начала файла; chardet на чистом Python – O(N) по байтам
+_ENCODING_SAMPLE_BYTES = 65536
+
+
+def detect_encoding(raw: bytes) -> str:
+    """
+    Кодировка по образцу байтов. BOM, ASCII и корректный UTF-8 определяются сразу,
+    chardet (статистический, на чистом Python) вызывается только для остального – обычно cp1251.
+    """
+    if raw.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if raw.isascii():
+        return 'utf-8'
+    try:
+        # final=False: образец мог оборваться посреди многобайтового символа
+        codecs.getincrementaldecoder('utf-8')().decode(raw, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        pass
+    return chardet.detect(raw[:_ENCODING_SAMPLE_BYTES])['encoding'] or 'utf-8'
+
+
+def _read_text_file(file_path: str) -> str:
+    """Текст .txt запроса в кодировке, определенной по первым _ENCODING_SAMPLE_BYTES байтам (cp1251/utf-8)."""
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    encoding = detect_encoding(raw[:_ENCODING_SAMPLE_BYTES])
+    try:
+        return raw.decode(encoding, errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
 # --- Pydantic модели для валидации извлеченных товаров клиента ---
 
 class ClientRequestedItem(BaseModel):
@@ -185,12 +241,15 @@ class ClientRequestExtractor:
             
             # Унифицированное чтение текста из разных форматов для эвристик
             if ext == '.txt':
-                with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-                    extracted_text = f.read()
+                extracted_text = _read_text_file(file_path)
             elif ext == '.docx':
                 doc = docx.Document(file_path)
-                extracted_text = '\n'.join([p.text for p in doc.paragraphs if p.text.strip()] +
-                                            [cell.text for table in doc.tables for row in table.rows for cell in row.cells if cell.text.strip()])
+                # p.text / cell.text каждый раз заново собирают текст из runs – читаем по одному разу,
+                # пустые абзацы и ячейки пропускаем, промежуточные списки не строим.
+                # Текст не обрезаем: эвристики ниже ищут позиции по всем строкам документа
+                paragraph_texts = (p.text for p in doc.paragraphs)
+                cell_texts = (cell.text for table in doc.tables for row in table.rows for cell in row.cells)
+                extracted_text = '\n'.join(t for t in itertools.chain(paragraph_texts, cell_texts) if t.strip())
             elif ext == '.pdf':
                 try:
                     # Попытка извлечь таблицы с tabula-py, затем текст с PyPDF2
@@ -198,9 +257,7 @@ class ClientRequestExtractor:
                     if tables:
                         extracted_text = '\n'.join([df.to_string(index=False, header=False) for df in tables])
                     else:
-                        from PyPDF2 import PdfReader
-                        reader = PdfReader(file_path)
-                        extracted_text = '\n'.join([page.extract_text() for page in reader.pages if page.extract_text()])
+                        extracted_text = _pdf_text(file_path)
                 except Exception as pdf_err:
                     self.cascade_log.append(f"Ошибка чтения PDF (Tabula/PyPDF2): {pdf_err}")
                     return {"success": False, "items": [], "error": f"Ошибка чтения PDF: {pdf_err}"}
@@ -405,6 +462,10 @@ class ClientRequestExtractor:
             workbook = openpyxl.load_workbook(file_path, data_only=True)
             sheet = workbook.active
             
+            # Объединённые диапазоны: значение хранится в левой верхней ячейке (остальные пустые).
+            # Множество считаем один раз, а не список диапазонов на каждую ячейку
+            merged_starts = {(merged_range.min_row, merged_range.min_col) for merged_range in sheet.merged_cells.ranges}
+            
             cells_data = []
             max_rows_to_process = 500  # Достаточно для большинства запросов
             for row_idx, row in enumerate(sheet.iter_rows(max_row=max_rows_to_process)):
@@ -415,7 +476,7 @@ class ClientRequestExtractor:
                             "col": col_idx,
                             "value": str(cell.value),
                             "is_bold": cell.font.b or False,
-                            "is_merged": cell.coordinate in [merged_range.coord for merged_range in sheet.merged_cells.ranges]
+                            "is_merged": (cell.row, cell.column) in merged_starts
                         })
             
             self.cascade_log.append(f"Проанализировано {len(cells_data)} ячеек из Excel файла.")
@@ -0,0 +1,52 @@
+"""
+Поиск набора ключевых слов в тексте за один проход.
+С pyahocorasick (в requirements.txt) – автомат Ахо-Корасик; без него (урезанная установка) –
+регулярные выражения с тем же результатом.
+Семантика подстрочная: основы вроде 'наимен', 'стоим', 'остат' находятся внутри слов.
+"""
+import re
+from typing import Callable, Iterable, List, Tuple
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    ahocorasick = None
+    AHOCORASICK_AVAILABLE = False
+
+
+def keyword_finder(keywords: Iterable[str]) -> Callable[[str], List[Tuple[int, str]]]:
+    """
+    Возвращает функцию text -> [(позиция, ключевое_слово)] для всех вхождений, в том числе перекрывающихся.
+    Порядок как у автомата: по концу вхождения, при общем конце – сначала более длинное слово.
+    """
+    keywords = list(dict.fromkeys(keywords))
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for kw in keywords:
+            automaton.add_word(kw, kw)
+        automaton.make_automaton()
+        return lambda text: [(end - len(kw) + 1, kw) for end, kw in automaton.iter(text)]
+    # Одна альтернация на одной позиции нашла бы только одно слово, поэтому каждое слово ищется
+    # своим шаблоном; lookahead не поглощает текст – перекрывающиеся вхождения тоже находятся
+    patterns = [(kw, re.compile('(?=' + re.escape(kw) + ')')) for kw in keywords]
+
+    def find(text: str) -> List[Tuple[int, str]]:
+        hits = [(m.start(), kw) for kw, pattern in patterns for m in pattern.finditer(text)]
+        hits.sort(key=lambda hit: (hit[0] + len(hit[1]), -len(hit[1])))
+        return hits
+
+    return find
+
+
+def keyword_matcher(keywords: Iterable[str]) -> Callable[[str], bool]:
+    """Возвращает функцию text -> bool: есть ли в тексте хотя бы одно из ключевых слов."""
+    keywords = list(dict.fromkeys(keywords))
+    if AHOCORASICK_AVAILABLE:
+        automaton = ahocorasick.Automaton()
+        for kw in keywords:
+            automaton.add_word(kw, kw)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text), None) is not None
+    pattern = re.compile('|'.join(re.escape(kw) for kw in keywords))
+    return lambda text: pattern.search(text) is not None
@@ -0,0 +1,48 @@
+import re
+
+from django.db import migrations, models
+
+
+# Копия products.normalization.normalize_product_name на момент миграции: миграция не должна
+# менять смысл вместе с кодом приложения
+_DIM_SEP_RE = re.compile(r'(\d+)\s*[xх*×X]\s*(\d+)', re.IGNORECASE)
+_NUMNUM_RE = re.compile(r'(\d+)\s+(\d+)(?=\s|$|[^\d.])')
+_SLASH_RE = re.compile(r'(\d+)/(\d+)')
+
+
+def normalize_product_name(name):
+    result = (name or '').lower()
+    if not result:
+        return result
+    result = _DIM_SEP_RE.sub(r'\1x\2', result)
+    result = _NUMNUM_RE.sub(r'\1x\2', result)
+    return _SLASH_RE.sub(r'\1x\2', result)
+
+
+def fill_name_norm(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    batch = []
+    for product in Product.objects.only('id', 'name').iterator(chunk_size=2000):
+        product.name_norm = normalize_product_name(product.name)
+        batch.append(product)
+        if len(batch) >= 2000:
+            Product.objects.bulk_update(batch, ['name_norm'])
+            batch = []
+    if batch:
+        Product.objects.bulk_update(batch, ['name_norm'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='name_norm',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=512),
+        ),
+        migrations.RunPython(fill_name_norm, migrations.RunPython.noop),
+    ]
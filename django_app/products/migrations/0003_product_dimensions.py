@@ -0,0 +1,41 @@
+import re
+
+from django.db import migrations, models
+
+
+# Копия products.normalization.extract_dimensions на момент миграции: миграция не должна
+# менять смысл вместе с кодом приложения
+_DIM_RE = re.compile(r'\d+x\d+', re.IGNORECASE)
+
+
+def extract_dimensions(normalized):
+    return _DIM_RE.findall(normalized or '')
+
+
+def fill_dimensions(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    batch = []
+    for product in Product.objects.only('id', 'name_norm').iterator(chunk_size=2000):
+        product.dimensions = extract_dimensions(product.name_norm)
+        batch.append(product)
+        if len(batch) >= 2000:
+            Product.objects.bulk_update(batch, ['dimensions'])
+            batch = []
+    if batch:
+        Product.objects.bulk_update(batch, ['dimensions'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_product_name_norm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='dimensions',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.RunPython(fill_dimensions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+import hashlib
+
+from django.db import migrations, models
+
+
+def search_query_hash(query_text):
+    # Копия products.models.search_query_hash на момент миграции: миграция не должна зависеть от текущего кода моделей
+    return hashlib.sha1(query_text.encode('utf-8')).hexdigest()
+
+
+def fill_query_hash(apps, schema_editor):
+    SearchQuery = apps.get_model('products', 'SearchQuery')
+    batch = []
+    for search_query in SearchQuery.objects.only('id', 'query_text').iterator(chunk_size=2000):
+        search_query.query_hash = search_query_hash(search_query.query_text)
+        batch.append(search_query)
+        if len(batch) >= 2000:
+            SearchQuery.objects.bulk_update(batch, ['query_hash'])
+            batch = []
+    if batch:
+        SearchQuery.objects.bulk_update(batch, ['query_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0003_product_dimensions'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='searchquery',
+            name='query_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=40),
+        ),
+        migrations.RunPython(fill_query_hash, migrations.RunPython.noop),
+    ]
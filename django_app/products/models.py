@@ -1,7 +1,16 @@
+import hashlib
+
 from django.db import models
+from django.dispatch import Signal
+
+from .normalization import normalize_product_name, extract_dimensions
 
 # Create your models here.
 
+# Массовые изменения товаров (bulk_create, delete_fast) не шлют post_save/post_delete –
+# подписчики (индекс названий в query_processor) узнают о них через этот сигнал
+products_bulk_changed = Signal()
+
 class Supplier(models.Model):
     name = models.CharField(max_length=255, unique=True)
     contact_email = models.EmailField(blank=True, null=True)
@@ -15,9 +24,35 @@ class Supplier(models.Model):
     def __str__(self):
         return self.name
 
+class ProductQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create не вызывает save(), поэтому нормализованное название и размеры заполняем здесь
+        objs = list(objs)
+        for obj in objs:
+            obj.fill_search_fields()
+        created = super().bulk_create(objs, *args, **kwargs)
+        products_bulk_changed.send(sender=self.model)
+        return created
+
+    def delete_fast(self):
+        """
+        Удаляет товары без загрузки в память: связи с КП и сами товары – по одному DELETE.
+        post_delete не отправляется, вместо него – products_bulk_changed (индекс названий
+        query_processor.get_name_index перестраивается по нему).
+        """
+        self.model.proposals.through.objects.filter(product__in=self).delete()
+        deleted = self._raw_delete(self.db)
+        products_bulk_changed.send(sender=self.model)
+        return deleted
+
+
 class Product(models.Model):
     supplier = models.ForeignKey(Supplier, on_delete=models.CASCADE, related_name='products')
     name = models.CharField(max_length=512)
+    # Нормализованное название (нижний регистр + размеры 57х5/57*5 -> 57x5) – считается один раз при записи
+    name_norm = models.CharField(max_length=512, blank=True, default='', db_index=True, editable=False)
+    # Размеры из name_norm (['57x5', ...]) – скоринг поиска берёт их готовыми, без regex на каждый запрос
+    dimensions = models.JSONField(default=list, blank=True, editable=False)
     # Изменяем price и stock на CharField для поддержки "X"
     price = models.CharField(max_length=50, default='X')  # Цена или "X"
     stock = models.CharField(max_length=50, default='X')  # Количество или "X"
@@ -27,23 +62,62 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ProductQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Товар"
         verbose_name_plural = "Товары"
 
+    def fill_search_fields(self):
+        """Пересчитывает производные от названия поля для поиска"""
+        self.name_norm = normalize_product_name(self.name)
+        self.dimensions = extract_dimensions(self.name_norm)
+
+    def save(self, *args, **kwargs):
+        self.fill_search_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'name' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'name_norm', 'dimensions'}
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.name} ({self.supplier.name})"
 
+def search_query_hash(query_text: str) -> str:
+    """sha1 текста запроса – индексируемый ключ вместо сравнения TextField целиком"""
+    return hashlib.sha1(query_text.encode('utf-8')).hexdigest()
+
+
+class SearchQueryQuerySet(models.QuerySet):
+    def record(self, query_text: str, result_count: int) -> 'SearchQuery':
+        """
+        Возвращает запись запроса (создает при первом обращении) и обновляет result_count.
+        Поиск идет по индексу query_hash, а не сканированием query_text.
+        """
+        query_hash = search_query_hash(query_text)
+        if self.filter(query_hash=query_hash).update(result_count=result_count):
+            return self.filter(query_hash=query_hash).first()
+        return self.create(query_text=query_text, query_hash=query_hash, result_count=result_count)
+
+
 class SearchQuery(models.Model):
     query_text = models.TextField()
+    # sha1(query_text) – по нему ищется повтор запроса
+    query_hash = models.CharField(max_length=40, blank=True, default='', db_index=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     result_count = models.IntegerField(default=0)
     proposals = models.ManyToManyField('Proposal', blank=True, related_name='search_queries')
 
+    objects = SearchQueryQuerySet.as_manager()
+
     class Meta:
         verbose_name = "Поисковый запрос"
         verbose_name_plural = "Поисковые запросы"
 
+    def save(self, *args, **kwargs):
+        self.query_hash = search_query_hash(self.query_text)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         return f"{self.query_text[:50]}... ({self.created_at:%Y-%m-%d %H:%M})"
 
@@ -0,0 +1,56 @@
+"""
+Нормализация названий товаров и запросов.
+Модуль без тяжёлых зависимостей – используется и моделями, и поиском.
+"""
+import re
+from functools import lru_cache
+from typing import List
+
+# Предкомпилированные шаблоны размеров
+_DIM_SEP_RE = re.compile(r'(\d+)\s*[xх*×X]\s*(\d+)', re.IGNORECASE)
+_NUMNUM_RE = re.compile(r'(\d+)\s+(\d+)(?=\s|$|[^\d.])')
+_SLASH_RE = re.compile(r'(\d+)/(\d+)')
+_DIM_RE = re.compile(r'\d+x\d+', re.IGNORECASE)
+
+
+# Чистая функция, вызывается повторно на одних и тех же названиях и запросах – мемоизируем
+@lru_cache(maxsize=200_000)
+def normalize_dimensions(text: str) -> str:
+    """
+    Приводит размеры к единому виду:
+    '57х5', '57 х 5', '57*5', '57 x 5', '57X5', '57 5' -> '57x5'
+    ВАЖНО: нормализует ВСЕ возможные варианты написания размеров
+    """
+    if not text:
+        return text
+    
+    result = text
+    
+    # 1. Заменяем все варианты разделителей размеров на 'x'
+    # Кириллическая 'х', латинская 'x', '*', любые пробелы вокруг
+    result = _DIM_SEP_RE.sub(r'\1x\2', result)
+    
+    # 2. КРИТИЧНО: "число пробел число" тоже размер (57 5 -> 57x5) 
+    # Но только если это явно размеры (не в середине длинного числа)
+    result = _NUMNUM_RE.sub(r'\1x\2', result)
+    
+    # 3. Дополнительные варианты размеров
+    # "Ду57/5" или "57/5" тоже размеры 
+    result = _SLASH_RE.sub(r'\1x\2', result)
+    
+    return result
+
+
+def normalize_product_name(name: str) -> str:
+    """Название товара для поиска: нижний регистр + нормализованные размеры"""
+    return normalize_dimensions((name or '').lower())
+
+
+def extract_dimensions(normalized: str) -> List[str]:
+    """Размеры из уже нормализованной строки: '... 57x5 ... 89x6' -> ['57x5', '89x6']"""
+    return _DIM_RE.findall(normalized or '')
+
+
+def clear_normalization_caches():
+    """Сбрасывает кэши нормализации текущего процесса (например, после массовой загрузки прайсов)"""
+    normalize_dimensions.cache_clear()
@@ -1,24 +1,34 @@
 import re
 import json
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, NamedTuple, Tuple
 import logging
 import httpx
 import time
-from langchain_openai import ChatOpenAI
+import asyncio
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain.chains import LLMChain
 from langchain.prompts import PromptTemplate
 import os
+import hashlib
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 print("HTTP_PROXY:", os.environ.get("HTTP_PROXY"))
 print("HTTPS_PROXY:", os.environ.get("HTTPS_PROXY"))
-from django.db.models import Q
+from django.db import connection
+from django.db.models import Q, Count, Max
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 import operator
-from functools import reduce
+from functools import reduce, lru_cache
 import pandas as pd
-import statistics  # Для вычисления статистики релевантности
+import numpy as np
 
-from .cache import QueryCache
+from .cache import QueryCache, SemanticCache
 from logger import setup_logger
-from .models import Product
+from .models import Product, products_bulk_changed
+from .normalization import normalize_dimensions, normalize_product_name, clear_normalization_caches
+from .keywords import keyword_finder, keyword_matcher
 
 # Отключаем DEBUG логи от OpenAI и httpx чтобы не засорять вывод
 logging.getLogger("openai").setLevel(logging.WARNING)
@@ -27,50 +37,558 @@ logging.getLogger("httpcore").setLevel(logging.WARNING)
 
 logger = setup_logger()
 
+# ---- ПРЕДКОМПИЛИРОВАННЫЕ РЕГУЛЯРНЫЕ ВЫРАЖЕНИЯ ----
+# Используются на каждый товар при скоринге, поэтому компилируем один раз при импорте
+# Каждое число строки с необязательной единицей "шт"/"штук"/"компл" – количество находится за один проход
+_QTY_RE = re.compile(r'(\d+)(\s*(?:шт|штук|компл)\b)?', re.IGNORECASE)
+_NUMBER_RE = re.compile(r'\d+')
+_QTY_STRIP_RE = re.compile(r'\d+\s*(?:шт|штук|компл)\b', re.IGNORECASE)
+_TAIL_NUM_RE = re.compile(r'\b\d+\s*$')
+_TAIL_SPACED_NUM_RE = re.compile(r'\s+\d+\s*$')
+_JSON_CODE_BLOCK_RE = re.compile(r"```json\s*([\s\S]*?)\s*```", re.IGNORECASE)
+# Разбор строк прайс-листа (extract_products_from_table)
+_HAS_DIGIT_RE = re.compile(r'\d')
+_NON_DIGIT_RE = re.compile(r'[^0-9]')
+_PHONE_RE = re.compile(r'[\+\-\(\)\s]*[\d\-\(\)\s]{7,}')
+_NUM_ONLY_RE = re.compile(r'^[\d\s\-\.\,\(\)]+$')
+# Фильтры мусора в названиях: по одной альтернации на группу вместо any(k in name) по спискам.
+# Границы слов не ставим – как и раньше, ищем подстроки в названии в нижнем регистре
+_HEADER_JUNK_RE = re.compile(r'наимен|товар|цена|назв|артикул|код|остаток|количество|сумма|стоим')
+_PHONE_HINT_RE = re.compile(r'тел|факс')
+_ADDR_JUNK_RE = re.compile(r'ул\.|пр\.|д\.|кв\.|офис|этаж')
+_PHRASE_JUNK_RE = re.compile(r'итого|всего|сумма|подпись|печать|директор|менеджер|контакты|реквизиты')
+# Признаки запроса, которому нужен LLM для извлечения ключевых слов: цифры, ГОСТ/ДУ/РУ, пунктуация
+_LLM_NEEDED_RE = re.compile(r'\d|\bгост|\bду\b|\bру\b|[^\w\s-]', re.IGNORECASE)
+_WORD_RE = re.compile(r'\b\w{2,}\b')
+_HAS_DIM_RE = re.compile(r'\d+[x*х]\d+', re.IGNORECASE)
+_DIM_RE = re.compile(r'\d+x\d+', re.IGNORECASE)
+
+
+class _PriceCharFilter(dict):
+    """
+    Таблица для str.translate: оставляет только [0-9,.], запятую сразу переводит в точку.
+    Любой другой символ (валюта, пробелы, NBSP, кириллица) удаляется; решения кэшируются в самом dict.
+    """
+    def __missing__(self, codepoint):
+        self[codepoint] = None
+        return None
+
+
+_PRICE_TRANS = _PriceCharFilter({ord(c): ord(c) for c in '0123456789.'})
+_PRICE_TRANS[ord(',')] = ord('.')
+
+# Важные ключевые слова (типы товаров, характеристики)
+_IMPORTANT_PATTERNS = [
+    'редуктор', 'задвижка', 'фланец', 'отвод', 'переход', 'тройник',
+    'заглушка', 'клапан', 'кран', 'муфта', 'патрубок',
+    r'ду\s*\d+', r'ру\s*\d+', r'гост\s*\d+', r'ст\.\d+', r'тип\s*[а-я]',
+]
+# Одна альтернация вместо цикла по шаблонам
+_IMPORTANT_RE = re.compile('|'.join(_IMPORTANT_PATTERNS), re.IGNORECASE)
+
+
+def _is_important_keyword(keyword: str) -> bool:
+    """Проверяет, является ли ключевое слово важным (тип товара или характеристика)"""
+    return _IMPORTANT_RE.search(keyword) is not None
+
+@lru_cache(maxsize=256)
+def _keyword_plan(keywords: tuple) -> tuple:
+    """
+    Предрасчёт по ключевым словам запроса (один раз на запрос, а не на каждый товар):
+    (ключевые слова в нижнем регистре, маска важных слов, маска слов длиной >= 4)
+    """
+    keywords_lower = tuple(kw.lower().strip() for kw in keywords if kw and len(kw.strip()) >= 2)
+    important_mask = 0
+    long_mask = 0
+    for i, keyword in enumerate(keywords_lower):
+        if _is_important_keyword(keyword):
+            important_mask |= 1 << i
+        if len(keyword) >= 4:
+            long_mask |= 1 << i
+    return keywords_lower, important_mask, long_mask
+
+# Numba-ядро поиска вхождений ключевых слов по плоскому UTF-8 буферу названий (numba – в requirements.txt).
+# Без неё (платформа без сборки llvmlite) используется векторизация на pandas.
+try:
+    from numba import njit, prange
+
+    @njit(parallel=True, cache=True)
+    def _numba_keyword_masks(name_buf, offsets, kw_buf, kw_offsets):
+        n = offsets.shape[0] - 1
+        k = kw_offsets.shape[0] - 1
+        masks = np.zeros(n, dtype=np.int64)
+        for i in prange(n):
+            start = offsets[i]
+            end = offsets[i + 1]
+            mask = 0
+            for j in range(k):
+                kw_start = kw_offsets[j]
+                kw_len = kw_offsets[j + 1] - kw_start
+                for pos in range(start, end - kw_len + 1):
+                    matched = True
+                    for t in range(kw_len):
+                        if name_buf[pos + t] != kw_buf[kw_start + t]:
+                            matched = False
+                            break
+                    if matched:
+                        mask |= np.int64(1) << j
+                        break
+            masks[i] = mask
+        return masks
+
+    @njit(parallel=True, cache=True)
+    def _numba_parse_prices(buf, offsets):
+        """
+        Цены из ячеек прайса: все байты кроме [0-9,.] отбрасываются, запятая = точка.
+        Нераспознанное (нет цифр, больше одной точки) -> NaN – как float() после зачистки регуляркой.
+        """
+        n = offsets.shape[0] - 1
+        prices = np.empty(n, dtype=np.float64)
+        for i in prange(n):
+            mantissa = 0.0
+            frac_digits = 0
+            dots = 0
+            digits = 0
+            for pos in range(offsets[i], offsets[i + 1]):
+                b = buf[pos]
+                if 48 <= b <= 57:
+                    mantissa = mantissa * 10.0 + (b - 48)
+                    digits += 1
+                    if dots:
+                        frac_digits += 1
+                elif b == 44 or b == 46:  # ',' или '.'
+                    dots += 1
+            if digits == 0 or dots > 1:
+                prices[i] = np.nan
+            else:
+                # Одно деление на точную степень десяти – тот же результат, что float() строки
+                prices[i] = mantissa / 10.0 ** frac_digits
+        return prices
+
+    _NUMBA_AVAILABLE = True
+except ImportError:
+    _NUMBA_AVAILABLE = False
+
+
+def _flatten_utf8(strings) -> tuple:
+    """Склеивает строки в один UTF-8 буфер (np.uint8) + массив смещений длиной N+1"""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    buf = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return buf, offsets
+
+@lru_cache(maxsize=256)
+def _query_features(query_lower: str) -> 'QueryFeatures':
+    """Признаки запроса, не зависящие от товара – считаются один раз на запрос"""
+    dimensions = _dimension_set(query_lower)
+    critical = _critical_buckets(query_lower)
+    # Верхняя граница бонусов за типы товаров, размеры и критичные характеристики (см. _calculate_relevance_score)
+    max_tail_bonus = (
+        30 * sum(1 for synonyms in _SPECIAL_BONUSES.values() if any(syn in query_lower for syn in synonyms))
+        + 150 * len(dimensions)
+        + sum(_CRITICAL_BONUSES[name] * len(values) for name, values in critical.items())
+    )
+    return QueryFeatures(
+        words=frozenset(_WORD_RE.findall(query_lower)),
+        has_dimensions=bool(_HAS_DIM_RE.search(query_lower)),
+        dimensions=dimensions,
+        critical=critical,
+        max_tail_bonus=max_tail_bonus,
+        n_tokens=len(query_lower.split()),
+    )
+
+
+def _dimension_set(text: str) -> frozenset:
+    """Размеры в нормализованном виде (57x5); строки интернируются – одинаковые размеры
+    запроса и товара сравниваются по ссылке при пересечении множеств"""
+    return frozenset(map(sys.intern, _DIM_RE.findall(normalize_dimensions(text))))
+
+
+class QueryFeatures(NamedTuple):
+    """Признаки запроса для скоринга (см. _query_features)"""
+    words: frozenset       # слова от 2 букв
+    has_dimensions: bool   # есть ли размеры вида 57x5 / 57*5 / 57х5
+    dimensions: frozenset  # размеры в нормализованном виде
+    critical: dict         # критичные характеристики {ду: frozenset({'300'}), ...}
+    max_tail_bonus: int    # максимум бонусов за типы товаров, размеры и критичные характеристики
+    n_tokens: int          # число слов через пробел
+
+
+class ProductFeatures(NamedTuple):
+    """Признаки товара, не зависящие от запроса – считаются один раз на название"""
+    words: frozenset       # слова от 2 букв
+    dimensions: frozenset  # размеры в нормализованном виде (57x5)
+    critical: dict         # критичные характеристики {ду: frozenset({'300'}), ...}
+    n_tokens: int          # число слов через пробел
+
+
+@lru_cache(maxsize=50_000)
+def _product_features(product_name: str, dimensions: Optional[tuple] = None) -> ProductFeatures:
+    """
+    product_name – название в нижнем регистре без крайних пробелов.
+    dimensions – размеры, сохранённые в Product.dimensions при записи; если не переданы, считаются здесь.
+    """
+    return ProductFeatures(
+        words=frozenset(_WORD_RE.findall(product_name)),
+        dimensions=(
+            frozenset(map(sys.intern, dimensions)) if dimensions is not None else _dimension_set(product_name)
+        ),
+        critical=_critical_buckets(product_name),
+        n_tokens=len(product_name.split()),
+    )
+
+# Минимальный из адаптивных порогов релевантности в process_query: товары ниже него не попадут в выдачу
+_MIN_RELEVANCE_THRESHOLD = 15
+
+# Частые типы товаров: бонус 30, если тип (или синоним) есть в запросе и тип есть в названии
+_SPECIAL_BONUSES = {
+    'редуктор': ['редуктор'],
+    'задвижка': ['задвижка', 'клапан'],
+    'фланец': ['фланец', 'фланцы'],
+    'отвод': ['отвод', 'отводы'],
+    'переход': ['переход', 'переходы'],
+    'тройник': ['тройник', 'тройники'],
+    'заглушка': ['заглушка', 'заглушки']
+}
+
+# КРИТИЧНЫЕ характеристики (ДУ, РУ, тип, ГОСТ, сталь) и бонусы за их совпадение
+_CRITICAL_BONUSES = {
+    'du': 150,     # ДУ - важная характеристика
+    'ru': 100,     # РУ - важная характеристика
+    'tip': 80,     # Тип - важная характеристика
+    'gost': 120,   # ГОСТ - стандарт
+    'st': 80,      # Сталь - материал
+    'isp': 60,     # Исполнение
+    '09г2с': 100,  # Конкретная сталь
+    'ст20': 80,    # Конкретная сталь
+    'ст45': 80,    # Конкретная сталь
+}
+# Все характеристики с числовым/буквенным значением – одна альтернация, один проход finditer.
+# Альтернативы начинаются с разных букв, поэтому не конкурируют за одну позицию; буквенные значения
+# (тип/исп) берутся lookahead-ом, чтобы не «съедать» начало следующей характеристики.
+_CRITICAL_ALT_RE = re.compile(
+    r'гост\s*(?P<gost>\d+(?:[-\s]*\d+)?)'
+    r'|ду\s*(?P<du>\d+)'
+    r'|ру\s*(?P<ru>\d+)'
+    r'|тип\s*(?=(?P<tip>[абвг]))'
+    r'|ст\.?\s*(?P<st>\d+)'
+    r'|исп\.?\s*(?=(?P<isp>[а-я]))',
+    re.IGNORECASE
+)
+# Марки стали без значения – достаточно проверки подстроки
+_CRITICAL_LITERALS = ('09г2с', 'ст20', 'ст45')
+
+
+def _critical_buckets(text: str) -> dict:
+    """{характеристика: frozenset значений} для критичных характеристик текста (в нижнем регистре)"""
+    buckets = {}
+    for match in _CRITICAL_ALT_RE.finditer(text):
+        name = match.lastgroup
+        value = match.group(name)
+        buckets.setdefault(name, set()).add(sys.intern(value))
+        if name == 'gost':
+            # "гост 17375" содержит и "ст 17375" – отдельный шаблон стали тоже находил это число
+            buckets.setdefault('st', set()).add(sys.intern(_NUMBER_RE.match(value).group(0)))
+    for literal in _CRITICAL_LITERALS:
+        if literal in text:
+            buckets[literal] = {literal}
+    # Результат кэшируется вместе с признаками – замораживаем, чтобы его нельзя было изменить
+    return {name: frozenset(values) for name, values in buckets.items()}
+
+def first_json_block(text: str, open_char: str = '[', close_char: str = ']') -> Optional[str]:
+    """
+    Возвращает первый сбалансированный JSON-блок ('[...]' или '{...}') из ответа LLM.
+    Один проход слева направо с учётом вложенности и строк – O(n), без бэктрекинга регулярки.
+    """
+    depth = 0
+    start = -1
+    in_string = False
+    escaped = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"' and start >= 0:
+            in_string = True
+        elif ch == open_char:
+            if start < 0:
+                start = i
+            depth += 1
+        elif ch == close_char and start >= 0:
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
+
+def first_json_array(text: str) -> Optional[str]:
+    """Первый сбалансированный JSON-массив '[...]' из текста"""
+    return first_json_block(text, '[', ']')
+
+@lru_cache(maxsize=100_000)
 def extract_quantity(text: Optional[str]) -> Optional[int]:
     """Извлекает количество из текста (например, '5 штук')"""
     if not text:
         return None
-    # Ищем число, за которым опционально идет пробел и "шт"/"штук"/"компл"
-    match = re.search(r'(\d+)\s*(?:шт|штук|компл)\b', text, re.IGNORECASE)
-    if match:
-        try:
+    # Первое число, за которым опционально идет пробел и "шт"/"штук"/"компл";
+    # если такого нет – последнее число в строке. Одним проходом finditer, без второго скана
+    last_number = None
+    for match in _QTY_RE.finditer(text):
+        if match.group(2):
             return int(match.group(1))
-        except ValueError:
-            return None
-    # Если не нашли с "шт", ищем просто последнее число в строке
-    numbers = re.findall(r'\d+', text)
-    if numbers:
-        try:
-            return int(numbers[-1])
-        except ValueError:
-            return None
-    return None
+        last_number = match.group(1)
+    return int(last_number) if last_number is not None else None
 
-def normalize_dimensions(text: str) -> str:
+@lru_cache(maxsize=8192)
+def _split_item_line(line: str) -> Tuple[str, Optional[int]]:
     """
-    Приводит размеры к единому виду:
-    '57х5', '57 х 5', '57*5', '57 x 5', '57X5', '57 5' -> '57x5'
-    ВАЖНО: нормализует ВСЕ возможные варианты написания размеров
+    Строка запроса -> (название товара без количества, количество).
+    Одни и те же позиции повторяются в запросах пачки – мемоизируем вместе с regex-зачисткой.
     """
-    if not text:
-        return text
-    
-    result = text
-    
-    # 1. Заменяем все варианты разделителей размеров на 'x'
-    # Кириллическая 'х', латинская 'x', '*', любые пробелы вокруг
-    result = re.sub(r'(\d+)\s*[xх*×X]\s*(\d+)', r'\1x\2', result, flags=re.IGNORECASE)
-    
-    # 2. КРИТИЧНО: "число пробел число" тоже размер (57 5 -> 57x5) 
-    # Но только если это явно размеры (не в середине длинного числа)
-    result = re.sub(r'(\d+)\s+(\d+)(?=\s|$|[^\d.])', r'\1x\2', result)
-    
-    # 3. Дополнительные варианты размеров
-    # "Ду57/5" или "57/5" тоже размеры 
-    result = re.sub(r'(\d+)/(\d+)', r'\1x\2', result)
-    
-    return result
+    quantity = extract_quantity(line)
+    # Убираем количество из названия товара
+    item_name = _QTY_STRIP_RE.sub('', line).strip()
+    item_name = _TAIL_SPACED_NUM_RE.sub('', item_name).strip()  # Убираем число в конце
+    return item_name, quantity
+
+def clear_text_caches():
+    """
+    Сбрасывает lru_cache нормализации/извлечения количества и признаков запросов в текущем процессе.
+    Вызывается views после загрузки прайс-листа (названия старых товаров поставщика больше не встретятся).
+    Кэши других воркеров не затрагиваются: в них только результаты чистых функций от текста,
+    устареть они не могут, а объем ограничен maxsize.
+    """
+    clear_normalization_caches()
+    extract_quantity.cache_clear()
+    _split_item_line.cache_clear()
+    _keyword_plan.cache_clear()
+    _query_features.cache_clear()
+    _product_features.cache_clear()
+
+# ---- ОБЩИЙ HTTP-КЛИЕНТ ДЛЯ LLM ----
+# Один пул соединений на процесс для каждой настройки прокси: keep-alive и TLS-сессии переиспользуются
+# всеми экземплярами QueryProcessor/ChatOpenAI. HTTP/2 включается, если установлен пакет h2 (httpx[http2]).
+_HTTPX_LIMITS = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+_HTTPX_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# {замороженные proxies: клиент}
+_HTTPX_CLIENTS: Dict[Optional[frozenset], httpx.Client] = {}
+_HTTPX_CLIENTS_LOCK = threading.Lock()
+
+try:
+    import h2  # noqa: F401
+    _HTTP2_AVAILABLE = True
+except ImportError:
+    _HTTP2_AVAILABLE = False
+
+
+def _http_client_kwargs(proxies: Optional[dict] = None) -> dict:
+    kwargs = {"http2": _HTTP2_AVAILABLE, "limits": _HTTPX_LIMITS, "timeout": _HTTPX_TIMEOUT}
+    if proxies:
+        kwargs["proxies"] = proxies
+    return kwargs
+
+
+def _get_http_client(proxies: Optional[dict] = None) -> httpx.Client:
+    """Возвращает общий для процесса httpx.Client для данных proxies (создаётся при первом обращении)"""
+    key = frozenset(proxies.items()) if proxies else None
+    client = _HTTPX_CLIENTS.get(key)
+    if client is None:
+        with _HTTPX_CLIENTS_LOCK:
+            client = _HTTPX_CLIENTS.get(key)
+            if client is None:
+                client = _HTTPX_CLIENTS[key] = httpx.Client(**_http_client_kwargs(proxies))
+    return client
+
+
+# Async-вызовы LLM идут через один долгоживущий event loop в фоновом потоке: с asyncio.run
+# на каждую пачку вместе с loop пересоздавался AsyncClient, и TLS-рукопожатия повторялись
+_ASYNC_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_ASYNC_LOOP_LOCK = threading.Lock()
+
+
+def _get_async_loop() -> asyncio.AbstractEventLoop:
+    global _ASYNC_LOOP
+    if _ASYNC_LOOP is None:
+        with _ASYNC_LOOP_LOCK:
+            if _ASYNC_LOOP is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-async-loop", daemon=True).start()
+                _ASYNC_LOOP = loop
+    return _ASYNC_LOOP
+
+
+def _run_async(coro):
+    """Выполняет корутину в фоновом loop и ждёт результат (из любого потока)"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_async_loop()).result()
+
+
+# ---- КЭШ НОРМАЛИЗОВАННЫХ НАЗВАНИЙ ТОВАРОВ ----
+# ({product_id: normalize_dimensions(name.lower())}, состояние каталога) – нормализация выполняется
+# один раз за время жизни товара, а не на каждый поисковый запрос. Состояние каталога
+# (кол-во товаров, max(updated_at)) на момент сборки входит в ключ кэша поиска, поэтому
+# индекс и состояние публикуются вместе одной ссылкой.
+_NAME_INDEX: Tuple[dict, Optional[tuple]] = ({}, None)
+# Версия каталога: увеличивается сигналами Product (post_save/post_delete и products_bulk_changed
+# для bulk_create/delete_fast). Индекс перестраивается только когда она отличается от версии сборки.
+_NAME_INDEX_VERSION = 0
+_NAME_INDEX_BUILT_VERSION = -1
+# Сигналы видны только своему процессу: прайс, загруженный другим воркером, замечаем
+# по состоянию каталога в БД, но проверяем его не чаще раза в NAME_INDEX_RECHECK_SECONDS
+NAME_INDEX_RECHECK_SECONDS = 30
+_NAME_INDEX_CHECKED_AT = 0.0
+# Индекс читают потоки process_queries: новый словарь собирается отдельно и публикуется
+# одной заменой ссылки, опубликованный словарь не изменяется
+_NAME_INDEX_LOCK = threading.Lock()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(products_bulk_changed, sender=Product)
+def _name_index_invalidate(sender, **kwargs):
+    global _NAME_INDEX_VERSION
+    with _NAME_INDEX_LOCK:
+        _NAME_INDEX_VERSION += 1
+
+
+def _name_index_is_fresh() -> bool:
+    return (_NAME_INDEX_BUILT_VERSION == _NAME_INDEX_VERSION
+            and time.monotonic() - _NAME_INDEX_CHECKED_AT < NAME_INDEX_RECHECK_SECONDS)
+
+
+def get_name_index() -> Tuple[dict, Optional[tuple]]:
+    """
+    Возвращает актуальные (индекс {id: нормализованное название}, состояние каталога),
+    при необходимости перестраивает индекс. Пара берется под блокировкой одним значением:
+    результат поиска по индексу кэшируется под ключом именно его состояния.
+    """
+    global _NAME_INDEX, _NAME_INDEX_BUILT_VERSION, _NAME_INDEX_CHECKED_AT
+    with _NAME_INDEX_LOCK:
+        if _name_index_is_fresh():
+            return _NAME_INDEX
+        version = _NAME_INDEX_VERSION
+        state = Product.objects.aggregate(cnt=Count('id'), last=Max('updated_at'))
+        state = (state['cnt'], state['last'])
+        if version != _NAME_INDEX_BUILT_VERSION or state != _NAME_INDEX[1]:
+            # Нормализованное название хранится в БД (Product.name_norm); пересчитываем только незаполненные
+            new_index = {
+                pk: name_norm or normalize_product_name(name)
+                for pk, name, name_norm in Product.objects.values_list('id', 'name', 'name_norm').iterator(chunk_size=2000)
+            }
+            _NAME_INDEX = (new_index, state)
+            logger.info(f"Индекс названий товаров перестроен: {len(new_index)} записей (версия {version})")
+        _NAME_INDEX_BUILT_VERSION = version
+        _NAME_INDEX_CHECKED_AT = time.monotonic()
+        return _NAME_INDEX
+
+
+# ---- КЛЮЧЕВЫЕ СЛОВА ЗАГОЛОВКОВ ДЛЯ FALLBACK-МАППИНГА КОЛОНОК ----
+_HEADER_KEYWORDS = {
+    "name": ['наимен', 'товар', 'продукт', 'описан', 'позиц', 'name', 'product', 'item', 'description'],
+    "price": ['цена', 'стоим', 'прайс', 'price', 'cost', 'value'],
+    "stock": ['кол-во', 'остат', 'наличие', 'склад', 'баланс', 'stock', 'quantity', 'qty', 'amount', 'balance', 'available'],
+    "article": ['артикул', 'код', 'sku', 'id', 'номер', 'article', 'code']
+}
+
+# Все ключевые слова заголовка ищутся одним проходом (Ахо-Корасик или одна альтернация re)
+_HEADER_KW_TO_STD = {kw: std for std, kws in _HEADER_KEYWORDS.items() for kw in kws}
+_find_header_keywords = keyword_finder(_HEADER_KW_TO_STD)
+
+# Признаки цены (валюта, десятичная запятая) и остатка в ячейке – для определения перепутанных колонок
+_has_price_marker = keyword_matcher([',', '₽', 'руб', '$', 'eur', '€', 'тг'])
+_has_stock_marker = keyword_matcher(['нет', 'под заказ', 'ожид', 'отсут', 'в наличии', 'есть'])
+# Заголовки и итоги в многострочном запросе (простой фильтр split_query_into_items)
+_is_junk_line = keyword_matcher(['№', 'наименование', 'количество', 'цена', 'стоимость', 'итог'])
+
+
+def _scan_header_keywords(header_lower: str) -> list:
+    """Возвращает [(стандартное_поле, ключевое_слово)] для всех вхождений ключевых слов в заголовок (как подстрок)."""
+    return [(_HEADER_KW_TO_STD[kw], kw) for _, kw in _find_header_keywords(header_lower)]
+
+# ---- СТАТИЧНЫЕ ЧАСТИ ПРОМПТОВ ----
+# Неизменяемый текст (правила, примеры) стоит в начале и побайтно совпадает между вызовами,
+# чтобы работало кэширование префикса промпта у OpenAI; переменная часть добавляется строго в конец.
+_KEYWORD_PROMPT_PREFIX = """ЗАДАЧА: Извлечь ключевые слова для поиска товара.
+
+ПРАВИЛА:
+1. Извлекай характеристики ТОЧНО как в тексте: "тип В", "ст.20", "ГОСТ 17375-2001", "108*6", "ДУ400".
+2. НЕ включай количество (штук, шт, компл) и числа количества.
+3. НЕ включай слова: нужен, для, под, и, с, еще, в, количестве.
+4. ВСЕГДА возвращай JSON-массив, даже для простых слов.
+
+ПРИМЕРЫ:
+"редуктор" → ["редуктор"]
+"фланец" → ["фланец"] 
+"отвод 57х5" → ["отвод", "57х5"]
+"задвижка ДУ300" → ["задвижка", "ДУ300"]
+"Отвод ГОСТ17375-2001 108*6 ст.20 90гр. 2000 штук" → ["Отвод", "ГОСТ17375-2001", "108*6", "ст.20", "90гр"]
+"""
+
+# Несколько запросов в одном промпте (пронумерованы) – ответ массивом массивов в том же порядке
+_KEYWORD_BATCH_PROMPT_SUFFIX = """
+Ниже несколько пронумерованных запросов. Для КАЖДОГО запроса извлеки ключевые слова по тем же правилам.
+Верни ТОЛЬКО JSON-массив JSON-массивов: по одному массиву на запрос, в том же порядке и того же количества.
+"""
+
+_SPLIT_PROMPT_PREFIX = """ЗАДАЧА: Разделить общий запрос клиента на отдельные товарные позиции.
+ПРАВИЛА:
+1. Для КАЖДОЙ позиции извлечь описание товара (item_query) и запрошенное количество (quantity).
+2. Игнорировать общие фразы, приветствия, предлоги.
+3. Если количество не указано явно, использовать null или 1.
+4. Формат ответа - ТОЛЬКО валидный JSON-массив объектов. Каждый объект должен иметь ключи "item_query" (строка) и "quantity" (число или null).
+
+ПРИМЕРЫ:
+Запрос: "Добрый день! Нужен редуктор тип В 5 штук и еще задвижка ДУ500 10 шт"
+Ответ: [{"item_query": "редуктор тип В", "quantity": 5}, {"item_query": "задвижка ДУ500", "quantity": 10}]
+Запрос: "отводы стальные 90 градусов гост 17375 10 штук"
+Ответ: [{"item_query": "отводы стальные 90 градусов гост 17375", "quantity": 10}]
+Запрос: "фланец плоский ст.20"
+Ответ: [{"item_query": "фланец плоский ст.20", "quantity": null}]
+"""
+
+# Стандартные поля прайс-листа, которые ищем (ключ: описание для LLM)
+_COLUMN_MAPPING_FIELDS = {
+    "name": "Наименование товара (полное название, марка, тип, ГОСТ, характеристики)",
+    "price": "Цена (розничная, оптовая, с НДС или без - любая цена)",
+    "stock": "Остаток на складе (количество, наличие, 'в наличии', 'под заказ')",
+    "article": "Артикул (код товара, SKU, номенклатурный номер)",
+    # "unit": "Единица измерения (шт, кг, м, т)"
+}
+
+_COLUMN_MAPPING_PROMPT_PREFIX = """ЗАДАЧА: Проанализируй фрагмент прайс-листа (заголовки и первые строки с данными) и определи, какие колонки соответствуют нужным нам стандартным полям.
+Стандартные поля, которые мы ищем:
+{field_descriptions}
+
+ТРЕБОВАНИЯ К ОТВЕТУ:
+1. Верни ТОЛЬКО валидный JSON-объект.
+2. Ключи JSON-объекта - это наши стандартные имена полей ({field_names}).
+3. Значения JSON-объекта - это ТОЧНЫЕ названия колонок из ФРАГМЕНТА ПРАЙС-ЛИСТА.
+4. Если для стандартного поля не нашлось подходящей колонки, используй значение null (не строку "null").
+5. Если для одного стандартного поля подходят НЕСКОЛЬКО колонок, выбери САМУЮ ПОДХОДЯЩУЮ (например, для 'price' выбери розничную цену, если есть и оптовая).
+6. НЕ ПРИДУМЫВАЙ колонки, которых нет в заголовках.
+
+ПРИМЕР ОТВЕТА:
+{{
+  "name": "Наименование товара",
+  "price": "Цена розн.",
+  "stock": "Остаток",
+  "article": "Артикул"
+}}
+ИЛИ (если что-то не найдено):
+{{
+  "name": "Номенклатура",
+  "price": "Стоимость",
+  "stock": null,
+  "article": "Код"
+}}
+""".format(
+    field_descriptions="\n".join(f"- {k}: {v}" for k, v in _COLUMN_MAPPING_FIELDS.items()),
+    field_names=", ".join(_COLUMN_MAPPING_FIELDS.keys()),
+)
 
 class QueryProcessor:
     def __init__(self, query_cache: QueryCache):
@@ -82,7 +600,28 @@ class QueryProcessor:
         self.query_cache = query_cache
         # Используем gpt-4o для максимальной точности анализа сложных структур
         self.llm_model_name = "gpt-4o"
+        # Для простой задачи извлечения ключевых слов хватает дешёвой и быстрой модели,
+        # при двух подряд неразборчивых ответах эскалируем на основную
+        self.keyword_model_name = "gpt-4o-mini"
+        self.llm_cheap = None
+        # Ограничение параллельных LLM-запросов (~500 запросов в минуту)
+        self.llm_max_concurrency = 8
+        # Потоки для поиска товаров по позициям многострочного запроса
+        self.search_max_workers = 16
+        # Сколько запросов упаковывается в один промпт извлечения ключевых слов
+        self.llm_batch_size = 8
+        # Счётчик запросов, обработанных без LLM (быстрый путь для простых запросов)
+        self.llm_skipped_total = 0
+        self.api_key = ""
+        self.http_client_args = {}
+        # Async-модели для пачек ключевых слов, создаются лениво в фоновом loop
+        self._async_llms = None
+        self.embeddings = None
         self._initialize_llm()
+        # Семантический кэш ответов LLM (похожие запросы/заголовки переиспользуют прошлый ответ)
+        embed_fn = self.embeddings.embed_query if self.embeddings is not None else None
+        self.keyword_cache = SemanticCache(embed_fn, query_cache, namespace="keywords")
+        self.column_mapping_cache = SemanticCache(embed_fn, query_cache, namespace="column_mapping")
     
     def _initialize_llm(self):
         """Initialize LangChain with OpenAI."""
@@ -95,15 +634,16 @@ class QueryProcessor:
                 masked = api_key[:4] + "***" + api_key[-4:]
                 logger.info(f"OPENAI_API_KEY найден (длина={len(api_key)}): {masked}")
                 
+            self.api_key = api_key
             proxy_url = os.environ.get("HTTP_PROXY") or os.environ.get("HTTPS_PROXY")
-            http_client_args = {}
+            proxies = None
             if proxy_url:
                 logger.info(f"Using proxy: {proxy_url}")
                 proxies = {"http://": proxy_url, "https://": proxy_url}
-                http_client_args['proxies'] = proxies
             
-            # Создаем httpx.Client с настройками прокси, если они есть
-            http_client = httpx.Client(**http_client_args)
+            # Общий для процесса httpx.Client с настройками прокси и пулом соединений
+            http_client = _get_http_client(proxies)
+            self.http_client_args = _http_client_kwargs(proxies)
             
             # Передаем http_client в ChatOpenAI
             self.llm = ChatOpenAI(
@@ -114,29 +654,35 @@ class QueryProcessor:
             )
             logger.info(f"LLM ({self.llm_model_name}) initialized successfully.")
             
+            try:
+                self.llm_cheap = ChatOpenAI(
+                    model_name=self.keyword_model_name,
+                    openai_api_key=api_key,
+                    temperature=0,
+                    http_client=http_client
+                )
+                logger.info(f"Keyword LLM ({self.keyword_model_name}) initialized successfully.")
+            except Exception as cheap_err:
+                logger.warning(f"Keyword LLM unavailable, using {self.llm_model_name}: {cheap_err}")
+                self.llm_cheap = None
+            
+            # Эмбеддинги для семантического кэша (дешевле и быстрее полного LLM-вызова)
+            try:
+                self.embeddings = OpenAIEmbeddings(
+                    model="text-embedding-3-small",
+                    openai_api_key=api_key,
+                    http_client=http_client
+                )
+            except Exception as emb_err:
+                logger.warning(f"Embeddings unavailable, semantic cache works in exact mode: {emb_err}")
+                self.embeddings = None
+            
             # Оставляем split_chain и prompt для разделения запросов
             # (хотя возможно стоит переделать на новые RunnableSequence)
             self.split_prompt = PromptTemplate(
                 input_variables=["query"],
-                template="""
-                ЗАДАЧА: Разделить общий запрос клиента на отдельные товарные позиции.
-                ПРАВИЛА:
-                1. Для КАЖДОЙ позиции извлечь описание товара (item_query) и запрошенное количество (quantity).
-                2. Игнорировать общие фразы, приветствия, предлоги.
-                3. Если количество не указано явно, использовать null или 1.
-                4. Формат ответа - ТОЛЬКО валидный JSON-массив объектов. Каждый объект должен иметь ключи "item_query" (строка) и "quantity" (число или null).
-                
-                ПРИМЕРЫ:
-                Запрос: "Добрый день! Нужен редуктор тип В 5 штук и еще задвижка ДУ500 10 шт"
-                Ответ: [{{"item_query": "редуктор тип В", "quantity": 5}}, {{"item_query": "задвижка ДУ500", "quantity": 10}}]
-                Запрос: "отводы стальные 90 градусов гост 17375 10 штук"
-                Ответ: [{{"item_query": "отводы стальные 90 градусов гост 17375", "quantity": 10}}]
-                Запрос: "фланец плоский ст.20"
-                Ответ: [{{"item_query": "фланец плоский ст.20", "quantity": null}}]
-                
-                Запрос: {{query}}
-                Ответ:
-                """ # Используем двойные фигурные скобки для literal braces
+                # Статичная часть экранируется для PromptTemplate, переменная – строго в конце
+                template=_SPLIT_PROMPT_PREFIX.replace("{", "{{").replace("}", "}}") + "\nЗапрос: {query}\nОтвет:"
             )
             # TODO: Переделать LLMChain на новый синтаксис prompt | llm
             self.split_chain = LLMChain(llm=self.llm, prompt=self.split_prompt)
@@ -159,24 +705,25 @@ class QueryProcessor:
             "article": None
         }
         
-        header_keywords = {
-            "name": ['наимен', 'товар', 'продукт', 'описан', 'позиц', 'name', 'product', 'item', 'description'],
-            "price": ['цена', 'стоим', 'прайс', 'price', 'cost', 'value'],
-            "stock": ['кол-во', 'остат', 'наличие', 'склад', 'баланс', 'stock', 'quantity', 'qty', 'amount', 'balance', 'available'],
-            "article": ['артикул', 'код', 'sku', 'id', 'номер', 'article', 'code']
-        }
+        # Один проход автомата по каждому заголовку вместо вложенных циклов поле × заголовок × слово
+        header_hits = {}
+        for header in headers:
+            if header is not None and header not in header_hits:
+                header_lower = str(header).lower().strip()
+                header_hits[header] = (header_lower, _scan_header_keywords(header_lower))
         
         assigned_headers = set()
 
         # Сначала ищем точные совпадения или приоритетные слова
-        for standard_name, keywords in header_keywords.items():
+        for standard_name, keywords in _HEADER_KEYWORDS.items():
             best_match = None
             for header in headers:
                 if header is None or header in assigned_headers:
                     continue
-                header_lower = str(header).lower().strip()
-                # Ищем полное совпадение или слово целиком
-                if any(f'\b{kw}\b' in header_lower for kw in keywords) or header_lower in keywords:
+                header_lower, hits = header_hits[header]
+                matched = {kw for std, kw in hits if std == standard_name}
+                # Ищем вхождение ключевого слова (основы 'наимен', 'стоим', 'остат' – подстрокой)
+                if matched or header_lower in keywords:
                      # Простое совпадение по приоритетным словам
                      if standard_name == "price" and "цена" in header_lower:
                           best_match = header
@@ -187,7 +734,7 @@ class QueryProcessor:
                      if standard_name == "stock" and ("кол-во" in header_lower or "остат" in header_lower or "наличи" in header_lower):
                            best_match = header
                            break # Нашли количество/остаток/наличие
-                     if standard_name == "article" and ("артикул" in header_lower or "код" in header_lower or "\bsku\b" in header_lower):
+                     if standard_name == "article" and ("артикул" in header_lower or "код" in header_lower or "sku" in matched):
                            best_match = header
                            break # Нашли артикул/код/sku
                      # Если нет приоритетных, запоминаем первое совпадение
@@ -199,14 +746,13 @@ class QueryProcessor:
                 assigned_headers.add(best_match)
                 
         # Если что-то не нашли, пробуем найти по частичному совпадению (менее надежно)
-        for standard_name, keywords in header_keywords.items():
+        for standard_name in _HEADER_KEYWORDS:
              if mapping[standard_name] is None: # Ищем только для ненайденных
                  best_match = None
                  for header in headers:
                      if header is None or header in assigned_headers:
                          continue
-                     header_lower = str(header).lower().strip()
-                     if any(kw in header_lower for kw in keywords):
+                     if any(std == standard_name for std, _ in header_hits[header][1]):
                          best_match = header # Берем первое попавшееся не занятое
                          break
                  if best_match:
@@ -226,6 +772,16 @@ class QueryProcessor:
         Uses LLM or fallback keyword matching to determine the column mapping.
         Returns mapping dict or None if both methods fail.
         """
+        # --- Попытка 0: семантический кэш (прайс-листы с теми же/похожими заголовками) ---
+        cache_key = "\t".join(str(h).strip().lower() for h in header_row if h is not None)
+        cached_mapping, cache_vector = self.column_mapping_cache.get(cache_key)
+        if cached_mapping:
+            valid_headers = set(str(h) for h in header_row if h is not None)
+            if all(v is None or str(v) in valid_headers for v in cached_mapping.values()) \
+                    and cached_mapping.get("name") and cached_mapping.get("price"):
+                logger.info(f"Column mapping taken from cache: {cached_mapping}")
+                return dict(cached_mapping)
+
         # --- Попытка 1: LLM ---
         if self.llm:
             # Преобразуем данные в строку для промпта
@@ -233,51 +789,9 @@ class QueryProcessor:
             sample_rows_str = "\n".join(["\t".join(map(str, row)) for row in sample_rows])
             file_fragment = f"Headers:\n{header_str}\n\nSample data:\n{sample_rows_str}"
             
-            # Определяем стандартные поля, которые ищем
-            standard_fields = { # Ключ: Описание для LLM
-                "name": "Наименование товара (полное название, марка, тип, ГОСТ, характеристики)",
-                "price": "Цена (розничная, оптовая, с НДС или без - любая цена)",
-                "stock": "Остаток на складе (количество, наличие, 'в наличии', 'под заказ')",
-                "article": "Артикул (код товара, SKU, номенклатурный номер)",
-                 # Добавь сюда другие важные поля, если они есть
-                 # "unit": "Единица измерения (шт, кг, м, т)"
-            }
-            
-            field_descriptions = "\n".join([f"- {k}: {v}" for k, v in standard_fields.items()])
-            
-            prompt = f"""
-            ЗАДАЧА: Проанализируй фрагмент прайс-листа (заголовки и первые строки с данными) и определи, какие колонки соответствуют нужным нам стандартным полям.
-            Стандартные поля, которые мы ищем:
-            {field_descriptions}
-
-            ФРАГМЕНТ ПРАЙС-ЛИСТА:
-            {file_fragment}
-
-            ТРЕБОВАНИЯ К ОТВЕТУ:
-            1. Верни ТОЛЬКО валидный JSON-объект.
-            2. Ключи JSON-объекта - это наши стандартные имена полей ({', '.join(standard_fields.keys())}).
-            3. Значения JSON-объекта - это ТОЧНЫЕ названия колонок из ФРАГМЕНТА ПРАЙС-ЛИСТА.
-            4. Если для стандартного поля не нашлось подходящей колонки, используй значение null (не строку "null").
-            5. Если для одного стандартного поля подходят НЕСКОЛЬКО колонок, выбери САМУЮ ПОДХОДЯЩУЮ (например, для 'price' выбери розничную цену, если есть и оптовая).
-            6. НЕ ПРИДУМЫВАЙ колонки, которых нет в заголовках.
-
-            ПРИМЕР ОТВЕТА:
-            {{
-              "name": "Наименование товара",
-              "price": "Цена розн.",
-              "stock": "Остаток",
-              "article": "Артикул"
-            }}
-            ИЛИ (если что-то не найдено):
-            {{
-              "name": "Номенклатура",
-              "price": "Стоимость",
-              "stock": null,
-              "article": "Код"
-            }}
-
-            JSON-ОТВЕТ:
-            """
+            standard_fields = _COLUMN_MAPPING_FIELDS
+            # Статичная часть промпта идёт первой (кэширование префикса на стороне OpenAI), фрагмент файла – в конце
+            prompt = _COLUMN_MAPPING_PROMPT_PREFIX + "\nФРАГМЕНТ ПРАЙС-ЛИСТА:\n" + file_fragment + "\n\nJSON-ОТВЕТ:"
             
             logger.info(f"Sending request to LLM ({self.llm_model_name}) for column mapping. Header: {header_str}")
             response = self.llm.invoke(prompt)
@@ -286,20 +800,15 @@ class QueryProcessor:
             
             # Пытаемся извлечь JSON из ответа
             json_str = None
-            match_block = re.search(r"```json\s*([\s\S]*?)\s*```", response_text, re.IGNORECASE)
-            match_plain = re.search(r"^\s*{\s*[\s\S]*?\s*}\s*$", response_text) # Если JSON без ```
+            match_block = _JSON_CODE_BLOCK_RE.search(response_text)
             
             if match_block:
                 json_str = match_block.group(1).strip()
-            elif match_plain:
-                 json_str = response_text
             else:
-                 logger.warning("Could not find JSON block in LLM response for mapping.")
-                 # Попытка найти JSON хоть как-то (менее надежно)
-                 start_index = response_text.find('{')
-                 end_index = response_text.rfind('}')
-                 if start_index != -1 and end_index != -1 and end_index > start_index:
-                      json_str = response_text[start_index:end_index+1]
+                 # JSON без ``` – первый сбалансированный объект за один линейный проход
+                 json_str = first_json_block(response_text, '{', '}')
+                 if json_str is None:
+                      logger.warning("Could not find JSON block in LLM response for mapping.")
             
             if json_str:
                 try:
@@ -329,6 +838,7 @@ class QueryProcessor:
                     # Проверяем, найдены ли хотя бы имя и цена
                     if validated_mapping.get("name") and validated_mapping.get("price"):
                         logger.info(f"Successfully obtained and validated column mapping from LLM: {validated_mapping}")
+                        self.column_mapping_cache.set(cache_key, validated_mapping, cache_vector)
                         return validated_mapping
                     else:
                         logger.warning("LLM failed to map essential fields 'name' or 'price'. Trying fallback.")
@@ -352,154 +862,291 @@ class QueryProcessor:
             logger.error("Both LLM and fallback keyword mapping failed.")
             return None
 
-    def process_query(self, query: str) -> List[Product]:
+    def _build_keyword_prompt(self, query: str) -> str:
+        """Промпт извлечения ключевых слов для поиска товара"""
+        return _KEYWORD_PROMPT_PREFIX + "\nЗапрос: " + query + "\nОтвет:"
+
+    def _build_keyword_batch_prompt(self, queries: List[str]) -> str:
+        """Промпт извлечения ключевых слов сразу для нескольких пронумерованных запросов"""
+        numbered = "\n".join(f"{i}. {query}" for i, query in enumerate(queries, 1))
+        return _KEYWORD_PROMPT_PREFIX + _KEYWORD_BATCH_PROMPT_SUFFIX + "\nЗапросы:\n" + numbered + "\nОтвет:"
+
+    def _parse_keywords_batch_response(self, text: str, expected: int) -> Optional[list]:
+        """Массив массивов ключевых слов из ответа на пачку; None, если число ответов не совпало"""
+        text = text.strip()
+        try:
+            parsed = json.loads(text)
+        except Exception:
+            array_str = first_json_array(text)
+            try:
+                parsed = json.loads(array_str) if array_str else None
+            except Exception:
+                parsed = None
+        if not isinstance(parsed, list) or len(parsed) != expected or not all(isinstance(kws, list) for kws in parsed):
+            logger.warning(f"Batch keyword response does not match {expected} queries: {text[:200]}")
+            return None
+        return parsed
+
+    def _parse_keywords_response(self, text: str) -> list:
+        """Достаёт JSON-массив ключевых слов из ответа LLM"""
+        text = text.strip()
+        try:
+            return json.loads(text)
+        except Exception:
+            array_str = first_json_array(text)
+            if array_str:
+                try:
+                    return json.loads(array_str)
+                except Exception:
+                    logger.warning(f"Could not parse JSON from LLM response: {text}")
+                    return []
+            logger.warning(f"Could not find JSON in LLM response: {text}")
+            return []
+
+    def _finalize_keywords(self, keywords: list, query: str) -> List[str]:
+        """Очистка ключевых слов и fallback на разбиение текста запроса"""
+        # Если LLM не используется или не вернул ключевые слова
+        if not keywords:
+            keywords = [kw.strip() for kw in query.split() if kw.strip()]
+        # Финальная очистка ключевых слов: удаляем пробелы, пустые строки, приводим к нижнему регистру
+        keywords = [kw.strip() for kw in keywords if isinstance(kw, str) and kw.strip()]
+        if not keywords:
+            logger.warning(f"LLM returned empty keywords for query '{query}'. Falling back to splitting query text.")
+            cleaned_query = _QTY_STRIP_RE.sub('', query).strip()
+            cleaned_query = _TAIL_NUM_RE.sub('', cleaned_query).strip()
+            keywords = [kw.strip() for kw in cleaned_query.split() if kw.strip() and kw.lower() not in ["нужен", "в", "количестве", "для", "под", "и", "с", "еще", "шт", "штук", "компл"]]
+            if not keywords:
+                keywords = [query] if query else []
+        return keywords
+
+    def _simple_query_keywords(self, query: str) -> Optional[List[str]]:
         """
-        Process a natural language query and return ALL matching products (OR search, без скоринга).
+        Быстрый путь: для коротких запросов без цифр, ГОСТ/ДУ/РУ и пунктуации ("фланец",
+        "задвижка чугунная") LLM вернул бы те же слова – возвращаем их без вызова LLM.
         """
-        try:
-            logger.info(f"Processing query: {query}")
-            query = normalize_dimensions(query)
-            prompt = f"""ЗАДАЧА: Извлечь ключевые слова для поиска товара.
+        words = query.split()
+        if not words or len(words) > 3 or _LLM_NEEDED_RE.search(query):
+            return None
+        self.llm_skipped_total += 1
+        logger.info(f"Simple query, LLM skipped (llm_skipped_total={self.llm_skipped_total}): {query}")
+        return [w.strip().lower() for w in words if w.strip()]
 
-ПРАВИЛА:
-1. Извлекай характеристики ТОЧНО как в тексте: "тип В", "ст.20", "ГОСТ 17375-2001", "108*6", "ДУ400".
-2. НЕ включай количество (штук, шт, компл) и числа количества.
-3. НЕ включай слова: нужен, для, под, и, с, еще, в, количестве.
-4. ВСЕГДА возвращай JSON-массив, даже для простых слов.
+    def _cached_keywords(self, cache_key: str) -> Tuple[Optional[list], Any]:
+        """
+        Ключевые слова из семантического кэша: (ключевые слова или None, эмбеддинг для set()).
+        Соседний запрос может отличаться материалом/исполнением без чисел ("задвижка чугунная" и
+        "задвижка стальная"), поэтому семантическое попадание принимается, только если каждое
+        нечисловое ключевое слово соседа встречается в текущем запросе – как проверка маппинга
+        колонок по заголовкам в get_column_mapping.
+        """
+        cached, vector = self.keyword_cache.get(cache_key)
+        if cached and vector is not None:
+            foreign = [
+                kw for kw in cached
+                if isinstance(kw, str) and not _NUMBER_RE.search(kw)
+                and normalize_dimensions(kw.lower()).strip() not in cache_key
+            ]
+            if foreign:
+                logger.info(f"Semantic keyword cache hit rejected for '{cache_key}': {foreign} not in query")
+                return None, vector
+        return cached, vector
 
-ПРИМЕРЫ:
-"редуктор" → ["редуктор"]
-"фланец" → ["фланец"] 
-"отвод 57х5" → ["отвод", "57х5"]
-"задвижка ДУ300" → ["задвижка", "ДУ300"]
-"Отвод ГОСТ17375-2001 108*6 ст.20 90гр. 2000 штук" → ["Отвод", "ГОСТ17375-2001", "108*6", "ст.20", "90гр"]
+    def _extract_keywords(self, query: str) -> List[str]:
+        """Извлекает ключевые слова из (уже нормализованного) запроса через LLM"""
+        simple_keywords = self._simple_query_keywords(query)
+        if simple_keywords:
+            return simple_keywords
+        keywords = []
+        if self.llm is not None:
+            cache_key = normalize_dimensions(query.lower())
+            cached, vector = self._cached_keywords(cache_key)
+            if cached:
+                return self._finalize_keywords(cached, query)
+            prompt = self._build_keyword_prompt(query)
+            for llm, model_name in self._keyword_llm_chain(self.llm_cheap, self.llm):
+                try:
+                    started = time.time()
+                    response = llm.invoke(prompt)
+                    keywords = self._parse_keywords_response(response.content)
+                    logger.info(f"Keyword LLM {model_name}: {time.time() - started:.2f}s, keywords={len(keywords)}")
+                except Exception as llm_err:
+                    logger.error(f"LLM invoke failed ({model_name}): {llm_err}.")
+                if keywords:
+                    self.keyword_cache.set(cache_key, keywords, vector)
+                    break
+            else:
+                logger.warning("Keyword LLM returned no usable JSON. Falling back to simple keyword split.")
+        return self._finalize_keywords(keywords, query)
 
-Запрос: {query}
-Ответ:"""
-            keywords = []
-            if self.llm is not None:
+    def _keyword_llm_chain(self, cheap_llm, main_llm) -> list:
+        """Порядок попыток извлечения ключевых слов: дешёвая модель дважды, затем основная"""
+        chain = []
+        if cheap_llm is not None:
+            chain += [(cheap_llm, self.keyword_model_name)] * 2
+        if main_llm is not None:
+            chain.append((main_llm, self.llm_model_name))
+        return chain
+
+    async def _aextract_keywords_batch(self, queries: List[str]) -> List[List[str]]:
+        """
+        Параллельно (asyncio.gather) извлекает ключевые слова для пачки запросов.
+        Запросы упаковываются по llm_batch_size в один промпт; если ответ на группу
+        не разобрался, группа повторяется по одному запросу.
+        """
+        semaphore = asyncio.Semaphore(self.llm_max_concurrency)
+        allm_cheap, allm = self._get_async_llms()
+        chain = self._keyword_llm_chain(allm_cheap if self.llm_cheap is not None else None, allm)
+
+        async def extract(query: str) -> list:
+            prompt = self._build_keyword_prompt(query)
+            for llm, model_name in chain:
                 try:
-                    response = self.llm.invoke(prompt)
-                    text = response.content.strip()
-                    try:
-                        keywords = json.loads(text)
-                    except Exception:
-                        match = re.search(r'\[.*\]', text, re.DOTALL)
-                        if match:
-                            try:
-                                keywords = json.loads(match.group(0))
-                            except Exception:
-                                 logger.warning(f"Could not parse JSON from LLM response: {text}")
-                                 keywords = []
-                        else:
-                            logger.warning(f"Could not find JSON in LLM response: {text}")
-                            keywords = []
+                    started = time.time()
+                    async with semaphore:
+                        response = await llm.ainvoke(prompt)
+                    keywords = self._parse_keywords_response(response.content)
+                    logger.info(f"Keyword LLM {model_name}: {time.time() - started:.2f}s, keywords={len(keywords)}")
+                    if keywords:
+                        return keywords
                 except Exception as llm_err:
-                    logger.error(f"LLM invoke failed: {llm_err}. Falling back to simple keyword split.")
-            # Если LLM не используется или не вернул ключевые слова
-            if not keywords:
-                keywords = [kw.strip() for kw in query.split() if kw.strip()]
-            # Финальная очистка ключевых слов: удаляем пробелы, пустые строки, приводим к нижнему регистру
-            keywords = [kw.strip() for kw in keywords if isinstance(kw, str) and kw.strip()]
-            if not keywords:
-                logger.warning(f"LLM returned empty keywords for query '{query}'. Falling back to splitting query text.")
-                cleaned_query = re.sub(r'\d+\s*(?:шт|штук|компл)\b', '', query, flags=re.IGNORECASE).strip()
-                cleaned_query = re.sub(r'\b\d+\s*$', '', cleaned_query).strip()
-                keywords = [kw.strip() for kw in cleaned_query.split() if kw.strip() and kw.lower() not in ["нужен", "в", "количестве", "для", "под", "и", "с", "еще", "шт", "штук", "компл"]]
-                if not keywords:
-                    keywords = [query] if query else []
+                    logger.error(f"Async LLM invoke failed ({model_name}): {llm_err}.")
+            return []
+
+        async def extract_group(group: List[str]) -> List[list]:
+            if len(group) > 1:
+                prompt = self._build_keyword_batch_prompt(group)
+                for llm, model_name in chain:
+                    try:
+                        started = time.time()
+                        async with semaphore:
+                            response = await llm.ainvoke(prompt)
+                        keywords_list = self._parse_keywords_batch_response(response.content, len(group))
+                        logger.info(f"Batch keyword LLM {model_name}: {time.time() - started:.2f}s, queries={len(group)}")
+                        if keywords_list is not None:
+                            return keywords_list
+                    except Exception as llm_err:
+                        logger.error(f"Async batch LLM invoke failed ({model_name}): {llm_err}.")
+            return await asyncio.gather(*(extract(q) for q in group))
+
+        batch_size = max(1, self.llm_batch_size)
+        groups = [queries[start:start + batch_size] for start in range(0, len(queries), batch_size)]
+        group_results = await asyncio.gather(*(extract_group(group) for group in groups))
+        return [keywords for group_keywords in group_results for keywords in group_keywords]
+
+    def _get_async_llms(self) -> tuple:
+        """
+        (дешёвая, основная) async-модели поверх общего AsyncClient. Создаются один раз и
+        используются только внутри фонового loop (_get_async_loop), к которому привязан пул.
+        """
+        if self._async_llms is None:
+            http_async_client = httpx.AsyncClient(**self.http_client_args)
+            self._async_llms = tuple(
+                ChatOpenAI(
+                    model_name=model_name,
+                    openai_api_key=self.api_key,
+                    temperature=0,
+                    http_async_client=http_async_client
+                )
+                for model_name in (self.keyword_model_name, self.llm_model_name)
+            )
+        return self._async_llms
+
+    def extract_keywords_batch(self, queries: List[str]) -> List[List[str]]:
+        """
+        Извлекает ключевые слова для нескольких запросов одной пачкой параллельных LLM-вызовов.
+        Запросы должны быть уже нормализованы (normalize_dimensions).
+        """
+        if self.llm is None or len(queries) <= 1:
+            return [self._extract_keywords(q) for q in queries]
+        # Сначала семантический кэш, в LLM уходят только промахи
+        results = [None] * len(queries)
+        misses = []
+        for idx, query in enumerate(queries):
+            simple_keywords = self._simple_query_keywords(query)
+            if simple_keywords:
+                results[idx] = simple_keywords
+                continue
+            cache_key = normalize_dimensions(query.lower())
+            cached, vector = self._cached_keywords(cache_key)
+            if cached:
+                results[idx] = cached
+            else:
+                misses.append((idx, cache_key, vector))
+        if misses:
+            # Фоновый loop работает в своём потоке, поэтому вызов безопасен и из-под ASGI
+            miss_keywords = _run_async(self._aextract_keywords_batch([queries[idx] for idx, _, _ in misses]))
+            for (idx, cache_key, vector), keywords in zip(misses, miss_keywords):
+                if keywords:
+                    self.keyword_cache.set(cache_key, keywords, vector)
+                results[idx] = keywords
+        return [self._finalize_keywords(keywords or [], query) for keywords, query in zip(results, queries)]
+
+    def process_queries(self, queries: List[str]) -> List[List[Product]]:
+        """
+        Обрабатывает несколько позиций запроса: ключевые слова для всех позиций извлекаются
+        параллельно, затем по каждой позиции выполняется поиск товаров.
+        Одинаковые позиции (например, "задвижка 100" с разным количеством) обрабатываются один раз,
+        результат раскладывается по всем их индексам.
+        """
+        # Ключ позиции -> индексы во входном списке (порядок первых вхождений сохраняется)
+        positions = {}
+        for idx, q in enumerate(queries):
+            positions.setdefault(q.strip().lower(), []).append(idx)
+        if len(positions) < len(queries):
+            unique_queries = [queries[idxs[0]] for idxs in positions.values()]
+            logger.info(f"process_queries: {len(queries)} items, {len(unique_queries)} unique")
+            unique_results = self.process_queries(unique_queries)
+            results: List[List[Product]] = [[] for _ in queries]
+            for idxs, found in zip(positions.values(), unique_results):
+                for idx in idxs:
+                    results[idx] = found
+            return results
+
+        normalized = [normalize_dimensions(q) for q in queries]
+        keywords_batch = self.extract_keywords_batch(normalized)
+        if len(queries) <= 1:
+            return [self.process_query(q, keywords=kws) for q, kws in zip(queries, keywords_batch)]
+        # Индекс названий строим до запуска потоков, чтобы позиции не перестраивали его наперегонки
+        get_name_index()
+
+        def search(args) -> List[Product]:
+            query, keywords = args
+            try:
+                return self.process_query(query, keywords=keywords)
+            finally:
+                # Соединения Django привязаны к потоку – закрываем соединение рабочего потока
+                connection.close()
+
+        # Позиции независимы; executor.map сохраняет порядок для КП
+        with ThreadPoolExecutor(max_workers=min(self.search_max_workers, len(queries))) as executor:
+            return list(executor.map(search, zip(queries, keywords_batch)))
+
+    def process_query(self, query: str, keywords: Optional[List[str]] = None) -> List[Product]:
+        """
+        Process a natural language query and return ALL matching products (OR search, без скоринга).
+        keywords – заранее извлечённые ключевые слова (см. process_queries), LLM тогда не вызывается.
+        """
+        try:
+            logger.info(f"Processing query: {query}")
+            query = normalize_dimensions(query)
+            if keywords is None:
+                keywords = self._extract_keywords(query)
             logger.info(f"Using keywords: {keywords}")
             if keywords:
-                # ---- ШАГ 1. СТРОГИЙ AND-ПОИСК ----
-                all_products = list(Product.objects.all())
-                # Нормализуем ключевые слова и названия товаров (чтобы 108*6 == 108х6 == 108x6)
-                keywords_norm = [normalize_dimensions(kw.lower()) for kw in keywords]
-
-                def product_matches(p, required_ratio: float = 1.0) -> bool:
-                    name_norm = normalize_dimensions(p.name.lower())
-                    hits = sum(1 for kw in keywords_norm if kw in name_norm)
-                    return hits / len(keywords_norm) >= required_ratio
-
-                # СТРОГИЙ поиск: все ключевые слова должны присутствовать
-                strict_products = [p for p in all_products if product_matches(p, required_ratio=1.0)]
-
-                if strict_products:
-                    logger.info(
-                        f"STRICT-поиск: найдено {len(strict_products)} товар(ов), удовлетворяющих 100% из {len(keywords_norm)} ключевых слов."
-                    )
-                    return strict_products
-
-                # МЯГКИЙ AND-поиск (>=80% совпадений) – спасает, если ключевые слова содержат редкие детали
-                soft_products = [p for p in all_products if product_matches(p, required_ratio=0.8)]
-
-                if soft_products:
-                    logger.info(
-                        f"SOFT-поиск: найдено {len(soft_products)} товар(ов), удовлетворяющих ≥80% ключевых слов."
-                    )
-                    # Переходим к скорингу, но уже по уменьшенному набору
-                    all_products = soft_products
-
-                # ---- ШАГ 2. ГИБКИЙ ПОИСК С ОЦЕНКОЙ РЕЛЕВАНТНОСТИ ----
-                scored_products = []
-                
-                for product in all_products:
-                    score = self._calculate_relevance_score(product.name.lower(), keywords, query.lower())
-                    if score > 0:
-                        scored_products.append((product, score))
-                
-                # Сортируем по релевантности (убывание)
-                scored_products.sort(key=lambda x: x[1], reverse=True)
-                
-                if not scored_products:
-                    logger.info("No products found with positive relevance score.")
-                    return []
-                
-                # --- ДОПОЛНИТЕЛЬНЫЕ ЛОГИ ДЛЯ ДИАГНОСТИКИ ---
-                if scored_products:
-                    scores_only = [s for _, s in scored_products]
-                    max_score = scores_only[0]
-                    avg_score = statistics.mean(scores_only)
-                    median_score = statistics.median(scores_only)
-                    logger.info(
-                        f"Статистика релевантности: макс={max_score:.1f}, среднее={avg_score:.1f}, медиана={median_score:.1f}, всего_оценено={len(scores_only)}"
-                    )
-
-                    # Логируем топ-10 товаров по релевантности
-                    top_samples = [
-                        (p.id, p.name[:60], f"{s:.1f}") for p, s in scored_products[:10]
-                    ]
-                    logger.debug(f"Топ-10 по релевантности: {top_samples}")
-                # --- КОНЕЦ ДОПОЛНИТЕЛЬНЫХ ЛОГОВ ---
-                
-                # АДАПТИВНЫЙ ПОРОГ РЕЛЕВАНТНОСТИ (ИСКОННАЯ ЛОГИКА)
-                if max_score >= 1000:  # Точное совпадение
-                    threshold = 50   # Снижаем порог
-                elif max_score >= 500:  # Название начинается с запроса  
-                    threshold = 40   # Снижаем порог
-                elif max_score >= 300:  # Запрос содержится в названии
-                    threshold = 30   # Снижаем порог
-                elif max_score >= 150:  # Хорошие совпадения ключевых слов
-                    threshold = 20   # Снижаем порог
-                else:  # Слабые совпадения
-                    threshold = 15   # Снижаем порог
-                
-                # Фильтруем по порогу
-                filtered_products = [(p, s) for p, s in scored_products if s >= threshold]
-                
-                # Логи о количестве прошедших/отсеянных товаров
-                logger.info(
-                    f"Прошло фильтр: {len(filtered_products)} из {len(scored_products)} (порог={threshold})"
-                )
-                
-                # НЕ ОГРАНИЧИВАЕМ количество результатов - могут быть разные поставщики
-                # Пользователь хочет видеть все релевантные товары от всех поставщиков
-                
-                results = [product for product, score in filtered_products]
-                
-                logger.info(f"Found {len(results)} relevant products (threshold={threshold}, max_score={max_score:.1f}).")
-                if filtered_products:
-                    logger.info(f"Top 3 matches: {[(p.id, p.name[:50], f'{score:.1f}') for p, score in filtered_products[:3]]}")
-                
+                # Названия уже нормализованы в индексе (чтобы 108*6 == 108х6 == 108x6)
+                name_index, catalog_state = get_name_index()
+                # Результат зависит только от запроса, ключевых слов и состояния каталога, по которому
+                # собран индекс (меняется после загрузки прайса) – id найденных товаров кэшируем в общем
+                # QueryCache (sqlite, виден всем воркерам), повторные одинаковые позиции не пересчитываются
+                cache_key = "__search__:" + hashlib.sha1(
+                    repr((query, tuple(keywords), catalog_state)).encode('utf-8')
+                ).hexdigest()
+                cached_ids = self.query_cache.get(cache_key)
+                if cached_ids is not None:
+                    logger.info(f"Search cache hit: {len(cached_ids)} product(s) for query '{query}'")
+                    return self._products_by_ids(cached_ids)
+                results = self._search_products(query, keywords, name_index)
+                self.query_cache.set(cache_key, [product.id for product in results])
                 return results
             else:
                 logger.info("No keywords extracted, returning empty results.")
@@ -508,25 +1155,171 @@ class QueryProcessor:
             logger.error(f"Error processing query: {str(e)}")
             raise
     
-    def _calculate_relevance_score(self, product_name: str, keywords: List[str], original_query: str) -> float:
+    def _search_products(self, query: str, keywords: List[str], name_index: dict) -> List[Product]:
+        """Поиск товаров по ключевым словам: строгий/мягкий AND-отбор по индексу, затем скоринг релевантности"""
+        # ---- ШАГ 1. СТРОГИЙ AND-ПОИСК ----
+        keywords_norm = tuple(normalize_dimensions(kw.lower()) for kw in keywords)
+
+        # Один проход по индексу: СТРОГИЙ (все ключевые слова) и МЯГКИЙ (>=80%) отбор вместе
+        keywords_count = len(keywords_norm)
+        strict_ids = []
+        soft_ids = []
+        for pk, name in name_index.items():
+            hits = sum(1 for kw in keywords_norm if kw in name)
+            if hits == keywords_count:
+                strict_ids.append(pk)
+            elif hits / keywords_count >= 0.8:
+                soft_ids.append(pk)
+
+        if strict_ids:
+            strict_products = self._products_by_ids(strict_ids)
+            logger.info(
+                f"STRICT-поиск: найдено {len(strict_products)} товар(ов), удовлетворяющих 100% из {len(keywords_norm)} ключевых слов."
+            )
+            return strict_products
+
+        # МЯГКИЙ AND-поиск (>=80% совпадений) – спасает, если ключевые слова содержат редкие детали
+        if soft_ids:
+            logger.info(
+                f"SOFT-поиск: найдено {len(soft_ids)} товар(ов), удовлетворяющих ≥80% ключевых слов."
+            )
+            # Переходим к скорингу, но уже по уменьшенному набору
+            all_products = self._products_by_ids(soft_ids)
+            deferred_products = False
+        else:
+            # Полный скан неизбежен – тянем из БД только id, name и размеры, остальные поля загрузим для прошедших порог
+            all_products = list(Product.objects.only('id', 'name', 'dimensions').iterator(chunk_size=2000))
+            deferred_products = True
+
+        # ---- ШАГ 2. ГИБКИЙ ПОИСК С ОЦЕНКОЙ РЕЛЕВАНТНОСТИ ----
+        names_lower = [product.name.lower().strip() for product in all_products]
+        # Вхождения ключевых слов считаем векторно по всем названиям сразу
+        keyword_masks = self._keyword_masks(names_lower, keywords)
+        query_lower = query.lower().strip()
+        query_features = _query_features(query_lower)
+        
+        # Баллы – в массив NumPy по позиции товара; выбор топа и порог – без сортировки списков кортежей
+        scores = np.empty(len(all_products), dtype=np.float64)
+        for i, (product, name_lower, keyword_mask) in enumerate(zip(all_products, names_lower, keyword_masks)):
+            scores[i] = self._calculate_relevance_score(
+                name_lower, keywords, query_lower, keyword_mask=keyword_mask, query_features=query_features,
+                min_score=_MIN_RELEVANCE_THRESHOLD, product_dimensions=tuple(product.dimensions)
+            )
+        
+        positive_idx = np.flatnonzero(scores > 0)
+        if positive_idx.size == 0:
+            logger.info("No products found with positive relevance score.")
+            return []
+        
+        # --- ДОПОЛНИТЕЛЬНЫЕ ЛОГИ ДЛЯ ДИАГНОСТИКИ ---
+        max_score = float(scores[positive_idx].max())
+        # Статистика считается только если INFO-логи включены
+        if logger.isEnabledFor(logging.INFO):
+            scores_only = scores[positive_idx]
+            avg_score = float(scores_only.mean())
+            median_score = float(np.median(scores_only))
+            logger.info(
+                f"Статистика релевантности: макс={max_score:.1f}, среднее={avg_score:.1f}, медиана={median_score:.1f}, всего_оценено={len(scores_only)}"
+            )
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Логируем топ-10 товаров по релевантности: argpartition – O(N), сортируем только 10
+            top_k = min(10, positive_idx.size)
+            top_idx = positive_idx[np.argpartition(-scores[positive_idx], top_k - 1)[:top_k]]
+            top_idx = top_idx[np.argsort(-scores[top_idx], kind='stable')]
+            top_samples = [
+                (all_products[i].id, all_products[i].name[:60], f"{scores[i]:.1f}") for i in top_idx
+            ]
+            logger.debug(f"Топ-10 по релевантности: {top_samples}")
+        # --- КОНЕЦ ДОПОЛНИТЕЛЬНЫХ ЛОГОВ ---
+        
+        # АДАПТИВНЫЙ ПОРОГ РЕЛЕВАНТНОСТИ (ИСКОННАЯ ЛОГИКА)
+        if max_score >= 1000:  # Точное совпадение
+            threshold = 50   # Снижаем порог
+        elif max_score >= 500:  # Название начинается с запроса  
+            threshold = 40   # Снижаем порог
+        elif max_score >= 300:  # Запрос содержится в названии
+            threshold = 30   # Снижаем порог
+        elif max_score >= 150:  # Хорошие совпадения ключевых слов
+            threshold = 20   # Снижаем порог
+        else:  # Слабые совпадения
+            threshold = _MIN_RELEVANCE_THRESHOLD   # Снижаем порог
+        
+        # Фильтруем по порогу и сортируем по релевантности (убывание) только прошедшие
+        passed_idx = np.flatnonzero(scores >= threshold)
+        passed_idx = passed_idx[np.argsort(-scores[passed_idx], kind='stable')]
+        filtered_products = [(all_products[i], float(scores[i])) for i in passed_idx]
+        
+        # Логи о количестве прошедших/отсеянных товаров
+        logger.info(
+            f"Прошло фильтр: {len(filtered_products)} из {positive_idx.size} (порог={threshold})"
+        )
+        
+        # НЕ ОГРАНИЧИВАЕМ количество результатов - могут быть разные поставщики
+        # Пользователь хочет видеть все релевантные товары от всех поставщиков
+        
+        results = [product for product, score in filtered_products]
+        if deferred_products:
+            results = self._products_by_ids([product.id for product in results])
+        
+        logger.info(f"Found {len(results)} relevant products (threshold={threshold}, max_score={max_score:.1f}).")
+        if filtered_products:
+            logger.info(f"Top 3 matches: {[(p.id, p.name[:50], f'{score:.1f}') for p, score in filtered_products[:3]]}")
+        
+        return results
+
+    def _products_by_ids(self, ids: List[int]) -> List[Product]:
+        """Загружает товары по id, сохраняя порядок индекса (поставщик – тем же JOIN, его имя выводится в выдаче и КП)"""
+        products = Product.objects.select_related('supplier').in_bulk(ids)
+        return [products[pk] for pk in ids if pk in products]
+
+    def _keyword_masks(self, names: List[str], keywords: List[str]) -> list:
+        """
+        Векторно (numba-ядро или pandas, по одному проходу на ключевое слово) строит битовые маски вхождений
+        ключевых слов для каждого названия. Возвращает [None] * N, если векторизация неприменима.
+        """
+        keywords_lower = _keyword_plan(tuple(keywords))[0]
+        if not names or not keywords_lower or len(keywords_lower) > 62:
+            return [None] * len(names)
+        if _NUMBA_AVAILABLE:
+            # Поиск подстроки в UTF-8 байтах эквивалентен поиску в str
+            name_buf, offsets = _flatten_utf8(names)
+            kw_buf, kw_offsets = _flatten_utf8(keywords_lower)
+            return _numba_keyword_masks(name_buf, offsets, kw_buf, kw_offsets).tolist()
+        series = pd.Series(names, dtype=object)
+        masks = np.zeros(len(names), dtype=np.int64)
+        for i, keyword in enumerate(keywords_lower):
+            hits = series.str.contains(keyword, regex=False).to_numpy(dtype=np.int64)
+            masks |= hits << i
+        return masks.tolist()
+
+    def _calculate_relevance_score(self, product_name: str, keywords: List[str], original_query: str,
+                                   keyword_mask: Optional[int] = None,
+                                   query_features: Optional[QueryFeatures] = None,
+                                   min_score: Optional[float] = None,
+                                   product_dimensions: Optional[tuple] = None) -> float:
         """
         Рассчитывает релевантность товара запросу.
         Чем выше балл, тем более релевантен товар.
+        product_name и original_query передаются уже в нижнем регистре и без крайних пробелов.
+        keyword_mask – заранее посчитанная маска вхождений ключевых слов (см. _keyword_masks).
+        query_features – признаки запроса, посчитанные вызывающим один раз на весь цикл по товарам.
+        min_score – балл, ниже которого товар всё равно отбросят: если его уже не набрать, возвращаем 0.
+        product_dimensions – размеры товара из Product.dimensions (посчитаны при записи в БД).
+        Признаки запроса и товара (слова, размеры, критичные характеристики) кэшируются
+        в _query_features/_product_features, здесь остаются только пересечения множеств.
         """
         score = 0.0
-        product_name = product_name.lower().strip()
-        original_query = original_query.lower().strip()
+        if query_features is None:
+            query_features = _query_features(original_query)
+        query_words, has_dimensions, query_dimensions, query_buckets = query_features[:4]
+        features = _product_features(product_name, product_dimensions)
         
         # 0. ПРЕДВАРИТЕЛЬНАЯ ФИЛЬТРАЦИЯ - исключаем заведомо нерелевантные товары
         if len(original_query) >= 3:  # Только для запросов длиннее 3 символов
             # Если нет ни одного общего значимого слова - сразу отсекаем
-            query_words = set(re.findall(r'\b\w{2,}\b', original_query))  # Слова от 2 букв
-            product_words = set(re.findall(r'\b\w{2,}\b', product_name))
-            
             # НО! Не отсекаем если есть размеры - они могут быть записаны по-разному
-            has_dimensions = bool(re.search(r'\d+[x*х]\d+', original_query, re.IGNORECASE))
-            
-            if not has_dimensions and not query_words.intersection(product_words) and original_query not in product_name:
+            if not has_dimensions and query_words.isdisjoint(features.words) and original_query not in product_name:
                 return 0  # Нет пересечений - нерелевантно
         
         # 1. ТОЧНОЕ СОВПАДЕНИЕ названия (высший приоритет)
@@ -544,36 +1337,27 @@ class QueryProcessor:
             score += 300
         
         # 4. СТРОГАЯ ПРОВЕРКА КЛЮЧЕВЫХ СЛОВ
-        keywords_lower = [kw.lower().strip() for kw in keywords if kw and len(kw.strip()) >= 2]
-        exact_matches = 0
-        important_keywords_found = 0
-        
-        # Важные ключевые слова (типы товаров, характеристики)
-        important_patterns = ['редуктор', 'задвижка', 'фланец', 'отвод', 'переход', 'тройник', 
-                             'заглушка', 'клапан', 'кран', 'муфта', 'патрубок',
-                             r'ду\s*\d+', r'ру\s*\d+', r'гост\s*\d+', r'ст\.\d+', r'тип\s*[а-я]']
+        # Битовая маска: бит i установлен, если ключевое слово i входит в название
+        keywords_lower, important_mask, long_mask = _keyword_plan(tuple(keywords))
+        if keyword_mask is not None:
+            mask = keyword_mask
+        else:
+            mask = 0
+            for i, keyword in enumerate(keywords_lower):
+                if keyword in product_name:
+                    mask |= 1 << i
+        exact_matches = mask.bit_count()
+        important_keywords_found = (mask & important_mask).bit_count()
         
-        for keyword in keywords_lower:
-            if keyword in product_name:
-                # Базовый бонус за вхождение
-                base_bonus = 30
-                
-                # Проверяем важность ключевого слова
-                is_important = any(re.search(pattern, keyword, re.IGNORECASE) for pattern in important_patterns) or \
-                              any(pattern in keyword for pattern in ['редуктор', 'задвижка', 'фланец', 'отвод'])
-                
-                if is_important:
-                    base_bonus = 80  # Повышенный бонус для важных слов
-                    important_keywords_found += 1
-                    
-                score += base_bonus
-                exact_matches += 1
-                
-                # Дополнительный бонус за границы слов (более точное совпадение)
-                if f" {keyword} " in f" {product_name} " or \
-                   product_name.startswith(keyword + " ") or \
-                   product_name.endswith(" " + keyword) or \
-                   len(keyword) >= 4:  # Длинные ключевые слова менее требовательны к границам
+        # Базовый бонус 30 за вхождение, 80 для важных слов (типы товаров, характеристики)
+        score += exact_matches * 30 + important_keywords_found * 50
+        # Дополнительный бонус за границы слов; длинные ключевые слова менее требовательны к границам
+        score += (mask & long_mask).bit_count() * 20
+        short_hits = mask & ~long_mask
+        if short_hits:
+            padded_name = f" {product_name} "
+            for i, keyword in enumerate(keywords_lower):
+                if short_hits >> i & 1 and f" {keyword} " in padded_name:
                     score += 20
         
         # 5. СТРОГИЕ ТРЕБОВАНИЯ К ПОКРЫТИЮ
@@ -591,39 +1375,29 @@ class QueryProcessor:
         if important_keywords_found == 0 and len(keywords_lower) > 2:
             score -= 50  # Штраф если нет важных ключевых слов в длинном запросе
         
-        # 6. СПЕЦИАЛЬНЫЕ БОНУСЫ ДЛЯ ЧАСТЫХ ТИПОВ ТОВАРОВ
-        special_bonuses = {
-            'редуктор': ['редуктор'],
-            'задвижка': ['задвижка', 'клапан'],
-            'фланец': ['фланец', 'фланцы'],
-            'отвод': ['отвод', 'отводы'],
-            'переход': ['переход', 'переходы'],
-            'тройник': ['тройник', 'тройники'],
-            'заглушка': ['заглушка', 'заглушки']
-        }
+        # Оставшиеся разделы (типы товаров, размеры, критичные характеристики) дают не больше
+        # query_features.max_tail_bonus – если и с ним товар не дотянет до min_score, дальше не считаем
+        if min_score is not None and score + query_features.max_tail_bonus < min_score:
+            return 0
         
-        for product_type, synonyms in special_bonuses.items():
+        # 6. СПЕЦИАЛЬНЫЕ БОНУСЫ ДЛЯ ЧАСТЫХ ТИПОВ ТОВАРОВ
+        for product_type, synonyms in _SPECIAL_BONUSES.items():
             if any(syn in original_query for syn in synonyms):
                 if product_type in product_name:
                     score += 30  # Бонус за соответствие типа товара
         
         # 7. ШТРАФ ЗА СЛИШКОМ ДЛИННЫЕ НАЗВАНИЯ (если запрос короткий)
-        if len(original_query.split()) <= 2 and len(product_name.split()) > 5:
+        if query_features.n_tokens <= 2 and features.n_tokens > 5:
             score -= 10
         
         # 8. КРИТИЧЕСКИ ВАЖНЫЙ ПОИСК ПО РАЗМЕРАМ
         
-        # Нормализуем и запрос, и название товара для точного сравнения размеров
-        normalized_query = normalize_dimensions(original_query)
-        normalized_product = normalize_dimensions(product_name)
-        
-        # Извлекаем ВСЕ размеры из нормализованных строк
-        query_dimensions = re.findall(r'\d+x\d+', normalized_query, re.IGNORECASE)
-        product_dimensions = re.findall(r'\d+x\d+', normalized_product, re.IGNORECASE)
+        # ВСЕ размеры из нормализованных строк посчитаны заранее (_query_features/_product_features)
+        product_dimensions = features.dimensions
         
         # УЛУЧШЕННАЯ система размеров - точные совпадения И частичные
         if query_dimensions:
-            exact_dimension_matches = set(query_dimensions) & set(product_dimensions)
+            exact_dimension_matches = query_dimensions & product_dimensions
             
             if exact_dimension_matches:
                 # ВЫСОКИЙ бонус за точное совпадение размеров
@@ -636,35 +1410,22 @@ class QueryProcessor:
             # Если в товаре нет размеров, не штрафуем (может быть общее название)
         
         # Другие КРИТИЧНЫЕ характеристики (ДУ, РУ, тип, ГОСТ, сталь)
-        critical_patterns = [
-            (r'ду\s*(\d+)', 150),      # ДУ - важная характеристика
-            (r'ру\s*(\d+)', 100),      # РУ - важная характеристика  
-            (r'тип\s*([абвг])', 80),   # Тип - важная характеристика
-            (r'гост\s*(\d+(?:[-\s]*\d+)?)', 120),  # ГОСТ - стандарт
-            (r'ст\.?\s*(\d+)', 80),    # Сталь - материал
-            (r'исп\.?\s*([а-я])', 60), # Исполнение
-            (r'09г2с', 100),           # Конкретная сталь
-            (r'ст20', 80),             # Конкретная сталь
-            (r'ст45', 80),             # Конкретная сталь
-        ]
-        
-        for pattern, bonus in critical_patterns:
-            query_matches = set(re.findall(pattern, original_query, re.IGNORECASE))
-            product_matches = set(re.findall(pattern, product_name, re.IGNORECASE))
-            
-            if query_matches and product_matches:
-                # Бонус за совпадающие критичные характеристики
-                common_matches = query_matches & product_matches
-                if common_matches:
-                    score += len(common_matches) * bonus
-                    # logger.debug(f"Critical pattern match: {pattern} - {common_matches}")  # Убираем избыточные логи
+        if query_buckets:
+            product_buckets = features.critical
+            for name, query_matches in query_buckets.items():
+                bonus = _CRITICAL_BONUSES[name]
+                product_matches = product_buckets.get(name)
+                if product_matches:
+                    # Бонус за совпадающие критичные характеристики
+                    common_matches = query_matches & product_matches
+                    if common_matches:
+                        score += len(common_matches) * bonus
+                    else:
+                        # Штраф за несовпадение критичных характеристик
+                        score -= bonus // 2
                 else:
-                    # Штраф за несовпадение критичных характеристик
-                    score -= bonus // 2
-                    # logger.debug(f"Critical pattern mismatch: query={query_matches}, product={product_matches}")  # Убираем избыточные логи
-            elif query_matches and not product_matches:
-                # Если в запросе есть критичная характеристика, а в товаре нет - штраф
-                score -= bonus // 3
+                    # Если в запросе есть критичная характеристика, а в товаре нет - штраф
+                    score -= bonus // 3
         
         return max(score, 0)  # Минимум 0
     
@@ -682,25 +1443,22 @@ class QueryProcessor:
             
         # ПРОСТАЯ ЛОГИКА: разделяем по строкам
         if '\n' in full_query:
-            lines = [line.strip() for line in full_query.splitlines() if line.strip()]
+            lines = [line for line in map(str.strip, full_query.splitlines()) if line]
+            
+            # Почти все строки – длинные и с цифрами (размеры, ГОСТ, количество): это уже список товаров,
+            # LLM здесь отсеял бы то же, что и простой фильтр – не тратим на него сетевой запрос
+            product_like = sum(1 for line in lines if len(line) > 20 and _HAS_DIGIT_RE.search(line))
             
             # УМНАЯ ФИЛЬТРАЦИЯ через LLM - определяем товарные строки
-            if self.llm and len(lines) > 1:
+            if self.llm and len(lines) > 1 and product_like / len(lines) <= 0.85:
                 clean_lines = self._filter_product_lines_with_llm(lines)
                 logger.info(f"LLM filtered {len(clean_lines)} product lines from {len(lines)} total lines")
             else:
-                # Простая фильтрация без LLM
-                clean_lines = []
-                for line in lines:
-                    line_lower = line.lower()
-                    # Пропускаем заголовки и мусор
-                    if any(junk in line_lower for junk in ['№', 'наименование', 'количество', 'цена', 'стоимость', 'итог']):
-                        continue
-                    if len(line) < 5:  # Слишком короткие строки
-                        continue
-                    if re.match(r'^\d+$', line):  # Только цифры
-                        continue
-                    clean_lines.append(line)
+                # Простая фильтрация без LLM: заголовки/мусор, слишком короткие строки, только цифры
+                clean_lines = [
+                    line for line in lines
+                    if len(line) >= 5 and not line.isdigit() and not _is_junk_line(line.lower())
+                ]
                 logger.info(f"Simple filter: {len(clean_lines)} lines from {len(lines)} total lines")
         else:
             # Один товар
@@ -710,10 +1468,7 @@ class QueryProcessor:
         # Создаем список товаров
         items = []
         for line in clean_lines:
-            quantity = extract_quantity(line)
-            # Убираем количество из названия товара
-            item_name = re.sub(r'\d+\s*(?:шт|штук|компл)\b', '', line, flags=re.IGNORECASE).strip()
-            item_name = re.sub(r'\s+\d+\s*$', '', item_name).strip()  # Убираем число в конце
+            item_name, quantity = _split_item_line(line)
             
             if item_name:
                 items.append({
@@ -726,8 +1481,17 @@ class QueryProcessor:
     
     def _filter_product_lines_with_llm(self, lines: List[str]) -> List[str]:
         """
-        Использует LLM для определения какие строки содержат товары, а какие - мусор
+        Использует LLM для определения какие строки содержат товары, а какие - мусор.
+        Выбранные номера строк кэшируются в QueryCache: один и тот же шаблон заявки
+        (те же заголовки и строки) повторно не отправляется в LLM.
         """
+        cache_key = "__line_filter__:" + hashlib.sha1(
+            '\n'.join(line.lower() for line in lines).encode('utf-8')
+        ).hexdigest()
+        cached_indices = self.query_cache.get(cache_key)
+        if cached_indices is not None:
+            return [lines[i] for i in cached_indices if 0 <= i < len(lines)]
+
         try:
             # Создаем промпт для фильтрации
             lines_text = '\n'.join([f"{i+1}. {line}" for i, line in enumerate(lines)])
@@ -746,7 +1510,7 @@ class QueryProcessor:
             result_text = response.content if hasattr(response, 'content') else str(response)
             
             # Извлекаем номера строк
-            numbers = re.findall(r'\d+', result_text)
+            numbers = _NUMBER_RE.findall(result_text)
             selected_indices = [int(n)-1 for n in numbers if int(n) <= len(lines)]
             
             # Возвращаем отфильтрованные строки
@@ -754,6 +1518,7 @@ class QueryProcessor:
             
             if filtered_lines:
                 logger.info(f"LLM selected {len(filtered_lines)} product lines: {[f'{i+1}' for i in selected_indices]}")
+                self.query_cache.set(cache_key, [i for i in selected_indices if 0 <= i < len(lines)])
                 return filtered_lines
             else:
                 logger.warning("LLM returned no valid line numbers, using simple filter")
@@ -804,30 +1569,23 @@ class QueryProcessor:
             stock_col = headers[2]
         
         # --- ШАГ 1.2. Fallback: анализ данных, ищем числовые столбцы ---
+        # Выборку первых строк переводим в DataFrame один раз (колонки – позиции заголовков),
+        # дальше все проверки по ячейкам – векторные операции pandas
         sample_limit = min(30, len(table_rows))
+        sample_df = pd.DataFrame(
+            [[row.get(h, '') for h in headers] for row in table_rows[:sample_limit]],
+            dtype=object
+        ).fillna('')
+
         def detect_numeric_column(candidate_headers, allow_zero=True):
-            best_header = None
-            best_score = 0
-            for h in candidate_headers:
-                numeric_hits = 0
-                non_empty = 0
-                for i in range(sample_limit):
-                    val = table_rows[i].get(h, '')
-                    if val is None:
-                        continue
-                    val_str = str(val).strip()
-                    if not val_str:
-                        continue
-                    non_empty += 1
-                    if re.search(r"\d", val_str):
-                        numeric_hits += 1
-                if non_empty == 0:
-                    continue
-                ratio = numeric_hits / non_empty
-                if ratio > best_score:
-                    best_score = ratio
-                    best_header = h
-            return best_header if best_score >= 0.6 else None
+            values = sample_df.astype(str).apply(lambda col: col.str.strip())
+            non_empty = (values != '').sum()
+            numeric_hits = values.apply(lambda col: col.str.contains(r"\d", regex=True)).sum()
+            ratios = (numeric_hits / non_empty.where(non_empty > 0)).fillna(0)
+            ratios = ratios[[headers.index(h) for h in candidate_headers]]
+            if ratios.empty or ratios.max() < 0.6:
+                return None
+            return headers[int(ratios.idxmax())]
 
         # Переопределяем price_col/stock_col, если не нашли по заголовку
         if price_col is None:
@@ -848,10 +1606,10 @@ class QueryProcessor:
             if not v:
                 return False
             # наличие валютного символа или запятой как десятичного
-            if any(sym in v for sym in [',', '₽', 'руб', '$', 'eur', '€', 'тг']):
+            if _has_price_marker(v):
                 return True
             # большое число
-            digits = re.sub(r'[^0-9]', '', v)
+            digits = _NON_DIGIT_RE.sub('', v)
             if digits and len(digits) >= 4:
                 return True  # >= 1000
             return False
@@ -860,31 +1618,22 @@ class QueryProcessor:
             v = str(v).lower().strip()
             if not v:
                 return False
-            if any(word in v for word in ['нет', 'под заказ', 'ожид', 'отсут', 'в наличии', 'есть']):
+            if _has_stock_marker(v):
                 return True
-            digits = re.sub(r'[^0-9]', '', v)
+            digits = _NON_DIGIT_RE.sub('', v)
             if digits and len(digits) <= 4:  # до 9999 шт
                 return True
             return False
 
         swap_needed = False
         if price_col and stock_col:
-            price_like_in_price = 0
-            stock_like_in_price = 0
-            price_like_in_stock = 0
-            stock_like_in_stock = 0
             sample_n = min(25, len(table_rows))
-            for i in range(sample_n):
-                price_val = table_rows[i].get(price_col, '')
-                stock_val = table_rows[i].get(stock_col, '')
-                if looks_like_price(price_val):
-                    price_like_in_price += 1
-                if looks_like_stock(price_val):
-                    stock_like_in_price += 1
-                if looks_like_price(stock_val):
-                    price_like_in_stock += 1
-                if looks_like_stock(stock_val):
-                    stock_like_in_stock += 1
+            price_values = sample_df[headers.index(price_col)].head(sample_n)
+            stock_values = sample_df[headers.index(stock_col)].head(sample_n)
+            price_like_in_price = int(price_values.map(looks_like_price).sum())
+            stock_like_in_price = int(price_values.map(looks_like_stock).sum())
+            price_like_in_stock = int(stock_values.map(looks_like_price).sum())
+            stock_like_in_stock = int(stock_values.map(looks_like_stock).sum())
 
             # если price_col больше похож на stock, а stock_col похож на price
             if stock_like_in_price > price_like_in_price and price_like_in_stock > stock_like_in_stock:
@@ -896,134 +1645,97 @@ class QueryProcessor:
                 f"SWAP DETECTED: переопределяем price_col -> '{price_col}', stock_col -> '{stock_col}' по анализу содержимого."
             )
 
-        results = []
-        
-        for row_idx, row_dict in enumerate(table_rows):
-            try:
-                # Извлекаем имя
-                name = str(row_dict.get(name_col, '')).strip() if name_col else ''
-                
-                # Извлекаем цену
-                price = 0
-                price_raw = ""
-                if price_col:
-                    price_raw = str(row_dict.get(price_col, '')).strip()
-                    if price_raw:
-                        # Зачистка: убираем валюту, пробелы, «руб/₽/tг/eur» и т. д.
-                        clean_price = re.sub(r'[^0-9,\.]', '', price_raw.replace('\xa0', ''))
-                        price_numbers = re.findall(r'[\d\,\.]+', clean_price)
-                        if price_numbers:
-                            try:
-                                price = float(price_numbers[0].replace(',', '.'))
-                            except:
-                                price = 0
-                        else:
-                            logger.debug(
-                                f"Row {row_idx}: цена не распознана из '{price_raw}'. price_numbers пустой."
-                            )
-                
-                # Логируем первые несколько строк для диагностики
-                if row_idx < 5:
-                    logger.info(f"Row {row_idx}: name='{name}', price_raw='{price_raw}', price={price}")
-                
-                # Извлекаем остаток
-                stock = 100  # значение по умолчанию
-                if stock_col:
-                    stock_raw = str(row_dict.get(stock_col, '')).strip()
-                    if stock_raw:
-                        stock_lower = stock_raw.lower()
-                        # текстовые варианты
-                        if any(w in stock_lower for w in ['нет', '0', 'под заказ', 'ожид', 'отсут']):
-                            stock = 0
-                        elif any(w in stock_lower for w in ['есть', 'в наличии', 'налич', 'много']):
-                            stock = 100
-                        else:
-                            stock_numbers = re.findall(r'\d+', stock_raw)
-                            if stock_numbers:
-                                try:
-                                    stock = int(stock_numbers[0])
-                                except:
-                                    stock = 100
-                            elif stock_numbers == []:
-                                logger.debug(f"Row {row_idx}: остаток не распознан из '{stock_raw}'.")
+        # --- ШАГ 2. Колоночное извлечение: каждую нужную колонку достаём один раз,
+        # разбор цены/остатка и фильтрация мусора – векторные операции pandas ---
+        def column_values(col):
+            if not col:
+                return pd.Series('', index=range(len(table_rows)), dtype=object)
+            return pd.Series([row.get(col, '') for row in table_rows], dtype=object).astype(str).str.strip()
+
+        names = column_values(name_col)
+        price_raw = column_values(price_col)
+        stock_raw = column_values(stock_col)
+
+        # Цена: зачистка валюты/пробелов, первое число, запятая -> точка; нераспознанное и <=0 -> 0.0
+        if price_col:
+            if _NUMBA_AVAILABLE:
+                # Компилированное ядро: один проход по байтам всех ячеек без regex
+                prices = pd.Series(_numba_parse_prices(*_flatten_utf8(price_raw.tolist())), index=names.index)
+            else:
+                # Зачистка через str.translate (C-цикл по символам) вместо regex-замены
+                prices = pd.to_numeric(price_raw.str.translate(_PRICE_TRANS), errors='coerce')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Цена не распознана в %d строках", int(prices.isna().sum()))
+            prices = prices.where(prices > 0, 0.0).astype(float)
+        else:
+            prices = pd.Series(0.0, index=names.index)
+
+        # Остаток: текстовые варианты, затем первое целое число; по умолчанию 100
+        if stock_col:
+            stock_lower = stock_raw.str.lower()
+            stock_numbers = pd.to_numeric(stock_raw.str.extract(r'(\d+)', expand=False), errors='coerce').fillna(100)
+            stock = pd.Series(np.select(
+                [
+                    stock_raw == '',
+                    stock_lower.str.contains('нет|0|под заказ|ожид|отсут', regex=True),
+                    stock_lower.str.contains('есть|в наличии|налич|много', regex=True),
+                ],
+                [100, 0, 100],
+                default=stock_numbers,
+            ), index=names.index).astype(int)
+        else:
+            logger.debug("stock_col is None, остаток по умолчанию 100")
+            stock = pd.Series(100, index=names.index)
+
+        # МИНИМАЛЬНАЯ фильтрация - берём почти всё, отсекаем только мусор
+        name_lower = names.str.lower().str.strip()
+        # Заголовок – короткая строка (до 3 слов) с ключевым словом; на слова режем только совпавшие строки
+        header_mask = name_lower.str.contains(_HEADER_JUNK_RE, regex=True)
+        if header_mask.any():
+            header_mask[header_mask] = (name_lower[header_mask].str.split().str.len() <= 3).to_numpy()
+
+        skip_checks = [
+            ('name too short', names.str.len() < 2),
+            # 1. Заголовки таблиц
+            ('table header', header_mask),
+            # 2. Телефоны и факсы
+            ('phone/fax detected', names.str.contains(_PHONE_RE, regex=True)
+                & (name_lower.str.contains(_PHONE_HINT_RE, regex=True) | names.str.contains('+', regex=False))),
+            # 3. Email адреса
+            ('email detected', names.str.contains('@', regex=False) & names.str.contains('.', regex=False)),
+            # 4. Адреса
+            ('address detected', name_lower.str.contains(_ADDR_JUNK_RE, regex=True)),
+            # 5. Только цифры или знаки препинания
+            ('only numbers/punctuation', names.str.match(_NUM_ONLY_RE)),
+            # 6. Общие фразы и мусор
+            ('junk phrase detected', name_lower.str.contains(_PHRASE_JUNK_RE, regex=True)),
+        ]
+        skip_mask = reduce(operator.or_, (mask for _, mask in skip_checks))
+
+        # Логируем первые несколько строк для диагностики (только если INFO включён)
+        if logger.isEnabledFor(logging.INFO):
+            for row_idx in range(min(5, len(table_rows))):
+                name = names.iat[row_idx]
+                logger.info("Row %d: name='%s', price_raw='%s', price=%s",
+                            row_idx, name, price_raw.iat[row_idx], prices.iat[row_idx])
+                reason = next((label for label, mask in skip_checks if mask.iat[row_idx]), None)
+                if reason:
+                    logger.info("Row %d: Skipped - %s: '%s'", row_idx, reason, name)
                 else:
-                    logger.debug(
-                        f"Row {row_idx}: stock_col is None, raw_row={row_dict}"
-                    )
-                
-                # Поставщик = пустая строка (не важно для простой логики)
-                supplier = ""
-                
-                # МИНИМАЛЬНАЯ фильтрация - берём почти всё
-                if not name or len(name) < 2:
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - name too short: '{name}'")
-                    continue
-                    
-                # Если нет цены - ставим 0 (цена неизвестна, но товар есть)
-                if price <= 0:
-                    price = 0.0
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Set price=0 (no price found) for '{name}'")
-                    
-                # УЛУЧШЕННАЯ фильтрация мусора
-                name_lower = name.lower().strip()
-                
-                # 1. Заголовки таблиц (расширено)
-                if any(k in name_lower for k in ['наимен', 'товар', 'цена', 'назв', 'артикул', 'код', 'остаток', 'количество', 'сумма', 'стоим']) and len(name_lower.split())<=3:
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - table header: '{name}'")
-                    continue
-                
-                # 2. Телефоны и факсы
-                if re.search(r'[\+\-\(\)\s]*[\d\-\(\)\s]{7,}', name) and ('тел' in name_lower or 'факс' in name_lower or '+' in name):
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - phone/fax detected: '{name}'")
-                    continue
-                
-                # 3. Email адреса
-                if '@' in name and '.' in name:
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - email detected: '{name}'")
-                    continue
-                
-                # 4. Адреса
-                if any(addr_word in name_lower for addr_word in ['ул.', 'пр.', 'д.', 'кв.', 'офис', 'этаж']):
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - address detected: '{name}'")
-                    continue
-                
-                # 5. Только цифры или знаки препинания
-                if re.match(r'^[\d\s\-\.\,\(\)]+$', name):
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - only numbers/punctuation: '{name}'")
-                    continue
-                
-                # 6. Общие фразы и мусор
-                junk_phrases = ['итого', 'всего', 'сумма', 'подпись', 'печать', 'директор', 'менеджер', 'контакты', 'реквизиты']
-                if any(junk in name_lower for junk in junk_phrases):
-                    if row_idx < 5:
-                        logger.info(f"Row {row_idx}: Skipped - junk phrase detected: '{name}'")
-                    continue
-                    
-                results.append({
-                    'supplier': supplier,
-                    'name': name,
-                    'price': price,
-                    'stock': stock
-                })
-                
-                if row_idx < 5:
-                    logger.info(f"Row {row_idx}: ADDED product: '{name}', price={price}")
-                
-            except Exception as e:
-                logger.warning(f"Error processing row {row_idx}: {e}")
-                continue
-        
-        logger.info(f"Successfully extracted {len(results)} products from {len(table_rows)} rows")
+                    logger.info("Row %d: ADDED product: '%s', price=%s", row_idx, name, prices.iat[row_idx])
+
+        # Поставщик = пустая строка (не важно для простой логики)
+        results = pd.DataFrame({
+            'supplier': '',
+            'name': names,
+            'price': prices,
+            'stock': stock,
+        })[~skip_mask].to_dict(orient='records')
+
+        logger.info("Successfully extracted %d products from %d rows", len(results), len(table_rows))
         
         # Показываем примеры извлеченных товаров
         if results:
-            logger.info(f"Sample extracted products: {results[:3]}")
+            logger.info("Sample extracted products: %s", results[:3])
             
         return results 
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Фоновые задачи: тяжелая обработка (разбор файла, LLM, генерация КП) вне потока запроса.
+
+Очередь живет внутри процесса (пул потоков), внешний брокер не нужен.
+Статус задачи хранится в кэше Django (settings.CACHES, файловый кэш – общий для всех
+воркеров на сервере), поэтому опрос статуса может прийти в любой процесс.
+"""
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from django.core.cache import cache
+from django.db import connection
+from logger import setup_logger
+
+logger = setup_logger()
+
+# Сколько задач выполняется одновременно и сколько секунд хранится статус
+TASK_MAX_WORKERS = 2
+TASK_STATUS_TTL = 60 * 60
+
+_executor = ThreadPoolExecutor(max_workers=TASK_MAX_WORKERS, thread_name_prefix='kp-task')
+
+
+def _job_key(job_id: str) -> str:
+    return f"kp-task:{job_id}"
+
+
+def _set_job(job_id: str, status: str, result: Any = None, error: Optional[str] = None) -> None:
+    cache.set(_job_key(job_id), {'status': status, 'result': result, 'error': error}, TASK_STATUS_TTL)
+
+
+def _run_job(job_id: str, fn: Callable, args: tuple, kwargs: dict) -> None:
+    _set_job(job_id, 'running')
+    try:
+        result = fn(*args, **kwargs)
+        _set_job(job_id, 'done', result=result)
+    except Exception as e:
+        logger.exception(f"Background job {job_id} failed")
+        _set_job(job_id, 'failed', error=str(e))
+    finally:
+        # Соединение с БД открыто в потоке пула, Django само его не закроет
+        connection.close()
+
+
+def submit_job(fn: Callable, *args, **kwargs) -> str:
+    """Ставит fn(*args, **kwargs) в очередь и возвращает id задачи. Результат fn должен сериализоваться pickle."""
+    job_id = uuid.uuid4().hex
+    _set_job(job_id, 'pending')
+    _executor.submit(_run_job, job_id, fn, args, kwargs)
+    return job_id
+
+
+def job_status(job_id: str) -> Optional[Dict[str, Any]]:
+    """Состояние задачи или None, если id неизвестен (или статус устарел)."""
+    return cache.get(_job_key(job_id))
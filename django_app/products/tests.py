@@ -1,3 +1,229 @@
-from django.test import TestCase
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
 
-# Create your tests here.
+# views первым: он добавляет корень проекта в sys.path (модуль logger) для остальных модулей
+from .views import _products_from_items, _products_from_mapped_frame
+from .cache import SemanticCache
+from .cascade_processor import CascadeProcessor
+from .normalization import normalize_dimensions
+from .query_processor import QueryProcessor
+
+nan = np.nan
+
+
+class ProductsFromItemsTests(SimpleTestCase):
+    """Разбор товаров каскадного процессора перед bulk_create в upload_price_list"""
+
+    def test_int_values_are_not_upcast_to_float(self):
+        # В колонке есть пропуски – раньше pandas приводил ее к float и сохранял "1500.0"/"100.0"
+        items = [
+            {'name': 'Труба 57x5', 'price': 1500, 'stock': 100},
+            {'name': 'Отвод 57', 'price': 250},
+        ]
+        products = _products_from_items(items, supplier_id=1, date_str='01.01.2024')
+        self.assertEqual([p.price for p in products], ['1500', '250'])
+        self.assertEqual([p.stock for p in products], ['100', 'в наличии'])
+
+    def test_fields_match_row_by_row_conversion(self):
+        items = [
+            {'name': '  Лист 10 мм ', 'price': 12.5, 'stock': 'под заказ', 'article': 'L-10'},
+            {'full_name': 'Круг 20', 'price': 0},
+            {'name': '', 'price': 100},
+            {'name': 'Уголок 50x5', 'price': 'договорная'},
+        ]
+        products = _products_from_items(items, supplier_id=7, date_str='-')
+        self.assertEqual(
+            [(p.name, p.price, p.stock, p.article) for p in products],
+            [
+                ('Лист 10 мм', '12.5', 'под заказ', 'L-10'),
+                ('Круг 20', '-', 'в наличии', ''),
+                ('Уголок 50x5', '-', 'в наличии', ''),
+            ],
+        )
+        self.assertTrue(all(p.supplier_id == 7 and p.price_list_date == '-' for p in products))
+
+    def test_explicit_none_stock_and_article(self):
+        # Построчный код сохранял str(None) == 'None' в остаток и None в артикул;
+        # явный None обрабатывается как отсутствующее значение
+        items = [{'name': 'Кран шаровой Ду15', 'price': 350, 'stock': None, 'article': None}]
+        products = _products_from_items(items, supplier_id=1, date_str='-')
+        self.assertEqual([(p.stock, p.article) for p in products], [('в наличии', '')])
+
+
+# Ожидаемые значения ниже получены прежними построчными реализациями (цикл по строкам/iterrows)
+# на тех же таблицах – векторный разбор должен давать тот же результат.
+# Экземпляры процессоров создаются без __init__: разбор таблиц не обращается к LLM.
+TABLE_HEADERS = ('Наименование', 'Цена, руб', 'Остаток')
+
+EXTRACT_FROM_TABLE_CASES = [
+    (
+        'prices with commas and currency',
+        [('Труба 57x5 ст.20', '1 500,50 руб', '10'), ('Отвод 90 ГОСТ 17375', '₽ 2300', 'в наличии'),
+         ('Фланец Ду100', '12.5$', 'нет'), ('Задвижка 30с41нж', '', 'под заказ'), ('Кран шаровый', 'abc', 'много')],
+        # '10' содержит '0' – прежняя логика считала такой остаток нулевым
+        [('Труба 57x5 ст.20', 1500.5, 0), ('Отвод 90 ГОСТ 17375', 2300.0, 100), ('Фланец Ду100', 12.5, 0),
+         ('Задвижка 30с41нж', 0.0, 0), ('Кран шаровый', 0.0, 100)],
+    ),
+    (
+        'empty stock',
+        [('Труба 108x6', '5000', ''), ('Лист 10мм', '7 200', '  '), ('Круг ст.45', '300', None), ('Уголок 50x5', '120', '25 шт')],
+        [('Труба 108x6', 5000.0, 100), ('Лист 10мм', 7200.0, 100), ('Круг ст.45', 300.0, 100), ('Уголок 50x5', 120.0, 25)],
+    ),
+    (
+        'junk rows',
+        [('Наименование', 'Цена', 'Остаток'), ('Итого по разделу', '1000', '1'), ('тел. +7 (495) 123-45-67', '', ''),
+         ('info@mail.ru', '', ''), ('ул. Ленина, д. 5', '', ''), ('123-45', '', ''), ('Т', '1', '1'),
+         ('Переход 57x3 ГОСТ 17378', '450', '7')],
+        [('Переход 57x3 ГОСТ 17378', 450.0, 7)],
+    ),
+    (
+        'gost and steel grade keywords',
+        [('Отвод ГОСТ17375-2001 108*6 ст.20 90гр', '980', '12'), ('Труба ст.09г2с ГОСТ 8732', '2 100,00', '0'),
+         ('Заглушка ГОСТ 17379 ст20', '150', 'ожидается')],
+        [('Отвод ГОСТ17375-2001 108*6 ст.20 90гр', 980.0, 12), ('Труба ст.09г2с ГОСТ 8732', 2100.0, 0),
+         ('Заглушка ГОСТ 17379 ст20', 150.0, 0)],
+    ),
+]
+
+
+class ExtractProductsFromTableTests(SimpleTestCase):
+    def test_matches_row_loop(self):
+        processor = QueryProcessor.__new__(QueryProcessor)
+        for label, rows, expected in EXTRACT_FROM_TABLE_CASES:
+            with self.subTest(label):
+                table_rows = [dict(zip(TABLE_HEADERS, row)) for row in rows]
+                products = processor.extract_products_from_table(table_rows)
+                self.assertEqual([(p['name'], p['price'], p['stock']) for p in products], expected)
+                self.assertTrue(all(p['supplier'] == '' for p in products))
+
+
+SUBHEADER_COLUMNS = ['Наименование', 'Цена', 'Остаток']
+
+SUBHEADER_CASES = [
+    (
+        'prices with commas and currency',
+        [['Труба 57x5', '1 234,56', '10'], ['Отвод 90', '1.234,56 руб', 'в наличии'], ['Фланец Ду100', '\xa02 300', 'нет'],
+         ['Кран', '-', nan], ['Заглушка', 'договорная', '5 шт']],
+        [('Труба 57x5', 1234.56, 0), ('Отвод 90', 1234.56, 100), ('Фланец Ду100', 2300.0, 0), ('Кран', 0.0, 100),
+         ('Заглушка', 0.0, 5)],
+    ),
+    (
+        'empty stock',
+        [['Лист 10мм', '7200', nan], ['Круг ст.45', '300', ''], ['Уголок', '120', 'nan'], ['Швеллер', '99.90', 'под заказ']],
+        [('Лист 10мм', 7200.0, 100), ('Круг ст.45', 300.0, 100), ('Уголок', 120.0, 100), ('Швеллер', 99.9, 0)],
+    ),
+    (
+        'subheader rows',
+        [['Трубы стальные', nan, nan], ['57x5 ГОСТ 8732', '1500', '12'], ['108x6 ст.20', '2100', ''], ['Отводы', '', ' '],
+         ['90гр ГОСТ 17375', '450', 'много'], [nan, '1', 1], ['nan', '2', '3']],
+        [('Трубы стальные 57x5 ГОСТ 8732', 1500.0, 12), ('Трубы стальные 108x6 ст.20', 2100.0, 100),
+         ('Отводы 90гр ГОСТ 17375', 450.0, 100)],
+    ),
+    (
+        'gost and steel grade keywords',
+        [['Отвод ГОСТ17375-2001 108*6 ст.20', '980', '0'], ['Задвижка 30с41нж Ду50', '12 000,00', 'ожидается']],
+        [('Отвод ГОСТ17375-2001 108*6 ст.20', 980.0, 0), ('Задвижка 30с41нж Ду50', 12000.0, 0)],
+    ),
+]
+
+
+class ExtractProductsWithSubheadersTests(SimpleTestCase):
+    def test_matches_row_loop(self):
+        processor = CascadeProcessor.__new__(CascadeProcessor)
+        for label, rows, expected in SUBHEADER_CASES:
+            with self.subTest(label):
+                df = pd.DataFrame(rows, columns=SUBHEADER_COLUMNS)
+                products = processor._extract_products_with_subheaders(df, 'Наименование', 'Цена', 'Остаток', [], {})
+                self.assertEqual([(p['name'], p['price'], p['stock']) for p in products], expected)
+
+    def test_without_stock_column_defaults_to_100(self):
+        processor = CascadeProcessor.__new__(CascadeProcessor)
+        df = pd.DataFrame(SUBHEADER_CASES[0][1], columns=SUBHEADER_COLUMNS)
+        products = processor._extract_products_with_subheaders(df, 'Наименование', 'Цена', None, [], {})
+        self.assertEqual([p['stock'] for p in products], [100] * 5)
+
+
+MAPPED_FRAME_CASES = [
+    (
+        'prices with commas and currency',
+        {'name': ['Труба 57x5', ' Отвод 90 ', 'Фланец', 'Кран', 'Лист', nan, '  '],
+         'price': ['1 500,50 руб', '₽2300', '1.234,56', 'договорная', nan, '100', '5'],
+         'stock': ['10 шт', 'в наличии', 'под заказ', 'есть', nan, '1', '2']},
+        [('Труба 57x5', 1500.5, 10), ('Отвод 90', 2300.0, 100)],
+    ),
+    (
+        'empty stock',
+        {'name': ['Круг ст.45', 'Уголок', 'Швеллер'], 'price': ['300', '120', '99.90'], 'stock': [nan, '', 'нет']},
+        [('Круг ст.45', 300.0, 100), ('Уголок', 120.0, 0), ('Швеллер', 99.9, 0)],
+    ),
+    (
+        'gost and steel grade keywords, no stock column',
+        {'name': ['Отвод ГОСТ17375-2001 108*6 ст.20', 'Заглушка ГОСТ 17379 ст20'], 'price': ['980', '150,5']},
+        [('Отвод ГОСТ17375-2001 108*6 ст.20', 980.0, 100), ('Заглушка ГОСТ 17379 ст20', 150.5, 100)],
+    ),
+]
+
+
+class ManualMappingFrameTests(SimpleTestCase):
+    def test_matches_iterrows_loop(self):
+        for label, columns, expected in MAPPED_FRAME_CASES:
+            with self.subTest(label):
+                df = pd.DataFrame(columns, dtype=object)
+                products = _products_from_mapped_frame(df, supplier_id=1, file_date='-')
+                self.assertEqual([(p.name, p.price, p.stock) for p in products], expected)
+
+
+RELEVANCE_NAMES = [
+    'Отвод ГОСТ17375-2001 108x6 ст.20 90гр', 'Отвод 108x6 ст.20', 'Отвод 57x5 ст.20', 'Труба 108x6 ст.20 ГОСТ 8732',
+    'Задвижка ДУ300 30с41нж', 'Задвижка ДУ400 30с41нж', 'Фланец Ду100 Ру16 ст.20', 'Редуктор',
+    'Отвод ГОСТ 17375 108*6 ст.09г2с', 'фланец',
+]
+
+RELEVANCE_CASES = [
+    ('Отвод ГОСТ17375-2001 108x6 ст.20 90гр', ['Отвод', 'ГОСТ17375-2001', '108x6', 'ст.20', '90гр'],
+     [1000, 350, 250, 150, 0, 0, 110, 0, 180, 0]),
+    ('задвижка ДУ300', ['задвижка', 'ДУ300'], [0, 0, 0, 0, 500, 55, 0, 0, 0, 0]),
+    ('фланец', ['фланец'], [0, 0, 0, 0, 0, 0, 500, 0, 0, 1000]),
+    ('отвод 108x6', ['отвод', '108x6'], [260, 500, 110, 200, 0, 0, 0, 0, 260, 0]),
+    ('труба ст.20 гост', ['труба', 'ст.20', 'гост'], [280, 150, 150, 380, 0, 0, 150, 0, 0, 0]),
+]
+
+
+class RelevanceScoreTests(SimpleTestCase):
+    def test_keyword_masks_match_substring_loop(self):
+        processor = QueryProcessor.__new__(QueryProcessor)
+        names = [normalize_dimensions(name).lower().strip() for name in RELEVANCE_NAMES]
+        for query, keywords, expected in RELEVANCE_CASES:
+            with self.subTest(query):
+                query_norm = normalize_dimensions(query).lower().strip()
+                masks = processor._keyword_masks(names, keywords)
+                with_masks = [
+                    processor._calculate_relevance_score(name, keywords, query_norm, keyword_mask=mask)
+                    for name, mask in zip(names, masks)
+                ]
+                without_masks = [processor._calculate_relevance_score(name, keywords, query_norm) for name in names]
+                self.assertEqual(with_masks, expected)
+                self.assertEqual(without_masks, expected)
+
+
+class SemanticKeywordCacheTests(SimpleTestCase):
+    """Семантическое попадание в кэш ключевых слов проверяется по тексту запроса"""
+
+    def setUp(self):
+        # Все ключи получают один и тот же эмбеддинг – любой сосед с теми же числами считается похожим
+        self.processor = QueryProcessor.__new__(QueryProcessor)
+        self.processor.keyword_cache = SemanticCache(lambda text: [1.0, 0.0], store=None, namespace='keywords')
+        cached_query = normalize_dimensions('задвижка клиновая стальная фланцевая ду50'.lower())
+        self.processor.keyword_cache.set(cached_query, ['задвижка', 'клиновая', 'стальная', 'фланцевая', 'ду50'])
+
+    def test_neighbour_with_other_material_is_a_miss(self):
+        query = normalize_dimensions('задвижка клиновая чугунная фланцевая ду50'.lower())
+        keywords, vector = self.processor._cached_keywords(query)
+        self.assertIsNone(keywords)
+        self.assertIsNotNone(vector)
+
+    def test_neighbour_with_same_words_is_a_hit(self):
+        query = normalize_dimensions('фланцевая задвижка клиновая стальная ду50'.lower())
+        keywords, _ = self.processor._cached_keywords(query)
+        self.assertEqual(keywords, ['задвижка', 'клиновая', 'стальная', 'фланцевая', 'ду50'])
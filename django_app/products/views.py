@@ -6,27 +6,33 @@ from django.contrib import messages
 from .models import Supplier, Product, Proposal, SearchQuery
 from django import forms
 import pandas as pd
+import numpy as np
+import itertools
+from functools import lru_cache
 import re # ВОССТАНАВЛИВАЕМ re для старого парсера/извлечения
 from django.http import HttpResponse, FileResponse, JsonResponse
 from django.template.loader import render_to_string
 import tempfile
 import openpyxl
-from openpyxl.styles import Alignment, Font, Border, Side
-from django.core.files import File
+from openpyxl.styles import Alignment, Font, Border, Side, NamedStyle
+from openpyxl.cell import WriteOnlyCell
+from django.core.files.base import ContentFile
 from django.views.decorators.csrf import csrf_exempt
 # Импортируем QueryProcessor и зависимости
-from .query_processor import QueryProcessor, extract_quantity
+from .query_processor import QueryProcessor, extract_quantity, clear_text_caches
+from .tasks import submit_job, job_status
 # from .data_loader import DataLoader # DataLoader все еще не нужен
 from .cache import QueryCache
 from django.core.files.uploadedfile import UploadedFile
 import docx, PyPDF2
-import chardet
+from .client_request_extractor import detect_encoding
 import logging
 import csv
 import io
 from logger import setup_logger  # <--- добавил импорт
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
 from django.urls import reverse # Добавили reverse
+from django.db import transaction
 import json
 # Закомментирую проблемный импорт
 from .analytics import SystemAnalytics, get_quick_stats
@@ -44,36 +50,63 @@ class PriceListUploadForm(forms.Form):
     supplier_name = forms.CharField(label='Поставщик', required=False)
     date_str = forms.CharField(label='Дата (ГГГГ-ММ-ДД)', required=False)
 
+# Дата прайса в имени файла: ДД.ММ.ГГГГ или ДД.ММ.ГГ, разделители . _ -
+_FILENAME_DATE_RE = re.compile(r'(\d{2})[._-](\d{2})[._-]((?:20)?\d{2})')
+
+
+def _filename_date(date_match) -> str:
+    """ДД.ММ.ГГГГ из совпадения _FILENAME_DATE_RE (короткий год 25 -> 2025)."""
+    day, month, year = date_match.groups()
+    return f"{day}.{month}.{'20' + year if len(year) == 2 else year}"
+
+# Строк на один INSERT при замене прайса (на SQLite Django сам уменьшает пачку до лимита параметров)
+_PRODUCT_BULK_BATCH_SIZE = 1000
+
+# Колонки, которые читает старый парсер; остальные колонки прайса в память не загружаются
+_PARSE_PRICE_LIST_COLUMNS = frozenset(['Поставщик', 'Наименование изделия', 'Ду (мм)', 'Диаметр', 'Ру (МПа)', 'Давление', 'Цена руб.'])
+_PARSE_PRICE_LIST_CHUNK_ROWS = 5000
+
 # ВОССТАНАВЛИВАЕМ СТАРЫЙ ПАРСЕР (на всякий случай, хотя upload_price_list использует ИИ)
 def parse_price_list(file):
+    usecols = lambda col: col in _PARSE_PRICE_LIST_COLUMNS
     if file.name.endswith('.csv'):
-        df = pd.read_csv(file)
+        # CSV читаем кусками – в памяти одновременно не больше _PARSE_PRICE_LIST_CHUNK_ROWS строк
+        chunks = pd.read_csv(file, usecols=usecols, chunksize=_PARSE_PRICE_LIST_CHUNK_ROWS)
     elif file.name.endswith(('.xlsx', '.xls')):
-        df = pd.read_excel(file)
+        chunks = [pd.read_excel(file, usecols=usecols)]
     else:
         raise ValueError('Неподдерживаемый формат файла. Используйте CSV или Excel.')
     products = []
     # Определяем имя поставщика из файла или имени файла
     file_supplier = os.path.splitext(os.path.basename(file.name))[0].split()[0] if os.path.splitext(os.path.basename(file.name))[0] else 'Неизвестный'
-    for idx, row in df.iterrows():
-        # Пробуем взять из столбца 'Поставщик', иначе из имени файла
-        supplier_name = str(row.get('Поставщик', file_supplier)).strip()
-        if not supplier_name:
-            supplier_name = 'Неизвестный поставщик'
-        name = str(row.get('Наименование изделия', '')).strip()
-        # Пытаемся найти столбцы для характеристик (пример)
-        diameter = str(row.get('Ду (мм)', '') or row.get('Диаметр', '')).strip()
-        pressure = str(row.get('Ру (МПа)', '') or row.get('Давление', '')).strip()
-        price = row.get('Цена руб.') # Пример названия столбца цены
-
-        if pd.notnull(price) and name:
-            products.append({
-                'supplier_name': supplier_name,
-                'name': name,
-                'diameter': diameter, # Пример
-                'pressure': pressure, # Пример
-                'price': price,
-            })
+    for df in chunks:
+        # Наличие колонок проверяется один раз на кусок, строки идут по спискам значений колонок
+        column = lambda key, default='': df[key].tolist() if key in df.columns else [default] * len(df)
+        rows = zip(
+            column('Поставщик', file_supplier),
+            column('Наименование изделия'),
+            column('Ду (мм)'), column('Диаметр'),
+            column('Ру (МПа)'), column('Давление'),
+            column('Цена руб.', None),  # Пример названия столбца цены
+        )
+        for supplier_raw, name_raw, dn, diameter_alt, pn, pressure_alt, price in rows:
+            # Пробуем взять из столбца 'Поставщик', иначе из имени файла
+            supplier_name = str(supplier_raw).strip()
+            if not supplier_name:
+                supplier_name = 'Неизвестный поставщик'
+            name = str(name_raw).strip()
+            # Пытаемся найти столбцы для характеристик (пример)
+            diameter = str(dn or diameter_alt).strip()
+            pressure = str(pn or pressure_alt).strip()
+
+            if pd.notnull(price) and name:
+                products.append({
+                    'supplier_name': supplier_name,
+                    'name': name,
+                    'diameter': diameter, # Пример
+                    'pressure': pressure, # Пример
+                    'price': price,
+                })
     return products
 
 
@@ -81,62 +114,152 @@ logger = setup_logger()
 query_cache = QueryCache()
 query_processor = QueryProcessor(query_cache) # Теперь переменные точно доступны
 
+# Ключевые слова строки заголовков прайса – одна альтернация на ячейку вместо any(kw in cell) по списку
+_HEADER_CELL_KEYWORDS = ['наимен', 'товар', 'артикул', 'код', 'цена', 'стоим', 'кол-во', 'остат', 'вес', 'ед',
+                         'unit', 'sku', 'product', 'name', 'amount', 'qty', 'quantity']
+_HEADER_CELL_SHORT_KEYWORDS = ['наимен', 'товар', 'цена', 'кол-во']  # Упрощенный набор для поиска
+_HEADER_CELL_RE = re.compile('|'.join(re.escape(kw) for kw in _HEADER_CELL_KEYWORDS))
+_HEADER_CELL_SHORT_RE = re.compile('|'.join(re.escape(kw) for kw in _HEADER_CELL_SHORT_KEYWORDS))
+
+def _count_header_cells(row, keywords_re) -> int:
+    """Число непустых ячеек строки, содержащих хотя бы одно ключевое слово заголовка."""
+    return sum(1 for cell in row if pd.notna(cell) and cell != '' and keywords_re.search(str(cell).lower()))
+
+
+def _first_header_row(df: pd.DataFrame, keywords_re, min_matches: int = 2) -> Optional[int]:
+    """
+    Индекс первой строки df, где не меньше min_matches непустых ячеек содержат ключевое слово заголовка.
+    Все ячейки образца проверяются одним проходом str.contains, а не циклом по строкам.
+    """
+    if df.empty:
+        return None
+    cells = pd.Series(df.to_numpy(dtype=object).ravel())
+    row_labels = np.repeat(df.index.to_numpy(), df.shape[1])
+    filled = (cells.notna() & (cells != '')).to_numpy()
+    texts = cells[filled].astype(str).str.lower()
+    hits = texts.str.contains(keywords_re, regex=True).to_numpy()
+    per_row = pd.Series(hits, index=row_labels[filled]).groupby(level=0, sort=False).sum()
+    found = per_row.index[per_row.to_numpy() >= min_matches]
+    return int(found[0]) if len(found) else None
+
+
+# Сигнатуры Excel-файлов: zip (xlsx) и OLE2 (старый xls)
+_XLSX_MAGIC = b'PK\x03\x04'
+_OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+
+
+@lru_cache(maxsize=64)
+def _excel_engine_for(file_path: str, mtime_ns: int) -> Optional[str]:
+    with open(file_path, 'rb') as f:
+        magic = f.read(len(_OLE2_MAGIC))
+    if magic.startswith(_XLSX_MAGIC):
+        return 'openpyxl'
+    if magic == _OLE2_MAGIC:
+        return 'xlrd'
+    return None  # pandas выберет движок сам
+
+
+def _excel_engine(file_path: str) -> Optional[str]:
+    """
+    Движок read_excel по первым байтам файла, а не по расширению – вместо цепочки попыток
+    xlrd -> openpyxl -> по умолчанию. Результат запоминается для (путь, mtime).
+    """
+    return _excel_engine_for(file_path, os.stat(file_path).st_mtime_ns)
+
+
+def _iter_xlsx_rows(file_path: str):
+    """Значения строк первого листа .xlsx (read_only: объекты ячеек и стили не создаются)."""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+
+def _header_labels(cells) -> List[str]:
+    """
+    Подписи колонок из строки заголовков, как их получает pandas: пустая ячейка -> 'nan',
+    повторы -> 'Цена', 'Цена.1', 'Цена.2'.
+    """
+    raw = ['nan' if cell is None else str(cell) for cell in cells]
+    taken = set(raw)  # суффикс не должен совпасть с уже существующей подписью ('Цена.1' в самом файле)
+    labels = []
+    counts: Dict[str, int] = {}
+    for label in raw:
+        base = label
+        cur_count = counts.get(base, 0)
+        while cur_count > 0:
+            counts[base] = cur_count + 1
+            label = f"{base}.{cur_count}"
+            cur_count = cur_count + 1 if label in taken else counts.get(label, 0)
+        counts[label] = cur_count + 1
+        labels.append(label)
+    return labels
+
+
+_CSV_DELIMITERS = (',', ';', '\t', '|')
+
+
+def _guess_delimiter(sample: str) -> str:
+    """
+    Разделитель CSV по частоте символов в строках образца (вместо csv.Sniffer).
+    Побеждает кандидат, встречающийся одинаковое число раз в большинстве строк (шапка прайса может отличаться).
+    """
+    lines = [line for line in sample.splitlines()[:-1] or sample.splitlines() if line.strip()]  # последняя строка образца обрезана
+    best, best_score = ',', (0, 0)
+    for delim in _CSV_DELIMITERS:
+        counts = [line.count(delim) for line in lines]
+        nonzero = [c for c in counts if c]
+        if not nonzero:
+            continue
+        most_common = max(set(nonzero), key=nonzero.count)
+        score = (counts.count(most_common), sum(nonzero))
+        if score > best_score:
+            best, best_score = delim, score
+    return best
+
+
 def find_header_row_and_read_data(file_path: str, file_ext: str, encoding: Optional[str] = None, delimiter: Optional[str] = None, n_sample_rows: int = 10) -> Tuple[List[str], pd.DataFrame]:
     """
     Ищет строку с заголовками по ключевым словам и возвращает (заголовки, DataFrame с данными начиная с этой строки).
+    Файл целиком не разбирается: читаются только строки до заголовка и n_sample_rows строк данных.
     """
-    # Ключевые слова для поиска заголовков
-    header_keywords = [
-        'наимен', 'товар', 'артикул', 'код', 'цена', 'стоим', 'кол-во', 'остат', 'вес', 'ед', 'unit', 'sku', 'product', 'name', 'amount', 'qty', 'quantity'
-    ]
     max_scan_rows = 20
-    if file_ext in ['.xlsx', '.xls']:
+    if file_ext == '.xlsx':
         try:
-            # Выбираем движок в зависимости от формата
-            engine = None
-            if file_ext == '.xls':
-                try:
-                    df_all = pd.read_excel(file_path, header=None, nrows=max_scan_rows, engine='xlrd')
-                except:
-                    try:
-                        df_all = pd.read_excel(file_path, header=None, nrows=max_scan_rows, engine='openpyxl')
-                    except:
-                        df_all = pd.read_excel(file_path, header=None, nrows=max_scan_rows)
-            else:
-                df_all = pd.read_excel(file_path, header=None, nrows=max_scan_rows)
+            # Один потоковый проход по листу: те же строки идут и в поиск заголовка, и в образец данных
+            rows_iter = _iter_xlsx_rows(file_path)
+            scan_rows = list(itertools.islice(rows_iter, max_scan_rows))
+            header_row_idx = _first_header_row(pd.DataFrame(scan_rows), _HEADER_CELL_RE) if scan_rows else None
+            if header_row_idx is None:
+                header_row_idx = 0  # Если не нашли — заголовки в первой строке
+            if header_row_idx >= len(scan_rows):
+                return [], pd.DataFrame()
+            headers = _header_labels(scan_rows[header_row_idx])
+            data_rows = scan_rows[header_row_idx + 1:header_row_idx + 1 + n_sample_rows]
+            data_rows += itertools.islice(rows_iter, n_sample_rows - len(data_rows))
+            df = pd.DataFrame(data_rows, columns=headers, dtype=object)
+            # Как read_excel(dtype=str): значения строками, пустые ячейки – NaN
+            return headers, df.where(df.isna(), df.astype(str))
+        except Exception as e:
+            raise ValueError(f"Ошибка чтения Excel файла: {e}")
+    elif file_ext == '.xls':
+        try:
+            # Движок по сигнатуре файла (под .xls нередко лежит xlsx)
+            engine = _excel_engine(file_path)
+            df_all = pd.read_excel(file_path, header=None, nrows=max_scan_rows, engine=engine)
             
-            for idx, row in df_all.iterrows():
-                row_strs = [str(cell).lower() for cell in row if pd.notna(cell)]
-                matches = sum(any(kw in cell for kw in header_keywords) for cell in row_strs)
-                if matches >= 2:
-                    # Нашли строку с заголовками
-                    header_row_idx = idx
-                    headers = [str(cell) for cell in row]
-                    # Читаем данные начиная со следующей строки
-                    if file_ext == '.xls':
-                        try:
-                            df = pd.read_excel(file_path, header=header_row_idx, dtype=str, engine='xlrd')
-                        except:
-                            try:
-                                df = pd.read_excel(file_path, header=header_row_idx, dtype=str, engine='openpyxl')
-                            except:
-                                df = pd.read_excel(file_path, header=header_row_idx, dtype=str)
-                    else:
-                        df = pd.read_excel(file_path, header=header_row_idx, dtype=str)
-                    return headers, df.head(n_sample_rows)
+            header_row_idx = _first_header_row(df_all, _HEADER_CELL_RE)
+            if header_row_idx is not None:
+                # Нашли строку с заголовками
+                headers = [str(cell) for cell in df_all.loc[header_row_idx].tolist()]
+                # Читаем данные начиная со следующей строки
+                df = pd.read_excel(file_path, header=header_row_idx, dtype=str, engine=engine, nrows=n_sample_rows)
+                return headers, df
             # Если не нашли — читаем как обычно
-            if file_ext == '.xls':
-                try:
-                    df = pd.read_excel(file_path, header=0, dtype=str, engine='xlrd')
-                except:
-                    try:
-                        df = pd.read_excel(file_path, header=0, dtype=str, engine='openpyxl')
-                    except:
-                        df = pd.read_excel(file_path, header=0, dtype=str)
-            else:
-                df = pd.read_excel(file_path, header=0, dtype=str)
+            df = pd.read_excel(file_path, header=0, dtype=str, engine=engine, nrows=n_sample_rows)
             headers = df.columns.tolist()
-            return headers, df.head(n_sample_rows)
+            return headers, df
         except Exception as e:
             raise ValueError(f"Ошибка чтения Excel файла: {e}")
     elif file_ext == '.csv':
@@ -144,36 +267,44 @@ def find_header_row_and_read_data(file_path: str, file_ext: str, encoding: Optio
         if not encoding:
             with open(file_path, 'rb') as f:
                 rawdata = f.read(5000)
-                encoding_result = chardet.detect(rawdata)
-                encoding = encoding_result['encoding'] if encoding_result else 'utf-8'
+                encoding = detect_encoding(rawdata)
         if not delimiter:
             with io.TextIOWrapper(open(file_path, 'rb'), encoding=encoding, newline='') as f_text:
                 sample_csv = f_text.read(1024)
-                sniffer = csv.Sniffer()
-                try:
-                    dialect = sniffer.sniff(sample_csv)
-                    delimiter = dialect.delimiter
-                except csv.Error:
-                    delimiter = ','
+                delimiter = _guess_delimiter(sample_csv)
         # Сканируем первые строки
         with open(file_path, encoding=encoding, newline='') as f:
             reader = csv.reader(f, delimiter=delimiter)
-            rows = list(reader)[:max_scan_rows]
+            rows = list(itertools.islice(reader, max_scan_rows))
         for idx, row in enumerate(rows):
-            row_strs = [str(cell).lower() for cell in row if cell]
-            matches = sum(any(kw in cell for kw in header_keywords) for cell in row_strs)
+            matches = _count_header_cells(row, _HEADER_CELL_RE)
             if matches >= 2:
                 header_row_idx = idx
                 headers = [str(cell) for cell in row]
-                df = pd.read_csv(file_path, header=header_row_idx, sep=delimiter, encoding=encoding, dtype=str)
-                return headers, df.head(n_sample_rows)
+                df = pd.read_csv(file_path, header=header_row_idx, sep=delimiter, encoding=encoding, dtype=str, nrows=n_sample_rows)
+                return headers, df
         # Если не нашли — читаем как обычно
-        df = pd.read_csv(file_path, header=0, sep=delimiter, encoding=encoding, dtype=str)
+        df = pd.read_csv(file_path, header=0, sep=delimiter, encoding=encoding, dtype=str, nrows=n_sample_rows)
         headers = df.columns.tolist()
-        return headers, df.head(n_sample_rows)
+        return headers, df
     else:
         raise ValueError(f"Unsupported file type: {file_ext}")
 
+def _frame_below_header(df_raw: pd.DataFrame, header_row_idx: int, columns: List[str]) -> pd.DataFrame:
+    """
+    Данные под строкой заголовков листа, прочитанного с header=None, только колонки columns.
+    Заменяет повторный read_excel(header=..., usecols=...); одноименные колонки различаются
+    суффиксами .1, .2, как в pandas и в заголовках find_header_row_and_read_data.
+    """
+    columns = list(dict.fromkeys(columns))  # как usecols: повтор колонки не дублирует ее
+    positions = {label: pos for pos, label in enumerate(_header_labels(df_raw.iloc[header_row_idx].tolist()))}
+    missing = [col for col in columns if col not in positions]
+    if missing:
+        raise ValueError(f"В файле не найдены колонки: {missing}")
+    df = df_raw.iloc[header_row_idx + 1:, [positions[col] for col in columns]]
+    df.columns = columns
+    return df.reset_index(drop=True)
+
 # --- Добавляем форму для ручного маппинга ---
 class ManualMappingForm(forms.Form):
     file_path = forms.CharField(widget=forms.HiddenInput())
@@ -196,10 +327,83 @@ class ManualMappingForm(forms.Form):
         self.fields['article_col'].choices = optional_choices
 # --- Конец формы --- 
 
+def _products_from_items(items: list, supplier_id: int, date_str: str) -> list:
+    """
+    Товары каскадного процессора (список dict) -> несохраненные Product.
+    Поля приводятся колонками, в цикле остается только создание Product.
+    """
+    # dtype=object: значения остаются как есть, иначе pandas приводит колонку с пропусками
+    # к float и цена 1500 сохраняется как "1500.0"
+    items_df = pd.DataFrame(items, dtype=object)
+    column = lambda key: items_df[key] if key in items_df else pd.Series(None, index=items_df.index, dtype=object)
+    # Каскадный процессор может возвращать товары с ключом 'name' или 'full_name'
+    names = column('name')
+    names = names.where(names.notna() & (names != ''), column('full_name'))
+    names = names.fillna('').astype(str).str.strip()
+    has_name = (names != '').to_numpy()
+    if not has_name.all():
+        logger.warning(f"Пропущено строк без имени товара: {int((~has_name).sum())}")
+    # Цена: положительное число -> строка, остальное -> '-'
+    raw_prices = column('price')
+    prices = raw_prices.astype(str).where(pd.to_numeric(raw_prices, errors='coerce') > 0, '-')
+    # Явный None в остатке/артикуле – как отсутствующее значение (а не строка 'None')
+    stocks = column('stock').fillna('в наличии').astype(str)
+    articles = column('article').fillna('')
+    return [
+        Product(
+            supplier_id=supplier_id,
+            name=name,
+            price=price_str,
+            stock=stock,
+            article=article,
+            price_list_date=date_str
+        )
+        for name, price_str, stock, article in zip(
+            names[has_name].tolist(), prices[has_name].tolist(),
+            stocks[has_name].tolist(), articles[has_name].tolist(),
+        )
+    ]
+
+
+def _products_from_mapped_frame(df: pd.DataFrame, supplier_id: int, file_date: str) -> list:
+    """
+    Прайс по ручному маппингу (колонки уже переименованы в name/price/stock) -> несохраненные Product.
+    Строки без названия или с неразборчивой ценой пропускаются.
+    """
+    # Колонки разбираются целиком (str-операции pandas), без iterrows по строкам
+    column = lambda key: df[key] if key in df else pd.Series(None, index=df.index, dtype=object)
+    names = column('name')
+    names = names.where(names.isna(), names.astype(str).str.strip())
+    # Цена: оставляем цифры и разделители, запятая -> точка; неразборчивая цена -> строка пропускается
+    price_digits = column('price').astype(str).str.replace(r'[^0-9.,]', '', regex=True).str.replace(',', '.', regex=False)
+    prices = pd.to_numeric(price_digits, errors='coerce')
+    keep = (names.notna() & (names != '') & prices.notna()).to_numpy()
+    # Остаток: "в наличии"/"есть" -> 100, "под заказ" -> 0, иначе число из строки; пусто -> 100
+    stock_raw = column('stock')
+    stock_text = stock_raw.astype(str).str.lower()
+    stock_digits = pd.to_numeric(stock_text.str.replace(r'[^0-9]', '', regex=True), errors='coerce').fillna(0)
+    stocks = np.select(
+        [stock_raw.isna().to_numpy(),
+         stock_text.str.contains('наличи|есть', regex=True).to_numpy(),
+         stock_text.str.contains('заказ', regex=False).to_numpy()],
+        [100, 100, 0],
+        default=stock_digits.to_numpy(),
+    ).astype('int64')
+    return [
+        Product(
+            supplier_id=supplier_id,
+            name=name,
+            price=price,
+            stock=stock,
+            price_list_date=file_date  # Дата из имени файла
+        )
+        for name, price, stock in zip(names[keep].tolist(), prices[keep].tolist(), stocks[keep].tolist())
+    ]
+
+
 @csrf_exempt
 def upload_price_list(request):
-    import logging
-    logging.getLogger().info("upload_price_list CALLED")
+    logger.info("upload_price_list CALLED")
     if request.method == 'POST':
         form = PriceListUploadForm(request.POST, request.FILES)
         if form.is_valid():
@@ -208,14 +412,9 @@ def upload_price_list(request):
             supplier_name = None
             date_str = None
             # Ищем дату в разных форматах: ДД.ММ.ГГГГ или ДД.ММ.ГГ
-            date_match = re.search(r'(\d{2}[._-]\d{2}[._-](?:20)?\d{2})', file_base)
+            date_match = _FILENAME_DATE_RE.search(file_base)
             if date_match:
-                date_raw = date_match.group(1)
-                # Нормализуем дату: заменяем _ и . на -, добавляем 20 для коротких годов
-                date_str = date_raw.replace('_', '.').replace('-', '.')
-                if len(date_str.split('.')[-1]) == 2:  # короткий год (25 -> 2025)
-                    parts = date_str.split('.')
-                    date_str = f"{parts[0]}.{parts[1]}.20{parts[2]}"
+                date_str = _filename_date(date_match)
                 
                 # Определяем поставщика (все что после даты или до даты)
                 if date_match.start() == 0:  # дата в начале
@@ -252,34 +451,18 @@ def upload_price_list(request):
                     products_to_save = result['products']
                     logger.info(f"Каскадный процессор извлек {len(products_to_save)} товаров")
                     logger.info(f"Первые 3 товара для отладки: {products_to_save[:3]}")
-                    Product.objects.filter(supplier=supplier).delete()
-                    logger.info(f"Удалены старые товары для поставщика {supplier.name}.")
-
-                    products_to_create = []
-                    for item in products_to_save:
-                        # Каскадный процессор может возвращать товары с ключом 'name' или 'full_name'
-                        name = item.get('name') or item.get('full_name')
-                        if not name or not str(name).strip():
-                            logger.warning(f"Пропущена строка без имени товара: {item}")
-                            continue
-                        
-                        # Обрабатываем цену правильно
-                        price_value = item.get('price', '-')
-                        if isinstance(price_value, (int, float)) and price_value > 0:
-                            price_str = str(price_value)
-                        else:
-                            price_str = '-'
-                        
-                        products_to_create.append(Product(
-                            supplier=supplier,
-                            name=str(name).strip(),
-                            price=price_str,
-                            stock=str(item.get('stock', 'в наличии')),
-                            article=item.get('article', ''),
-                            price_list_date=date_str
-                        ))
-
-                    Product.objects.bulk_create(products_to_create)
+                    # Поставщик один на весь прайс: ставим supplier_id, а не объект – присваивание
+                    # объекта через дескриптор FK на каждой строке проверяет БД и роутер заново
+                    products_to_create = _products_from_items(products_to_save, supplier.pk, date_str)
+
+                    # Замена товаров поставщика – одна транзакция: удаление и вставка пачками,
+                    # а не отдельный коммит на каждый INSERT (и без окна, когда у поставщика нет товаров)
+                    with transaction.atomic():
+                        Product.objects.filter(supplier=supplier).delete_fast()
+                        logger.info(f"Удалены старые товары для поставщика {supplier.name}.")
+                        Product.objects.bulk_create(products_to_create, batch_size=_PRODUCT_BULK_BATCH_SIZE)
+                    # Старые названия поставщика больше не встретятся – освобождаем кэши нормализации
+                    clear_text_caches()
                     messages.success(request, f"Прайс-лист успешно обработан ({result.get('final_method', '')}). Добавлено {len(products_to_create)} товаров.")
                     logger.info(f"Сводка обработки:\n{cascade_processor.get_cascade_summary(result)}")
 
@@ -340,54 +523,25 @@ def manual_column_mapping(request):
                     
                 # Находим строку с заголовками (для корректного usecols)
                 header_row_idx = -1
-                header_keywords = ['наимен', 'товар', 'цена', 'кол-во'] # Упрощенный набор для поиска
                 if file_ext in ['.xlsx', '.xls']:
-                    if file_ext == '.xls':
-                        try:
-                            df_check = pd.read_excel(file_path, header=None, nrows=20, dtype=str, engine='xlrd')
-                        except:
-                            try:
-                                df_check = pd.read_excel(file_path, header=None, nrows=20, dtype=str, engine='openpyxl')
-                            except:
-                                df_check = pd.read_excel(file_path, header=None, nrows=20, dtype=str)
-                    else:
-                        df_check = pd.read_excel(file_path, header=None, nrows=20, dtype=str)
-                    for idx, row in df_check.iterrows():
-                         row_strs = [str(cell).lower() for cell in row if pd.notna(cell)]
-                         matches = sum(any(kw in cell for kw in header_keywords) for cell in row_strs)
-                         if matches >= 2:
-                              header_row_idx = idx
-                              break
-                    if header_row_idx == -1: header_row_idx = 0 # Если не нашли, считаем с первой
-                    if file_ext == '.xls':
-                        try:
-                            df = pd.read_excel(file_path, header=header_row_idx, usecols=relevant_file_headers, dtype=str, engine='xlrd')
-                        except:
-                            try:
-                                df = pd.read_excel(file_path, header=header_row_idx, usecols=relevant_file_headers, dtype=str, engine='openpyxl')
-                            except:
-                                df = pd.read_excel(file_path, header=header_row_idx, usecols=relevant_file_headers, dtype=str)
-                    else:
-                        df = pd.read_excel(file_path, header=header_row_idx, usecols=relevant_file_headers, dtype=str)
+                    # Лист разбираем один раз: поиск заголовков и данные берутся из одного DataFrame
+                    df_raw = pd.read_excel(file_path, header=None, dtype=str, engine=_excel_engine(file_path))
+                    header_row_idx = _first_header_row(df_raw.head(20), _HEADER_CELL_SHORT_RE)
+                    if header_row_idx is None: header_row_idx = 0 # Если не нашли, считаем с первой
+                    df = _frame_below_header(df_raw, header_row_idx, relevant_file_headers)
                 elif file_ext == '.csv':
                     # ... (Аналогичный код для CSV: определить кодировку/разделитель, найти header_row_idx) ...
                     with open(file_path, 'rb') as f_rb:
                         rawdata = f_rb.read(5000)
-                        encoding = chardet.detect(rawdata)['encoding'] or 'utf-8'
+                        encoding = detect_encoding(rawdata)
                     with io.TextIOWrapper(open(file_path, 'rb'), encoding=encoding, newline='') as f_text:
                         sample_csv = f_text.read(1024)
-                        sniffer = csv.Sniffer()
-                        try:
-                            dialect = sniffer.sniff(sample_csv)
-                            delimiter = dialect.delimiter
-                        except csv.Error:
-                            delimiter = ','
+                        delimiter = _guess_delimiter(sample_csv)
                     with open(file_path, encoding=encoding, newline='') as f_csv:
                         reader = csv.reader(f_csv, delimiter=delimiter)
-                        rows = list(reader)[:20]
+                        rows = list(itertools.islice(reader, 20))
                     for idx, row in enumerate(rows):
-                        row_strs = [str(cell).lower() for cell in row if cell]
-                        matches = sum(any(kw in cell for kw in header_keywords) for cell in row_strs)
+                        matches = _count_header_cells(row, _HEADER_CELL_SHORT_RE)
                         if matches >= 2:
                             header_row_idx = idx
                             break
@@ -401,68 +555,18 @@ def manual_column_mapping(request):
                 df.rename(columns=rename_mapping, inplace=True)
                 
                 # --- (Код сохранения данных в Product - точно такой же, как в upload_price_list) ---
-                Product.objects.filter(supplier=supplier).delete()
-                products_to_create = []
-                created_count = 0
-                skipped_count = 0
-                for index, row in df.iterrows():
-                    name = row.get('name')
-                    price_val = row.get('price')
-                    if pd.isna(name) or not str(name).strip():
-                        skipped_count += 1
-                        continue
-                    price = None
-                    if pd.notna(price_val):
-                        price_str = re.sub(r'[^0-9.,]', '', str(price_val)).replace(',', '.')
-                        try:
-                            price = float(price_str) if price_str else None
-                        except ValueError:
-                            price = None
-                    if price is None:
-                        skipped_count += 1
-                        continue
-                    stock_val = row.get('stock')
-                    stock = 100
-                    if pd.notna(stock_val):
-                        stock_str = str(stock_val).lower()
-                        if 'наличи' in stock_str or 'есть' in stock_str:
-                            stock = 100
-                        elif 'заказ' in stock_str:
-                            stock = 0
-                        else:
-                            stock_str_cleaned = re.sub(r'[^0-9]', '', stock_str)
-                            try:
-                                stock = int(stock_str_cleaned) if stock_str_cleaned else 0
-                            except ValueError:
-                                stock = 0
-                    # Получаем дату из имени файла в разных форматах
-                    file_name = os.path.basename(file_path)
-                    date_match = re.search(r'(\d{2}[._-]\d{2}[._-](?:20)?\d{2})', file_name)
-                    if date_match:
-                        date_raw = date_match.group(1)
-                        # Нормализуем дату
-                        file_date = date_raw.replace('_', '.').replace('-', '.')
-                        if len(file_date.split('.')[-1]) == 2:  # короткий год
-                            parts = file_date.split('.')
-                            file_date = f"{parts[0]}.{parts[1]}.20{parts[2]}"
-                    else:
-                        file_date = "-"
-                    
-                    products_to_create.append(
-                        Product(
-                            supplier=supplier,
-                            name=str(name).strip(),
-                            price=price,
-                            stock=stock,
-                            price_list_date=file_date  # Дата из имени файла
-                        )
-                    )
-                    created_count += 1
-                    if len(products_to_create) >= 500:
-                        Product.objects.bulk_create(products_to_create)
-                        products_to_create = []
-                if products_to_create:
-                    Product.objects.bulk_create(products_to_create)
+                # Получаем дату из имени файла в разных форматах (одна на весь файл)
+                file_name = os.path.basename(file_path)
+                date_match = _FILENAME_DATE_RE.search(file_name)
+                file_date = _filename_date(date_match) if date_match else "-"
+                products_to_create = _products_from_mapped_frame(df, supplier.pk, file_date)
+                created_count = len(products_to_create)
+                skipped_count = len(df) - created_count
+                # Удаление старых и вставка новых товаров – одной транзакцией, пачками по _PRODUCT_BULK_BATCH_SIZE
+                with transaction.atomic():
+                    Product.objects.filter(supplier=supplier).delete_fast()
+                    Product.objects.bulk_create(products_to_create, batch_size=_PRODUCT_BULK_BATCH_SIZE)
+                clear_text_caches()
                 # --- Конец кода сохранения ---
                 
                 messages.success(request, f'Прайс-лист успешно загружен по ручному маппингу. Добавлено {created_count} товаров, пропущено {skipped_count} строк.')
@@ -521,17 +625,42 @@ def generate_proposal_pdf(products, query_text):
 
 
 # Функция генерации Excel КП (исправлена, остается)
-def generate_proposal_excel(products_with_qty, query_text):
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = 'Коммерческое предложение'
+# Стиль шапки КП: регистрируется в книге один раз как именованный, ячейки ссылаются на него по имени
+_PROPOSAL_HEADER_STYLE_NAME = 'kp_header'
+
+
+def _proposal_header_style() -> NamedStyle:
+    return NamedStyle(
+        name=_PROPOSAL_HEADER_STYLE_NAME,
+        font=Font(bold=True),
+        alignment=Alignment(horizontal='center'),
+        border=Border(bottom=Side(style='thin')),
+    )
+
+
+def generate_proposal_excel_bytes(products_with_qty, query_text) -> Tuple[bytes, float]:
+    """
+    Строит xlsx коммерческого предложения в памяти.
+    Возвращает (содержимое файла, итоговая сумма) – сумма считается в том же проходе по позициям.
+    """
+    # write_only: строки сразу сериализуются в поток, объекты ячеек всего листа в памяти не держатся
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Коммерческое предложение')
+    # Ширину столбцов в write_only режиме задаём до первой строки
+    ws.column_dimensions['B'].width = 20 # Поставщик
+    ws.column_dimensions['D'].width = 60 # Наименование
+    ws.column_dimensions['E'].width = 12 # Количество
+    ws.column_dimensions['F'].width = 15 # Цена
+    ws.column_dimensions['G'].width = 15 # Сумма
+    # Стилизация шапки: одна ссылка на именованный стиль вместо трёх копий стиля на ячейку
+    wb.add_named_style(_proposal_header_style())
     # Правильная структура: № | Поставщик | Дата | Товар | Количество | Цена | Сумма
-    ws.append(['№', 'Поставщик', 'Дата загрузки', 'Наименование товара', 'Количество', 'Цена (руб)', 'Сумма (руб)'])
-    # Стилизация шапки
-    for cell in ws[1]:
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(horizontal='center')
-        cell.border = Border(bottom=Side(style='thin'))
+    header = []
+    for title in ['№', 'Поставщик', 'Дата загрузки', 'Наименование товара', 'Количество', 'Цена (руб)', 'Сумма (руб)']:
+        cell = WriteOnlyCell(ws, value=title)
+        cell.style = _PROPOSAL_HEADER_STYLE_NAME
+        header.append(cell)
+    ws.append(header)
     # Данные - обрабатываем как найденные, так и отсутствующие товары
     total = 0
     for i, item_data in enumerate(products_with_qty, 1):
@@ -575,54 +704,48 @@ def generate_proposal_excel(products_with_qty, query_text):
             ])
     # Итог
     ws.append(['', '', '', 'ИТОГО:', '', '', f"{total:.2f}" if total > 0 else "Расчет невозможен"])
-    # Настраиваем ширину столбцов
-    ws.column_dimensions['B'].width = 20 # Поставщик
-    ws.column_dimensions['D'].width = 60 # Наименование
-    ws.column_dimensions['E'].width = 12 # Количество
-    ws.column_dimensions['F'].width = 15 # Цена
-    ws.column_dimensions['G'].width = 15 # Сумма
-    # Сохраняем во временный файл
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue(), total
+
+
+def generate_proposal_excel(products_with_qty, query_text):
+    """Сохраняет КП во временный файл и возвращает путь (для отладочных скриптов; view работают с байтами)"""
     tmp_path = os.path.join(tempfile.gettempdir(), f'KP_{os.urandom(4).hex()}.xlsx')
-    wb.save(tmp_path)
+    with open(tmp_path, 'wb') as f:
+        f.write(generate_proposal_excel_bytes(products_with_qty, query_text)[0])
     return tmp_path
 
 
 # Функция создания КП и сохранения истории (остается)
 def create_proposal(request):
-    logger = logging.getLogger()
     if request.method == 'POST':
         try:
             product_ids = request.POST.getlist('product_ids')
             query_text = request.POST.get('query_text', '')
-            products = Product.objects.filter(id__in=product_ids)
+            # Поставщик нужен в каждой строке КП – подтягиваем JOIN-ом, а не запросом на товар
+            products = Product.objects.filter(id__in=product_ids).select_related('supplier')
             if not products.exists():
                 return HttpResponse('Ошибка: Не выбраны товары для КП', status=400)
-            # Генерируем Excel
-            excel_path = generate_proposal_excel(products, query_text)
-            # Сохраняем Proposal и SearchQuery
-            with open(excel_path, 'rb') as f:
-                # Считаем общую сумму с правильным типом данных
-                total_sum = 0
-                for p in products:
-                    try:
-                        price_num = float(p.price) if p.price != "-" else 0
-                        total_sum += price_num
-                    except (ValueError, TypeError):
-                        continue
-                proposal = Proposal.objects.create(total_sum=total_sum)
-                proposal.products.set(products)
-                proposal.file.save(f"KP_{proposal.id}.xlsx", File(f))
-            search_query, created = SearchQuery.objects.get_or_create(
-                query_text=query_text,
-                defaults={'result_count': products.count()}
+            # Генерируем Excel в памяти: те же байты идут и в Proposal.file, и в ответ – без временного файла
+            # Сумма КП (по одной штуке каждого товара) считается там же, где строятся строки Excel
+            excel_bytes, total_sum = generate_proposal_excel_bytes(
+                [{"product": p, "quantity": 1} for p in products], query_text
             )
+            # Сохраняем Proposal и SearchQuery
+            proposal = Proposal.objects.create(total_sum=total_sum)
+            proposal.products.set(products)
+            proposal.file.save(f"KP_{proposal.id}.xlsx", ContentFile(excel_bytes))
+            search_query = SearchQuery.objects.record(query_text, len(products))
             search_query.proposals.add(proposal)
             logger.info(f"Создано КП {proposal.id} для запроса '{query_text}'")
             # Отдаём файл пользователю
-            with open(excel_path, 'rb') as f:
-                response = HttpResponse(f.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                response['Content-Disposition'] = f'attachment; filename="KP_{search_query.id}.xlsx"'
-                return response
+            return FileResponse(
+                io.BytesIO(excel_bytes),
+                as_attachment=True,
+                filename=f"KP_{search_query.id}.xlsx",
+                content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
         except Exception as e:
             logger.exception("Ошибка при создании КП")
             return HttpResponse(f'Ошибка генерации КП: {e}', status=500)
@@ -642,7 +765,6 @@ class AIProductSearchForm(forms.Form):
 def ai_product_search(request):
     results = None
     query = ''
-    logger = logging.getLogger()
     if request.method == 'POST':
         form = AIProductSearchForm(request.POST)
         if form.is_valid():
@@ -666,32 +788,188 @@ class ClientRequestForm(forms.Form):
     text = forms.CharField(label='Текст запроса', widget=forms.Textarea(attrs={'rows': 4, 'cols': 60}), required=False)
     file = forms.FileField(label='Файл запроса (docx/pdf/xlsx/txt)', required=False)
 
-def extract_quantity(text):
-    """Извлекает количество из текста (например, '5 штук')"""
-    # Ищем число, за которым опционально идет пробел и "шт"/"штук"/"компл"
-    match = re.search(r'(\d+)\s*(?:шт|штук|компл)\b', text, re.IGNORECASE)
-    if match:
+# Импортируем новый ClientRequestExtractor
+from .client_request_extractor import ClientRequestExtractor
+
+def _build_client_proposal(text, file_name=None, file_bytes=None):
+    """
+    Конвейер запроса клиента: разбор файла и текста, поиск товаров, генерация КП.
+    Не зависит от request, поэтому выполняется и в запросе, и в фоновой задаче.
+    Возвращает dict: error, result, notes [(уровень, сообщение)], proposal, search_query, excel_bytes.
+    """
+    outcome = {'error': None, 'result': None, 'notes': [], 'proposal': None, 'search_query': None, 'excel_bytes': None}
+    error = None
+
+    # Сохраняем файл во временную директорию для обработки
+    temp_file_path = None
+    extracted_items_from_file = []
+    if file_bytes is not None:
         try:
-            return int(match.group(1))
-        except ValueError:
-            return None
-    # Если не нашли с "шт", ищем просто последнее число в строке
-    numbers = re.findall(r'\d+', text)
-    if numbers:
+            # Создаем временный файл
+            temp_dir = tempfile.gettempdir()
+            temp_file_name = f"client_request_{os.urandom(8).hex()}_{file_name}"
+            temp_file_path = os.path.join(temp_dir, temp_file_name)
+
+            with open(temp_file_path, 'wb+') as destination:
+                destination.write(file_bytes)
+            logger.info(f"Client request file saved temporarily to: {temp_file_path}")
+
+            # Инициализируем ClientRequestExtractor и обрабатываем файл
+            client_extractor = ClientRequestExtractor(llm=query_processor.llm)
+            file_processing_result = client_extractor.process_client_request_file_cascade(temp_file_path, file_name)
+
+            if file_processing_result.get('success'):
+                extracted_items_from_file = file_processing_result.get('items', [])
+                logger.info(f"Successfully extracted {len(extracted_items_from_file)} items from file.")
+                outcome['notes'].append((messages.INFO, f"Из файла извлечено {len(extracted_items_from_file)} позиций.<pre>{client_extractor.get_client_cascade_summary(file_processing_result)}</pre>"))
+            else:
+                error = f"Ошибка извлечения из файла: {file_processing_result.get('error', 'Неизвестная ошибка')}"
+                logger.error(f"File extraction failed: {error}\n{client_extractor.get_client_cascade_summary(file_processing_result)}")
+                outcome['notes'].append((messages.ERROR, f"Ошибка извлечения из файла: {error}.<pre>{client_extractor.get_client_cascade_summary(file_processing_result)}</pre>"))
+
+        except Exception as e:
+            error = f'Ошибка при работе с файлом запроса: {e}'
+            logger.exception(f"Error processing client request file: {file_name}")
+        finally:
+            if temp_file_path and os.path.exists(temp_file_path):
+                try: os.remove(temp_file_path)
+                except OSError: pass # Игнорируем ошибку удаления временного файла
+
+    # Далее обрабатываем текст запроса (если есть)
+    # Мы объединим результаты текстового извлечения и файлового
+
+    items_from_text = []
+    if text and text.strip() and not error: # Только если нет ошибки при обработке файла
+        logger.info(f"Starting text processing for: {text[:100]}...")
+        # Разделяем запрос на позиции (используем существующий метод из query_processor)
+        # query_processor.split_query_into_items возвращает [{item_query, quantity}]
+        text_items = query_processor.split_query_into_items(text)
+
+        # Для каждой текстовой позиции, создаем ClientRequestedItem
+        from .client_request_extractor import ClientRequestedItem # Временный импорт для Pydantic
+        for item_dict in text_items:
+            item_name = item_dict.get('item_query')
+            item_qty = item_dict.get('quantity')
+            if item_name and item_name.strip():
+                # Пробуем извлечь количество, если оно не было распознано LLM
+                if item_qty is None:
+                    item_qty = extract_quantity(item_name) # Используем старую эвристику extract_quantity
+
+                try:
+                    # Валидируем с помощью ClientRequestedItem (для унификации)
+                    validated_text_item = ClientRequestedItem(full_name=item_name, quantity=item_qty or 1)
+                    items_from_text.append(validated_text_item.dict())
+                except (ValidationError, ValueError) as e:
+                    logger.warning(f"Validation failed for text item '{item_name}': {e}")
+                    # Добавляем как невалидный, но с количеством 1 для дальнейшей обработки
+                    items_from_text.append({"full_name": item_name, "quantity": item_qty or 1})
+
+    # Объединяем все извлеченные позиции (из файла и из текста)
+    all_extracted_items = extracted_items_from_file + items_from_text
+
+    # Устраняем дубликаты из объединенного списка, используя логику ClientRequestExtractor
+    if all_extracted_items:
+        temp_extractor = ClientRequestExtractor(llm=query_processor.llm) # Временный экземпляр для дедупликации
+        final_unique_items = temp_extractor._remove_client_item_duplicates(all_extracted_items)
+        logger.info(f"Total unique items after deduplication: {len(final_unique_items)}")
+    else:
+        final_unique_items = []
+
+    final_products_for_proposal = []
+    if final_unique_items:
+        logger.info(f"Starting product search for {len(final_unique_items)} extracted client items.")
+        # Ключевые слова для всех позиций извлекаем параллельно одной пачкой LLM-запросов
         try:
-            return int(numbers[-1])
-        except ValueError:
-            return None
-    return None
+            batch_results = query_processor.process_queries([item['full_name'] for item in final_unique_items])
+        except Exception:
+            logger.exception("Batch product search failed, falling back to per-item search")
+            batch_results = None
+        for item_idx, client_item in enumerate(final_unique_items):
+            item_query = client_item['full_name']
+            requested_quantity = client_item['quantity']
+                
+            try:
+                # Ищем лучший товар(ы) для этой позиции в нашей базе
+                if batch_results is not None:
+                    found_products = batch_results[item_idx]
+                else:
+                    found_products = query_processor.process_query(item_query)
+                
+                if found_products:
+                    # Добавляем ВСЕ РЕЛЕВАНТНЫЕ ТОВАРЫ, но с запрошенным количеством
+                    for prod in found_products:
+                        final_products_for_proposal.append({
+                            "product": prod,
+                            "quantity": requested_quantity
+                        })
+                else:
+                    # ТОВАР НЕ НАЙДЕН - добавляем как отсутствующий
+                    logger.warning(f"No product found in DB for client item: '{item_query}'")
+                    final_products_for_proposal.append({
+                        "product": None,
+                        "product_name": item_query,
+                        "quantity": requested_quantity,
+                        "status": "ТОВАР ОТСУТСТВУЕТ"
+                    })
+            except Exception as item_search_err:
+                logger.exception(f"Error searching product for client item '{item_query}'")
+                final_products_for_proposal.append({
+                    "product": None,
+                    "product_name": item_query,
+                    "quantity": requested_quantity,
+                    "status": f"ОШИБКА ПОИСКА: {item_search_err}"
+                })
+
+        # 3. Генерируем КП всегда (даже если товары отсутствуют)
+        if final_products_for_proposal:
+            logger.info(f"Generating proposal for {len(final_products_for_proposal)} final items.")
+            try:
+                # Excel строится в памяти; те же байты сохраняются в Proposal.file и отдаются в ответе
+                # Итог (только найденные товары с ценой) считается в том же проходе, что и строки Excel
+                excel_bytes, total_sum = generate_proposal_excel_bytes(final_products_for_proposal, text or file_name)
+                proposal = Proposal.objects.create(total_sum=total_sum)
+                found_products_objects = [p_data["product"] for p_data in final_products_for_proposal if p_data.get("product")]
+                proposal.products.set(found_products_objects)
+                proposal.file.save(f"KP_{proposal.id}.xlsx", ContentFile(excel_bytes))
+                
+                search_query_text = text[:2000] if text else (file_name[:2000] if file_name else "Пустой запрос")
+                search_query = SearchQuery.objects.record(search_query_text, len(final_products_for_proposal))
+                search_query.proposals.add(proposal)
+                logger.info(f"Saved Proposal {proposal.id} and SearchQuery {search_query.id}.")
+                outcome.update(proposal=proposal, search_query=search_query, excel_bytes=excel_bytes)
+            except Exception as proposal_err:
+                logger.exception("Error during proposal generation/saving")
+                error = f"Ошибка формирования/отправки КП: {proposal_err}"
+
+        if not final_products_for_proposal and not error:
+            outcome['result'] = 'По вашему запросу ничего не найдено.'
+            logger.warning("No products found for any item in the query.")
+
+    elif not error:
+        error = 'Пустой запрос. Введите текст или загрузите файл.'
+        logger.warning("Empty request text and no file.")
+
+    outcome['error'] = error
+    return outcome
+
+
+def _client_request_job(text, file_name, file_bytes):
+    """Фоновая задача: тот же конвейер, в статус кладем только ссылку на сохраненный КП."""
+    outcome = _build_client_proposal(text, file_name, file_bytes)
+    proposal = outcome['proposal']
+    return {
+        'error': outcome['error'],
+        'result': outcome['result'],
+        'notes': [note for _, note in outcome['notes']],
+        'proposal_id': proposal.id if proposal else None,
+        'file_url': proposal.file.url if proposal and proposal.file else None,
+    }
 
-# Импортируем новый ClientRequestExtractor
-from .client_request_extractor import ClientRequestExtractor
 
 @csrf_exempt
 def client_request_to_proposal(request):
     result = None
     error = None
-    logger = logging.getLogger()
     form = ClientRequestForm(request.POST or None, request.FILES or None)
 
     if request.method == 'POST':
@@ -701,166 +979,36 @@ def client_request_to_proposal(request):
 
         if form.is_valid():
             text = form.cleaned_data['text']
-            file_obj = form.cleaned_data['file'] # Используем file_obj, чтобы не конфликтовать с file_path ниже
-            
-            # Сохраняем файл во временную директорию для обработки
-            temp_file_path = None
-            extracted_items_from_file = []
-            if file_obj:
-                try:
-                    # Создаем временный файл
-                    temp_dir = tempfile.gettempdir()
-                    temp_file_name = f"client_request_{os.urandom(8).hex()}_{file_obj.name}"
-                    temp_file_path = os.path.join(temp_dir, temp_file_name)
-
-                    with open(temp_file_path, 'wb+') as destination:
-                        for chunk in file_obj.chunks():
-                            destination.write(chunk)
-                    logger.info(f"Client request file saved temporarily to: {temp_file_path}")
-
-                    # Инициализируем ClientRequestExtractor и обрабатываем файл
-                    client_extractor = ClientRequestExtractor(llm=query_processor.llm)
-                    file_processing_result = client_extractor.process_client_request_file_cascade(temp_file_path, file_obj.name)
-                    
-                    if file_processing_result.get('success'):
-                        extracted_items_from_file = file_processing_result.get('items', [])
-                        logger.info(f"Successfully extracted {len(extracted_items_from_file)} items from file.")
-                        messages.info(request, f"Из файла извлечено {len(extracted_items_from_file)} позиций.<pre>{client_extractor.get_client_cascade_summary(file_processing_result)}</pre>")
-                    else:
-                        error = f"Ошибка извлечения из файла: {file_processing_result.get('error', 'Неизвестная ошибка')}"
-                        logger.error(f"File extraction failed: {error}\n{client_extractor.get_client_cascade_summary(file_processing_result)}")
-                        messages.error(request, f"Ошибка извлечения из файла: {error}.<pre>{client_extractor.get_client_cascade_summary(file_processing_result)}</pre>")
-                        
-                except Exception as e:
-                    error = f'Ошибка при работе с файлом запроса: {e}'
-                    logger.exception(f"Error processing client request file: {file_obj.name}")
-                finally:
-                    if temp_file_path and os.path.exists(temp_file_path):
-                        try: os.remove(temp_file_path)
-                        except OSError: pass # Игнорируем ошибку удаления временного файла
-            
-            # Далее обрабатываем текст запроса (если есть)
-            # Мы объединим результаты текстового извлечения и файлового
-            
-            items_from_text = []
-            if text and text.strip() and not error: # Только если нет ошибки при обработке файла
-                logger.info(f"Starting text processing for: {text[:100]}...")
-                # Разделяем запрос на позиции (используем существующий метод из query_processor)
-                # query_processor.split_query_into_items возвращает [{item_query, quantity}]
-                text_items = query_processor.split_query_into_items(text)
-                
-                # Для каждой текстовой позиции, создаем ClientRequestedItem
-                from .client_request_extractor import ClientRequestedItem # Временный импорт для Pydantic
-                for item_dict in text_items:
-                    item_name = item_dict.get('item_query')
-                    item_qty = item_dict.get('quantity')
-                    if item_name and item_name.strip():
-                        # Пробуем извлечь количество, если оно не было распознано LLM
-                        if item_qty is None:
-                            item_qty = extract_quantity(item_name) # Используем старую эвристику extract_quantity
-                        
-                        try:
-                            # Валидируем с помощью ClientRequestedItem (для унификации)
-                            validated_text_item = ClientRequestedItem(full_name=item_name, quantity=item_qty or 1)
-                            items_from_text.append(validated_text_item.dict())
-                        except (ValidationError, ValueError) as e:
-                            logger.warning(f"Validation failed for text item '{item_name}': {e}")
-                            # Добавляем как невалидный, но с количеством 1 для дальнейшей обработки
-                            items_from_text.append({"full_name": item_name, "quantity": item_qty or 1})
-                            
-            # Объединяем все извлеченные позиции (из файла и из текста)
-            all_extracted_items = extracted_items_from_file + items_from_text
-            
-            # Устраняем дубликаты из объединенного списка, используя логику ClientRequestExtractor
-            if all_extracted_items:
-                temp_extractor = ClientRequestExtractor(llm=query_processor.llm) # Временный экземпляр для дедупликации
-                final_unique_items = temp_extractor._remove_client_item_duplicates(all_extracted_items)
-                logger.info(f"Total unique items after deduplication: {len(final_unique_items)}")
-            else:
-                final_unique_items = []
-
-            final_products_for_proposal = []
-            if final_unique_items:
-                logger.info(f"Starting product search for {len(final_unique_items)} extracted client items.")
-                for client_item in final_unique_items:
-                    item_query = client_item['full_name']
-                    requested_quantity = client_item['quantity']
-                        
-                    try:
-                        # Ищем лучший товар(ы) для этой позиции в нашей базе
-                        found_products = query_processor.process_query(item_query)
-                        
-                        if found_products:
-                            # Добавляем ВСЕ РЕЛЕВАНТНЫЕ ТОВАРЫ, но с запрошенным количеством
-                            for prod in found_products:
-                                final_products_for_proposal.append({
-                                    "product": prod,
-                                    "quantity": requested_quantity
-                                })
-                        else:
-                            # ТОВАР НЕ НАЙДЕН - добавляем как отсутствующий
-                            logger.warning(f"No product found in DB for client item: '{item_query}'")
-                            final_products_for_proposal.append({
-                                "product": None,
-                                "product_name": item_query,
-                                "quantity": requested_quantity,
-                                "status": "ТОВАР ОТСУТСТВУЕТ"
-                            })
-                    except Exception as item_search_err:
-                        logger.exception(f"Error searching product for client item '{item_query}'")
-                        final_products_for_proposal.append({
-                            "product": None,
-                            "product_name": item_query,
-                            "quantity": requested_quantity,
-                            "status": f"ОШИБКА ПОИСКА: {item_search_err}"
-                        })
+            file_obj = form.cleaned_data['file']
+
+            file_name = file_obj.name if file_obj else None
+            file_bytes = file_obj.read() if file_obj else None
+
+            # AJAX-запрос: обработка уходит в фоновую задачу, клиент опрашивает proposal_status
+            if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+                job_id = submit_job(_client_request_job, text, file_name, file_bytes)
+                logger.info(f"Client request queued as job {job_id}")
+                return JsonResponse({
+                    'job_id': job_id,
+                    'status_url': reverse('proposal_status', args=[job_id]),
+                }, status=202)
 
-                # 3. Генерируем КП всегда (даже если товары отсутствуют)
-                if final_products_for_proposal:
-                    logger.info(f"Generating proposal for {len(final_products_for_proposal)} final items.")
-                    try:
-                        excel_path = generate_proposal_excel(final_products_for_proposal, text or file_obj.name)
-                        with open(excel_path, 'rb') as f:
-                            total_sum = 0
-                            # Считаем только товары, которые есть в наличии и имеют цену
-                            for p_data in final_products_for_proposal:
-                                if p_data.get("product"):
-                                    try:
-                                        price_num = float(p_data["product"].price) if p_data["product"].price != "-" else 0
-                                        total_sum += price_num * (p_data["quantity"] or 0) # Используем 0 если количество None
-                                    except (ValueError, TypeError):
-                                        continue
-                            proposal = Proposal.objects.create(total_sum=total_sum)
-                            found_products_objects = [p_data["product"] for p_data in final_products_for_proposal if p_data.get("product")]
-                            proposal.products.set(found_products_objects)
-                            proposal.file.save(f"KP_{proposal.id}.xlsx", File(f))
-                        
-                        search_query_text = text[:2000] if text else (file_obj.name[:2000] if file_obj else "Пустой запрос")
-                        search_query, created = SearchQuery.objects.get_or_create(
-                            query_text=search_query_text, 
-                            defaults={'result_count': len(final_products_for_proposal)}
-                        )
-                        search_query.proposals.add(proposal)
-                        logger.info(f"Saved Proposal {proposal.id} and SearchQuery {search_query.id}.")
-                        
-                        logger.info("Attempting to return Excel file response.")
-                        with open(excel_path, 'rb') as f_resp:
-                            response = HttpResponse(f_resp.read(), content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-                            response['Content-Disposition'] = f'attachment; filename="KP_{search_query.id}.xlsx"'
-                            logger.info("Successfully created HttpResponse for Excel.")
-                            return response
-                    except Exception as proposal_err:
-                        logger.exception("Error during proposal generation/saving/response")
-                        error = f"Ошибка формирования/отправки КП: {proposal_err}"
-                        # НЕ ДЕЛАЕМ RETURN
-
-                if not final_products_for_proposal and not error:
-                    result = 'По вашему запросу ничего не найдено.'
-                    logger.warning("No products found for any item in the query.")
-
-            elif not error:
-                error = 'Пустой запрос. Введите текст или загрузите файл.'
-                logger.warning("Empty request text and no file.")
+            outcome = _build_client_proposal(text, file_name, file_bytes)
+            for level, note in outcome['notes']:
+                messages.add_message(request, level, note)
+            error = outcome['error']
+            result = outcome['result']
+
+            if outcome['excel_bytes'] is not None:
+                logger.info("Attempting to return Excel file response.")
+                response = FileResponse(
+                    io.BytesIO(outcome['excel_bytes']),
+                    as_attachment=True,
+                    filename=f"KP_{outcome['search_query'].id}.xlsx",
+                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+                )
+                logger.info("Successfully created FileResponse for Excel.")
+                return response
         else:
              error = "Ошибка формы. " + str(form.errors)
              logger.error(f"Form validation error: {form.errors}")
@@ -868,6 +1016,19 @@ def client_request_to_proposal(request):
     logger.info(f"Rendering template 'client_request.html' with result='{result}', error='{error}'")
     return render(request, 'products/client_request.html', {'form': form, 'result': result, 'error': error})
 
+
+def proposal_status(request, job_id):
+    """Статус фоновой обработки запроса клиента; по готовности – ссылка на КП."""
+    job = job_status(job_id)
+    if job is None:
+        return JsonResponse({'status': 'unknown'}, status=404)
+    payload = {'status': job['status']}
+    if job['status'] == 'done':
+        payload.update(job['result'])
+    elif job['status'] == 'failed':
+        payload['error'] = job['error']
+    return JsonResponse(payload)
+
 def faq(request):
     return render(request, 'products/faq.html')
 